@@ -0,0 +1,136 @@
+"""
+驗證碼辨識離線基準測試
+對一個資料夾中已標註的驗證碼 (檔名前 5 碼為答案，例如 12345.png) 量測各辨識器的正確率與延遲
+
+樣板與評分使用不同的驗證碼，避免每個字元都比對到自己而高估正確率：
+- --templates-from 指定另一個已標註資料夾建立樣板，評分使用 labelled_dir 全部
+- 未指定時將 labelled_dir 依 --test-ratio 切分，樣板只用訓練集建立，評分只用測試集
+
+本機辨識器另外在測試集上列出各信心門檻的採用比例與正確率，用來校正 EINVOICE_CAPTCHA_MIN_CONFIDENCE
+
+使用方式：
+    # 以 30% 保留資料評分並校正信心門檻
+    python benchmarks/captcha_benchmark.py captchas/ --build-templates captcha_templates --test-ratio 0.3
+
+    # 從另一個資料夾建立樣板，比較本機、OpenAI 與自動 (本機優先) 三種模式
+    python benchmarks/captcha_benchmark.py captchas_test/ --build-templates captcha_templates \
+        --templates-from captchas_train/ --recognizers local,openai,auto
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from captcha_recognizer import (  # noqa: E402
+    TemplateCaptchaRecognizer,
+    create_captcha_recognizer,
+    iter_labelled_captchas,
+)
+from openai_client import percentile  # noqa: E402
+
+THRESHOLDS = [0.70, 0.75, 0.80, 0.85, 0.90, 0.95]
+
+
+def split_samples(samples: list, test_ratio: float, seed: int) -> tuple:
+    """依固定亂數種子切分成 (訓練集, 測試集)"""
+    shuffled = samples[:]
+    random.Random(seed).shuffle(shuffled)
+    test_count = max(1, round(len(shuffled) * test_ratio))
+    return shuffled[test_count:], shuffled[:test_count]
+
+
+def run(labelled_dir: str, samples: list, mode: str) -> dict:
+    """以指定模式辨識樣本，另記錄每個樣本的 (信心, 是否正確) 供校正門檻"""
+    recognizer = create_captcha_recognizer(mode)
+    correct = 0
+    latencies = []
+    outcomes = []
+
+    for filename, label in samples:
+        with open(os.path.join(labelled_dir, filename), 'rb') as f:
+            captcha_png = f.read()
+
+        started = time.perf_counter()
+        text, confidence = recognizer.recognize(captcha_png)
+        latencies.append((time.perf_counter() - started) * 1000)
+        correct += text == label
+        outcomes.append((confidence, text == label))
+
+    return {
+        'mode': mode,
+        'samples': len(samples),
+        'accuracy': correct / len(samples) if samples else 0.0,
+        'p50_ms': statistics.median(latencies) if latencies else 0.0,
+        'p95_ms': percentile(latencies, 95) if latencies else 0.0,
+        'mean_ms': statistics.mean(latencies) if latencies else 0.0,
+        'outcomes': outcomes,
+    }
+
+
+def print_calibration(outcomes: list, target_precision: float):
+    """各信心門檻下本機辨識的採用比例與採用部分的正確率，並建議門檻"""
+    print(f"\n信心門檻校正 (測試集 {len(outcomes)} 筆):")
+    print(f"{'門檻':<8}{'採用比例':>10}{'採用正確率':>12}")
+    suggested = None
+    for threshold in THRESHOLDS:
+        accepted = [ok for confidence, ok in outcomes if confidence >= threshold]
+        precision = sum(accepted) / len(accepted) if accepted else None
+        print(
+            f"{threshold:<8.2f}{len(accepted) / len(outcomes) if outcomes else 0.0:>10.1%}"
+            f"{f'{precision:.1%}' if precision is not None else '-':>12}"
+        )
+        if suggested is None and precision is not None and precision >= target_precision:
+            suggested = threshold
+
+    if suggested is None:
+        print(f"沒有門檻的採用正確率達到 {target_precision:.0%}，建議增加樣板資料或只使用 OpenAI")
+    else:
+        print(f"建議 EINVOICE_CAPTCHA_MIN_CONFIDENCE={suggested:.2f} (採用正確率 ≥ {target_precision:.0%} 的最低門檻)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="驗證碼辨識正確率 / 延遲基準測試")
+    parser.add_argument('labelled_dir', help="已標註的驗證碼資料夾")
+    parser.add_argument('--recognizers', default='local', help="要測試的模式，以逗號分隔 (local, openai, auto)")
+    parser.add_argument('--build-templates', metavar='DIR', help="先建立本機樣板到 DIR")
+    parser.add_argument('--templates-from', metavar='DIR', help="建立樣板用的另一個已標註資料夾 (未指定時切分 labelled_dir)")
+    parser.add_argument('--test-ratio', type=float, default=0.3, help="未指定 --templates-from 時保留作為測試集的比例")
+    parser.add_argument('--seed', type=int, default=0, help="切分測試集的亂數種子")
+    parser.add_argument('--target-precision', type=float, default=0.99, help="校正門檻時要求的採用正確率")
+    args = parser.parse_args()
+
+    samples = list(iter_labelled_captchas(args.labelled_dir))
+    if args.build_templates:
+        if args.templates_from:
+            count = TemplateCaptchaRecognizer.build_templates(args.templates_from, args.build_templates)
+            print(f"從 {args.templates_from} 建立 {count} 個樣板於 {args.build_templates}")
+        else:
+            train, samples = split_samples(samples, args.test_ratio, args.seed)
+            count = TemplateCaptchaRecognizer.build_templates(
+                args.labelled_dir, args.build_templates, [filename for filename, _ in train]
+            )
+            print(f"以 {len(train)} 張訓練集建立 {count} 個樣板於 {args.build_templates}，以其餘 {len(samples)} 張評分")
+        os.environ['EINVOICE_CAPTCHA_TEMPLATES_DIR'] = args.build_templates
+
+    results = []
+    print(f"{'模式':<8}{'樣本':>6}{'正確率':>10}{'p50 (ms)':>12}{'p95 (ms)':>12}{'平均 (ms)':>12}")
+    for mode in args.recognizers.split(','):
+        result = run(args.labelled_dir, samples, mode.strip())
+        results.append(result)
+        print(
+            f"{result['mode']:<8}{result['samples']:>6}{result['accuracy']:>10.1%}"
+            f"{result['p50_ms']:>12.1f}{result['p95_ms']:>12.1f}{result['mean_ms']:>12.1f}"
+        )
+
+    for result in results:
+        if result['mode'] == 'local':
+            print_calibration(result['outcomes'], args.target_precision)
+
+
+if __name__ == "__main__":
+    main()
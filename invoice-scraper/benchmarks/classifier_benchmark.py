@@ -0,0 +1,230 @@
+"""
+發票分類離線基準測試
+以標註資料與本機 stub OpenAI 伺服器量測各分類模式的吞吐量、延遲與快取命中率，
+不需要網路也不會產生 API 費用
+
+stub 伺服器直接以同一份標註資料作答 (不理會提示詞規則)，因此使用 stub 時的「一致率」只反映
+回應解析 / 批次對應 / 快取是否正確處理回覆 (只有 --wrong-rate 會讓它下降)，不代表分類正確率；
+分類正確率需以 --base-url 指向真實的 OpenAI 相容端點量測
+
+模式：
+    single  逐張呼叫 classify_invoice (不使用快取)
+    batch   classify_invoices 每 batch-size 張合併成一次請求 (不使用快取)
+    pool    ClassificationPool 並行送出各批次 (不使用快取)
+    cached  逐張分類兩輪 (cold / warm)，第二輪應全部命中快取
+
+tokens/張 為回覆 usage 欄位的平均 token 數 (使用 stub 時為粗估值)
+
+使用方式：
+    # 使用內建 stub 伺服器 (每個請求延遲 0.2 秒，5% 回傳 500)
+    python benchmarks/classifier_benchmark.py --latency 0.2 --error-rate 0.05
+
+    # 指向已啟動的 stub 伺服器或其他 OpenAI 相容端點
+    python benchmarks/classifier_benchmark.py --base-url http://127.0.0.1:8765/v1 --modes batch,pool
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 在載入分類模組前停用本機店家分類器，並關閉 SDK 重試以量測原始的錯誤率
+os.environ['EINVOICE_MERCHANT_CLASSIFIER'] = '0'
+os.environ.setdefault('OPENAI_MAX_RETRIES', '0')
+
+import category_classifier  # noqa: E402
+import openai_client  # noqa: E402
+from disk_cache import DiskLRUCache  # noqa: E402
+from stub_openai_server import DEFAULT_FIXTURES, StubOpenAIServer, load_fixtures  # noqa: E402
+
+
+def invoice_input(fixture: dict) -> dict:
+    return {
+        'seller_name': fixture['seller_name'],
+        'details': fixture['details'],
+        'transaction_time': fixture.get('transaction_time')
+    }
+
+
+def run_single(fixtures: list, args) -> tuple:
+    """逐張分類，延遲為每張的呼叫時間"""
+    predictions, latencies = [], []
+    for fixture in fixtures:
+        started = time.perf_counter()
+        predictions.append(category_classifier.classify_invoice(**invoice_input(fixture)))
+        latencies.append(time.perf_counter() - started)
+    return predictions, latencies
+
+
+def run_batch(fixtures: list, args) -> tuple:
+    """每 batch_size 張一次請求，同批發票的延遲為該批的呼叫時間"""
+    predictions, latencies = [], []
+    for start in range(0, len(fixtures), args.batch_size):
+        chunk = fixtures[start:start + args.batch_size]
+        started = time.perf_counter()
+        predictions.extend(category_classifier.classify_invoices([invoice_input(f) for f in chunk], args.batch_size))
+        latencies.extend([time.perf_counter() - started] * len(chunk))
+    return predictions, latencies
+
+
+def run_pool(fixtures: list, args) -> tuple:
+    """所有批次同時交給分類池，延遲為該批從送出到完成的時間"""
+    pool = category_classifier.ClassificationPool(args.concurrency, args.batch_size)
+
+    async def classify_chunk(chunk: list, started: float) -> tuple:
+        results = await pool.classify([invoice_input(f) for f in chunk])
+        return results, time.perf_counter() - started
+
+    async def classify_all() -> list:
+        started = time.perf_counter()
+        chunks = [fixtures[start:start + args.batch_size] for start in range(0, len(fixtures), args.batch_size)]
+        try:
+            return await asyncio.gather(*(classify_chunk(chunk, started) for chunk in chunks))
+        finally:
+            # 非同步用戶端綁定此 event loop，結束前關閉，下次使用時重新建立
+            await openai_client.close_openai_clients()
+
+    predictions, latencies = [], []
+    for results, elapsed in asyncio.run(classify_all()):
+        predictions.extend(results)
+        latencies.extend([elapsed] * len(results))
+    return predictions, latencies
+
+
+MODES = {
+    'single': run_single,
+    'batch': run_batch,
+    'pool': run_pool,
+}
+
+
+def score(fixtures: list, predictions: list, latencies: list, elapsed: float, mode: str) -> dict:
+    exact = sum(p["name"] == f["name"] and p["category"] == f["category"] for f, p in zip(fixtures, predictions))
+    category = sum(p["category"] == f["category"] for f, p in zip(fixtures, predictions))
+    return {
+        'mode': mode,
+        'samples': len(fixtures),
+        'throughput': len(fixtures) / elapsed if elapsed else 0.0,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0.0,
+        'p95_ms': openai_client.percentile(latencies, 95) * 1000 if latencies else 0.0,
+        'hit_ratio': None,
+        'exact_match': exact / len(fixtures) if fixtures else 0.0,
+        'category_match': category / len(fixtures) if fixtures else 0.0,
+    }
+
+
+def tokens_per_invoice(usage, count: int) -> float:
+    total = usage.snapshot().get('total')
+    return total['total_tokens'] / count if total and count else 0.0
+
+
+def run(mode: str, fixtures: list, args) -> dict:
+    """以指定模式分類所有標註資料 (不使用快取)"""
+    category_classifier.classification_cache = None
+    usage = openai_client.begin_usage_scope()
+    started = time.perf_counter()
+    predictions, latencies = MODES[mode](fixtures, args)
+    result = score(fixtures, predictions, latencies, time.perf_counter() - started, mode)
+    result['tokens'] = tokens_per_invoice(usage, len(fixtures))
+    return result
+
+
+def run_cached(fixtures: list, args, cache_dir: str) -> list:
+    """以空白快取逐張分類兩輪，回傳 cold / warm 兩輪的結果"""
+    results = []
+    cache = DiskLRUCache(os.path.join(cache_dir, 'cache.sqlite3'), max_entries=10000, namespace='benchmark')
+    category_classifier.classification_cache = cache
+    for label in ('cached-cold', 'cached-warm'):
+        cache.hits = cache.misses = 0
+        usage = openai_client.begin_usage_scope()
+        started = time.perf_counter()
+        predictions, latencies = run_single(fixtures, args)
+        result = score(fixtures, predictions, latencies, time.perf_counter() - started, label)
+        result['hit_ratio'] = cache.stats().get('hit_ratio')
+        result['tokens'] = tokens_per_invoice(usage, len(fixtures))
+        results.append(result)
+    category_classifier.classification_cache = None
+    return results
+
+
+def print_result(result: dict):
+    hit_ratio = f"{result['hit_ratio']:.1%}" if result['hit_ratio'] is not None else "-"
+    print(
+        f"{result['mode']:<14}{result['samples']:>6}{result['throughput']:>12.1f}"
+        f"{result['p50_ms']:>11.1f}{result['p95_ms']:>11.1f}{hit_ratio:>10}"
+        f"{result['exact_match']:>12.1%}{result['category_match']:>10.1%}{result['tokens']:>12.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="發票分類吞吐量 / 延遲 / 正確率基準測試")
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES, help="標註資料 JSON 檔")
+    parser.add_argument('--modes', default='single,batch,pool,cached', help="要測試的模式，以逗號分隔")
+    parser.add_argument('--repeat', type=int, default=1, help="標註資料重複幾次 (增加樣本數)")
+    parser.add_argument('--batch-size', type=int, default=category_classifier.CLASSIFY_BATCH_SIZE, help="批次大小")
+    parser.add_argument('--concurrency', type=int, default=category_classifier.CLASSIFY_CONCURRENCY, help="分類池並行數")
+    parser.add_argument('--base-url', help="使用已啟動的 OpenAI 相容端點 (未指定時啟動內建 stub 伺服器)")
+    parser.add_argument('--latency', type=float, default=0.2, help="stub 每個請求的延遲秒數")
+    parser.add_argument('--jitter', type=float, default=0.05, help="stub 延遲的隨機浮動秒數")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="stub 回傳 500 的比例")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="stub 回傳 429 的比例")
+    parser.add_argument('--wrong-rate', type=float, default=0.0, help="stub 故意回答錯誤分類的比例")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures) * args.repeat
+
+    server = None
+    if args.base_url:
+        os.environ['OPENAI_BASE_URL'] = args.base_url
+    else:
+        server = StubOpenAIServer(
+            load_fixtures(args.fixtures), latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate, wrong_rate=args.wrong_rate
+        ).start()
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'stub')
+    print(f"端點 {os.environ['OPENAI_BASE_URL']}，{len(fixtures)} 筆標註資料，批次 {args.batch_size}，並行 {args.concurrency}\n")
+
+    # 只有真實端點的結果與標註比對才是正確率；stub 依標註作答，只能檢查回應處理的一致率
+    metric = '正確' if args.base_url else '一致'
+    if not args.base_url:
+        print("使用 stub 伺服器：一致率只反映回應處理 (受 --wrong-rate 影響)，不是分類正確率\n")
+    print(
+        f"{'模式':<14}{'樣本':>6}{'吞吐 (張/秒)':>12}{'p50 (ms)':>11}{'p95 (ms)':>11}{'快取命中':>10}"
+        f"{metric + ' 名稱+分類':>12}{metric + ' 分類':>10}{'tokens/張':>12}"
+    )
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for mode in args.modes.split(','):
+                mode = mode.strip()
+                if mode == 'cached':
+                    for result in run_cached(fixtures, args, cache_dir):
+                        print_result(result)
+                elif mode in MODES:
+                    print_result(run(mode, fixtures, args))
+                else:
+                    print(f"未知的模式: {mode}")
+    finally:
+        if server is not None:
+            server.stop()
+            print(f"\nstub 伺服器: {server.stats}")
+
+    print("\nOpenAI 請求延遲:")
+    for name, stats in openai_client.latency_stats().items():
+        print(f"  {name:<16}次數 {stats['count']:>5}  錯誤 {stats['errors']:>4}  p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms")
+
+    print("\nOpenAI token 用量:")
+    for name, usage in openai_client.usage_stats().items():
+        print(
+            f"  {name:<16}輸入 {usage['prompt_tokens']:>8}  輸出 {usage['completion_tokens']:>6}  "
+            f"估算費用 ${usage['estimated_cost_usd']:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
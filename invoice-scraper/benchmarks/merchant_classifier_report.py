@@ -0,0 +1,147 @@
+"""
+本機店家分類器離線正確率報告
+以 Notion 歷史交易依日期切分：較舊的記錄建立模型，最新的記錄作為測試集，
+量測本機分類器的涵蓋率 / 正確率，並可與 OpenAI 在同一測試集上比較
+
+使用方式：
+    # 從 Notion 取得最近 12 個月的記錄並匯出，方便之後離線重跑
+    python benchmarks/merchant_classifier_report.py --months 12 --export history.json
+
+    # 使用匯出的記錄，並與 OpenAI 比較
+    python benchmarks/merchant_classifier_report.py --history history.json --llm
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from category_classifier import (  # noqa: E402
+    CATEGORIES,
+    MERCHANT_MIN_CONFIDENCE,
+    _classify_uncached,
+    history_time,
+    normalize_seller,
+    time_bucket,
+)
+from merchant_classifier import MerchantClassifier  # noqa: E402
+
+
+def load_history(args) -> list:
+    """讀取匯出的記錄，或從 Notion 取得"""
+    if args.history:
+        with open(args.history, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    from notion_service import NotionService
+
+    start_date = (datetime.now() - timedelta(days=31 * args.months)).strftime('%Y-%m-%d')
+    history = NotionService().get_transaction_history(start_date)
+    if args.export:
+        with open(args.export, 'w', encoding='utf-8') as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+        print(f"已匯出 {len(history)} 筆記錄到 {args.export}")
+    return history
+
+
+def record_details(record: dict) -> str:
+    """從備註還原消費明細（沒有明細時備註為「發票號碼 - 平台店家名稱」）"""
+    note = record.get("備註") or ""
+    return "" if note.startswith(f"{record['發票號碼']} - ") else note
+
+
+def is_correct(prediction: dict, record: dict) -> tuple:
+    """(名稱與分類都正確, 分類正確)"""
+    category_ok = prediction["category"] == record["分類"]
+    return category_ok and prediction["name"] == record["名稱"], category_ok
+
+
+def rate(count: int, total: int) -> str:
+    return f"{count / total:.1%}" if total else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機店家分類器 vs OpenAI 正確率報告")
+    parser.add_argument('--history', help="get_transaction_history 匯出的 JSON 檔 (未指定時從 Notion 取得)")
+    parser.add_argument('--months', type=int, default=12, help="從 Notion 取得最近幾個月的記錄")
+    parser.add_argument('--export', metavar='FILE', help="將從 Notion 取得的記錄匯出到 FILE")
+    parser.add_argument('--test-ratio', type=float, default=0.2, help="最新的多少比例記錄作為測試集")
+    parser.add_argument('--min-confidence', type=float, default=MERCHANT_MIN_CONFIDENCE, help="本機分類器採用的最低信心")
+    parser.add_argument('--llm', action='store_true', help="同時以 OpenAI 分類測試集 (會產生 API 費用)")
+    args = parser.parse_args()
+
+    history = [
+        record for record in load_history(args)
+        if record.get("店家") and record.get("分類") in CATEGORIES and record.get("名稱")
+    ]
+    history.sort(key=lambda record: record["日期"])
+    split = int(len(history) * (1 - args.test_ratio))
+    train, test = history[:split], history[split:]
+    if not test:
+        print("記錄不足，無法建立測試集")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        classifier = MerchantClassifier(os.path.join(tmp_dir, 'model.json'))
+        merchants = classifier.build(
+            (normalize_seller(r["店家"]), time_bucket(history_time(r["日期"])), r["名稱"], r["分類"]) for r in train
+        )
+
+    print(f"訓練 {len(train)} 筆 ({merchants} 個店家)，測試 {len(test)} 筆，信心門檻 {args.min_confidence}")
+
+    local_total = local_exact = local_category = 0
+    llm_exact = llm_category = 0
+    llm_on_local_exact = 0
+    combined_exact = combined_category = 0
+    mixed_total = mixed_exact = 0  # 多分類店家：只憑店家的猜測，交給快取 / OpenAI
+
+    for record in test:
+        transaction_time = history_time(record["日期"])
+        seller = normalize_seller(record["店家"])
+        prediction, confidence = classifier.predict(seller, time_bucket(transaction_time))
+        confident = prediction is not None and confidence >= args.min_confidence
+
+        entry = classifier.merchants.get(seller)
+        if prediction is not None and entry is not None and not classifier.is_single_category(entry):
+            mixed_total += 1
+            mixed_exact += is_correct(prediction, record)[0]
+
+        llm_prediction = None
+        if args.llm:
+            # 與正式流程相同的 OpenAI 分類 (不查也不寫快取)，失敗時為預設分類
+            llm_prediction = _classify_uncached(record["店家"], record_details(record), transaction_time, None)
+            exact, category = is_correct(llm_prediction, record)
+            llm_exact += exact
+            llm_category += category
+
+        if confident:
+            local_total += 1
+            exact, category = is_correct(prediction, record)
+            local_exact += exact
+            local_category += category
+            combined_exact += exact
+            combined_category += category
+            if llm_prediction is not None:
+                llm_on_local_exact += is_correct(llm_prediction, record)[0]
+        elif llm_prediction is not None:
+            exact, category = is_correct(llm_prediction, record)
+            combined_exact += exact
+            combined_category += category
+
+    print(f"\n本機分類器涵蓋率: {rate(local_total, len(test))} ({local_total}/{len(test)})")
+    print(f"{'':<24}{'名稱+分類':>12}{'分類':>10}")
+    print(f"{'本機 (有把握的部分)':<24}{rate(local_exact, local_total):>12}{rate(local_category, local_total):>10}")
+    print(f"{'多分類店家只憑店家猜測':<24}{rate(mixed_exact, mixed_total):>12}{'':>10}  ({mixed_total} 筆，不採用)")
+    if args.llm:
+        print(f"{'OpenAI (同一部分)':<24}{rate(llm_on_local_exact, local_total):>12}{'':>10}")
+        print(f"{'OpenAI (全部)':<24}{rate(llm_exact, len(test)):>12}{rate(llm_category, len(test)):>10}")
+        print(f"{'本機 + OpenAI (全部)':<24}{rate(combined_exact, len(test)):>12}{rate(combined_category, len(test)):>10}")
+        print(f"\n可省下的 OpenAI 呼叫: {rate(local_total, len(test))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+店家名稱正規化基準測試
+以真實的平台店家名稱（分類標註資料，及可選的 Notion 歷史記錄）依出現頻率抽樣為查詢語料，量測：
+- 每秒查詢數：trie + LRU 快取、trie 不快取、逐一比對別名的基準做法
+- 碎片化程度：原始名稱、舊的字尾去除做法與標準店家 ID 各有幾個不同的鍵
+- 已知寫法的對應結果 (REGRESSION_CASES)，有不一致時以非 0 結束
+
+使用方式：
+    python benchmarks/seller_normalizer_benchmark.py --lookups 200000
+
+    # 加入 merchant_classifier_report.py --export 匯出的 Notion 記錄
+    python benchmarks/seller_normalizer_benchmark.py --history history.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seller_normalizer import (  # noqa: E402
+    BUILTIN_ALIASES,
+    SellerNormalizer,
+    alias_covers,
+    clean_seller_name,
+    seller_key,
+    strip_legal_suffix,
+)
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'classification_fixtures.json')
+
+# 平台上實際出現過的寫法 -> (店家 ID, 顯示名稱)
+REGRESSION_CASES = {
+    '7-ELEVEN 台北站前門市': ('7-eleven', '7-ELEVEN'),
+    '7-11 南京店': ('7-eleven', '7-ELEVEN'),
+    'Hi-Life 民生店': ('hi-life', '萊爾富'),
+    'Seven-Eleven 信義店': ('7-eleven', '7-ELEVEN'),
+    '統一超商股份有限公司台北市第一分公司': ('7-eleven', '7-ELEVEN'),
+    '萊爾富國際股份有限公司': ('hi-life', '萊爾富'),
+    '路易莎職人咖啡股份有限公司': ('louisa', '路易莎'),
+    '星巴克咖啡股份有限公司': ('starbucks', '星巴克'),
+    '麥當勞-台北南京店': ('mcdonalds', '麥當勞'),
+    '全家便利商店股份有限公司': ('familymart', '全家便利商店'),
+    'Netflix International B.V.': ('netflix', 'Netflix'),
+    '大樹藥局': ('大樹藥局', '大樹藥局'),
+}
+
+
+def legacy_normalize(seller_name: str) -> str:
+    """加入正規化子系統前的做法：全形轉半形、去除空白與結尾的公司型態"""
+    name = re.sub(r'\s+', '', unicodedata.normalize('NFKC', seller_name).strip().lower())
+    return re.sub(r'(股份有限公司|有限公司|公司)$', '', name)
+
+
+def load_seller_names(fixtures_path: str, history_path: str = None) -> list:
+    """讀取真實的店家名稱（保留重複，出現次數即為抽樣權重）"""
+    with open(fixtures_path, 'r', encoding='utf-8') as f:
+        names = [fixture['seller_name'] for fixture in json.load(f)]
+    if history_path:
+        with open(history_path, 'r', encoding='utf-8') as f:
+            names += [record['店家'] for record in json.load(f) if record.get('店家')]
+    return names
+
+
+def build_corpus(names: list, size: int, seed: int) -> list:
+    """依真實名稱的出現頻率抽樣出查詢語料"""
+    return random.Random(seed).choices(names, k=size)
+
+
+def check_regressions(normalizer: SellerNormalizer) -> int:
+    """比對 REGRESSION_CASES，回傳不一致的數量"""
+    failures = 0
+    for seller_name, expected in REGRESSION_CASES.items():
+        match = normalizer.match(seller_name)
+        if (match.merchant_id, match.display_name) != expected:
+            failures += 1
+            print(f"  ✗ {seller_name!r}: {(match.merchant_id, match.display_name)} != {expected}")
+    print(f"已知寫法對應: {len(REGRESSION_CASES) - failures}/{len(REGRESSION_CASES)} 正確")
+    return failures
+
+
+class LinearAliasMatcher:
+    """基準做法：依長度由長到短逐一比對別名 (與 trie 相同的完全 / 分店比對規則)"""
+
+    def __init__(self):
+        self._aliases = sorted(
+            ((seller_key(clean_seller_name(alias)), merchant_id)
+             for merchant_id, (display_name, names) in BUILTIN_ALIASES.items()
+             for alias in [display_name, *names]),
+            key=lambda item: -len(item[0])
+        )
+
+    def canonical_id(self, seller_name: str) -> str:
+        key = seller_key(clean_seller_name(seller_name))
+        for candidate in dict.fromkeys((seller_key(strip_legal_suffix(seller_name)), key)):
+            for alias, merchant_id in self._aliases:
+                if candidate.startswith(alias) and alias_covers(candidate, len(alias)):
+                    return merchant_id
+        return key
+
+
+def measure(name: str, lookup, corpus: list) -> float:
+    started = time.perf_counter()
+    for seller_name in corpus:
+        lookup(seller_name)
+    elapsed = time.perf_counter() - started
+    rate = len(corpus) / elapsed if elapsed else 0.0
+    print(f"{name:<24}{rate:>14,.0f}{elapsed * 1e6 / len(corpus):>14.2f}")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="店家名稱正規化查詢速度 / 碎片化基準測試")
+    parser.add_argument('--lookups', type=int, default=100000, help="查詢次數")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES, help="分類標註資料 JSON 檔 (取其 seller_name)")
+    parser.add_argument('--history', help="get_transaction_history 匯出的 JSON 檔 (取其店家欄位)")
+    args = parser.parse_args()
+
+    names = load_seller_names(args.fixtures, args.history)
+    corpus = build_corpus(names, args.lookups, args.seed)
+    cached = SellerNormalizer()
+    uncached = SellerNormalizer(cache_size=0)
+    linear = LinearAliasMatcher()
+
+    failures = check_regressions(uncached)
+    print(f"\n真實名稱 {len(names):,} 筆 ({len(set(names)):,} 種寫法)，抽樣查詢 {len(corpus):,} 次\n")
+    print(f"{'做法':<24}{'查詢/秒':>14}{'μs/次':>14}")
+    measure('trie + LRU 快取', cached.canonical_id, corpus)
+    measure('trie (不快取)', uncached.canonical_id, corpus)
+    measure('逐一比對別名', linear.canonical_id, corpus)
+
+    distinct = sorted(set(names))
+    mismatches = sum(uncached.canonical_id(name) != linear.canonical_id(name) for name in distinct)
+    print(f"\ntrie 與逐一比對結果不一致: {mismatches}/{len(distinct)}")
+
+    known = sum(uncached.match(name).known for name in distinct)
+    print(f"別名表涵蓋: {known}/{len(distinct)} 種寫法")
+
+    print("\n不同鍵的數量 (越少代表快取與分類器越不碎片化):")
+    print(f"  原始名稱        {len(distinct):>6}")
+    print(f"  舊的字尾去除    {len({legacy_normalize(name) for name in distinct}):>6}")
+    print(f"  標準店家 ID     {len({cached.canonical_id(name) for name in distinct}):>6}")
+    print(f"\n{cached.stats()}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+OpenAI 相容的本機 stub 伺服器
+依標註資料回答 /v1/chat/completions 的單張與批次分類請求，可設定延遲與錯誤注入，
+讓分類效能在沒有網路、不產生 API 費用的情況下量測
+
+使用方式：
+    # 獨立啟動 (之後以 OPENAI_BASE_URL=http://127.0.0.1:8765/v1 指向它)
+    python benchmarks/stub_openai_server.py --port 8765 --latency 0.3 --error-rate 0.05
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from category_classifier import normalize_items, normalize_seller, time_bucket  # noqa: E402
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'classification_fixtures.json')
+
+BATCH_LINE_PATTERN = re.compile(r'^(\d+)\. 商店: (.*?) \| 明細: (.*?)(?: \| 交易時間: (\S+))?$', re.MULTILINE)
+SELLER_PATTERN = re.compile(r'^商店: (.*)$', re.MULTILINE)
+DETAILS_PATTERN = re.compile(r'^明細: (.*?)(?=\n交易時間: |\n\n|\Z)', re.MULTILINE | re.DOTALL)
+TIME_PATTERN = re.compile(r'^交易時間: (\S+)', re.MULTILINE)
+TRUNCATED_PATTERN = re.compile(r' 等 \d+ 項$')  # summarize_details 省略項目的標記
+
+FALLBACK_LABEL = {"name": "消費", "category": "其他"}
+
+
+def prompt_details(details: str) -> str:
+    """將提示詞中以 ; 分隔的明細還原成每行一項"""
+    return TRUNCATED_PATTERN.sub('', details.strip()).replace('; ', '\n')
+
+
+def load_fixtures(path: str = DEFAULT_FIXTURES) -> list:
+    """讀取標註資料 [{"seller_name", "details", "transaction_time", "name", "category"}, ...]"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class FixtureOracle:
+    """
+    依標註資料回答分類：同店家中優先選同時段、明細重疊最多的記錄
+
+    不理會提示詞中的分類規則，以同一份標註資料評分時結果必然一致，只能用來檢查回應處理，不能評估提示詞
+    """
+
+    def __init__(self, fixtures: list):
+        self._by_seller: dict = {}
+        for fixture in fixtures:
+            self._by_seller.setdefault(normalize_seller(fixture['seller_name']), []).append((
+                time_bucket(fixture.get('transaction_time')),
+                set(normalize_items(fixture.get('details')).splitlines()),
+                {"name": fixture['name'], "category": fixture['category']}
+            ))
+
+    def answer(self, seller_name: str, details: str, transaction_time: str | None) -> dict:
+        candidates = self._by_seller.get(normalize_seller(seller_name))
+        if not candidates:
+            return dict(FALLBACK_LABEL)
+
+        bucket = time_bucket(transaction_time)
+        items = set(normalize_items(details).splitlines())
+        _, _, label = max(
+            candidates,
+            key=lambda candidate: (candidate[0] == bucket, len(candidate[1] & items))
+        )
+        return dict(label)
+
+
+class StubOpenAIServer:
+    """
+    在背景執行緒執行的 stub 伺服器
+
+    - latency / jitter: 每個請求的延遲秒數與隨機浮動 (± jitter)
+    - error_rate: 回傳 500 的比例
+    - throttle_rate: 回傳 429 的比例
+    - wrong_rate: 故意回答錯誤分類的比例 (模擬模型誤判)
+    """
+
+    def __init__(self, fixtures: list, host: str = '127.0.0.1', port: int = 0, latency: float = 0.2,
+                 jitter: float = 0.05, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 wrong_rate: float = 0.0, seed: int = 0):
+        self.oracle = FixtureOracle(fixtures)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.wrong_rate = wrong_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve_forever(self):
+        """在目前的執行緒執行 (獨立啟動時使用)"""
+        self._server.serve_forever()
+
+    def start(self):
+        """在背景執行緒執行"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _roll(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def _record(self, field: str, amount: int = 1):
+        with self._lock:
+            self.stats[field] += amount
+
+    def complete(self, prompt: str) -> str:
+        """依提示詞格式回答單張 (JSON 物件) 或批次 (JSON 陣列) 分類"""
+        batch_lines = BATCH_LINE_PATTERN.findall(prompt)
+        if batch_lines:
+            items = []
+            for index, seller_name, details, transaction_time in batch_lines:
+                label = self._maybe_wrong(self.oracle.answer(seller_name, prompt_details(details), transaction_time or None))
+                items.append({"index": int(index), **label})
+            return json.dumps(items, ensure_ascii=False)
+
+        seller = SELLER_PATTERN.search(prompt)
+        details = DETAILS_PATTERN.search(prompt)
+        transaction_time = TIME_PATTERN.search(prompt)
+        label = self.oracle.answer(
+            seller.group(1) if seller else '',
+            prompt_details(details.group(1)) if details else '',
+            transaction_time.group(1) if transaction_time else None
+        )
+        return json.dumps(self._maybe_wrong(label), ensure_ascii=False)
+
+    def _maybe_wrong(self, label: dict) -> dict:
+        if self.wrong_rate and self._roll() < self.wrong_rate:
+            return dict(FALLBACK_LABEL) if label != FALLBACK_LABEL else {"name": "日用品", "category": "購物"}
+        return label
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):  # 不輸出每個請求的存取記錄
+                pass
+
+            def _send_json(self, status: int, body: dict):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                stub._record('requests')
+                time.sleep(max(0.0, stub.latency + (stub._roll() * 2 - 1) * stub.jitter))
+
+                roll = stub._roll()
+                if roll < stub.error_rate:
+                    stub._record('errors')
+                    self._send_json(500, {"error": {"message": "injected error", "type": "server_error"}})
+                    return
+                if roll < stub.error_rate + stub.throttle_rate:
+                    stub._record('throttled')
+                    self._send_json(429, {"error": {"message": "injected rate limit", "type": "rate_limit_error"}})
+                    return
+
+                prompt = "\n".join(
+                    message.get('content') for message in request.get('messages', [])
+                    if isinstance(message.get('content'), str)
+                )
+                content = stub.complete(prompt)
+                # 粗估 token 數 (中文約 1 字 1 token)
+                prompt_tokens, completion_tokens = len(prompt), len(content)
+                stub._record('prompt_tokens', prompt_tokens)
+                stub._record('completion_tokens', completion_tokens)
+                self._send_json(200, {
+                    "id": f"chatcmpl-stub-{stub.stats['requests']}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get('model', 'stub'),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop"
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens
+                    }
+                })
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 相容的分類 stub 伺服器")
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES, help="標註資料 JSON 檔")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help="每個請求的延遲秒數")
+    parser.add_argument('--jitter', type=float, default=0.05, help="延遲的隨機浮動秒數")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="回傳 500 的比例")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="回傳 429 的比例")
+    parser.add_argument('--wrong-rate', type=float, default=0.0, help="故意回答錯誤分類的比例")
+    args = parser.parse_args()
+
+    server = StubOpenAIServer(
+        load_fixtures(args.fixtures), host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate, wrong_rate=args.wrong_rate
+    )
+    print(f"stub 伺服器啟動於 {server.base_url} (Ctrl+C 結束)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
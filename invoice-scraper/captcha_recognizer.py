@@ -0,0 +1,307 @@
+"""
+驗證碼辨識
+提供本機樣板比對 (Pillow，CPU 即可) 與 OpenAI Vision 兩種辨識器，本機信心不足時才退回 OpenAI
+"""
+
+import io
+import os
+import re
+import base64
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+from PIL import Image, ImageFilter, ImageOps
+
+from openai_client import get_openai_client, record_usage, track_latency
+
+logger = logging.getLogger(__name__)
+
+CAPTCHA_LENGTH = 5  # 平台驗證碼固定為 5 位數字
+CAPTCHA_OPENAI_TIMEOUT = float(os.getenv('EINVOICE_CAPTCHA_OPENAI_TIMEOUT', '15'))  # OpenAI 辨識逾時秒數
+
+
+class CaptchaRecognizer:
+    """驗證碼辨識器介面"""
+
+    name = 'base'
+
+    def recognize(self, captcha_png: bytes) -> Tuple[str, float]:
+        """
+        辨識驗證碼
+
+        Args:
+            captcha_png: 驗證碼圖片位元組
+
+        Returns:
+            (辨識出的數字字串, 信心分數 0~1)
+        """
+        raise NotImplementedError
+
+
+class OpenAICaptchaRecognizer(CaptchaRecognizer):
+    """使用 OpenAI Vision (gpt-4.1-mini) 辨識"""
+
+    name = 'openai'
+
+    def __init__(self, model: str = "gpt-4.1-mini"):
+        self.model = model
+
+    def recognize(self, captcha_png: bytes) -> Tuple[str, float]:
+        # 轉換為 base64
+        base64_image = base64.b64encode(captcha_png).decode('utf-8')
+
+        try:
+            with track_latency('captcha'):
+                response = get_openai_client().chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": "請辨識這張驗證碼圖片中的5位數字，只回覆數字本身，不要有任何其他文字或說明。"
+                                },
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": f"data:image/png;base64,{base64_image}"
+                                    }
+                                }
+                            ]
+                        }
+                    ],
+                    max_tokens=10,
+                    timeout=CAPTCHA_OPENAI_TIMEOUT
+                )
+            record_usage('captcha', response.usage)
+
+            # 只保留數字
+            result = re.sub(r'[^0-9]', '', response.choices[0].message.content.strip())
+            return result, 1.0 if len(result) == CAPTCHA_LENGTH else 0.0
+
+        except Exception as e:
+            logger.warning(f"OpenAI 驗證碼辨識失敗: {e}")
+            return "", 0.0
+
+
+class TemplateCaptchaRecognizer(CaptchaRecognizer):
+    """
+    本機樣板比對辨識器
+
+    前處理：灰階 → 中值濾波去除干擾線 → 自動對比 → Otsu 二值化
+    切字：以垂直投影找出 5 個字元區塊，各自裁切並縮放成固定大小
+    比對：與每個數字的樣板計算像素一致率，取最高者；整體信心為 5 個字元中最低的分數
+    """
+
+    name = 'local'
+    GLYPH_SIZE = (12, 20)  # 字元正規化後的寬高
+
+    def __init__(self, templates_dir: str):
+        """
+        Args:
+            templates_dir: 樣板資料夾，檔名格式為 <數字>_<任意>.png (由 build_templates 產生)
+        """
+        self.templates_dir = templates_dir
+        self.templates: List[Tuple[str, List[int]]] = []
+        self._load_templates()
+
+    def _load_templates(self):
+        if not os.path.isdir(self.templates_dir):
+            return
+
+        for filename in sorted(os.listdir(self.templates_dir)):
+            if not filename.endswith('.png') or not filename[0].isdigit():
+                continue
+            with Image.open(os.path.join(self.templates_dir, filename)) as image:
+                self.templates.append((filename[0], self._to_vector(image.convert('L'))))
+
+        logger.info(f"載入 {len(self.templates)} 個驗證碼樣板")
+
+    def recognize(self, captcha_png: bytes) -> Tuple[str, float]:
+        if not self.templates:
+            return "", 0.0
+
+        try:
+            glyphs = self.segment(captcha_png)
+        except Exception as e:
+            logger.warning(f"驗證碼切字失敗: {e}")
+            return "", 0.0
+
+        if len(glyphs) != CAPTCHA_LENGTH:
+            return "", 0.0
+
+        digits = []
+        confidence = 1.0
+        for glyph in glyphs:
+            vector = self._to_vector(glyph)
+            digit, score = max(
+                ((label, self._similarity(vector, template)) for label, template in self.templates),
+                key=lambda pair: pair[1]
+            )
+            digits.append(digit)
+            confidence = min(confidence, score)
+
+        return "".join(digits), confidence
+
+    @classmethod
+    def segment(cls, captcha_png: bytes) -> List[Image.Image]:
+        """將驗證碼切成單一字元影像 (白字黑底，已縮放成 GLYPH_SIZE)"""
+        image = Image.open(io.BytesIO(captcha_png)).convert('L')
+        image = image.filter(ImageFilter.MedianFilter(3))
+        image = ImageOps.autocontrast(image)
+
+        # 以 Otsu 門檻二值化，字元轉為白色 (255)
+        threshold = cls._otsu_threshold(image.histogram())
+        binary = image.point(lambda p: 255 if p < threshold else 0)
+
+        width, height = binary.size
+        data = binary.load()
+        column_ink = [sum(1 for y in range(height) if data[x, y]) for x in range(width)]
+
+        # 墨水量過少的欄位 (干擾線) 視為空白，連續有墨水的欄位視為一個區塊
+        min_ink = max(1, max(column_ink, default=0) // 5)
+        runs = []
+        start = None
+        for x, ink in enumerate(column_ink + [0]):
+            ink = ink >= min_ink
+            if ink and start is None:
+                start = x
+            elif not ink and start is not None:
+                runs.append([start, x])
+                start = None
+
+        # 區塊過多時合併間距最小的相鄰區塊，過少時切開最寬的區塊
+        while len(runs) > CAPTCHA_LENGTH:
+            gaps = [runs[i + 1][0] - runs[i][1] for i in range(len(runs) - 1)]
+            i = gaps.index(min(gaps))
+            runs[i] = [runs[i][0], runs[i + 1][1]]
+            del runs[i + 1]
+        while runs and len(runs) < CAPTCHA_LENGTH:
+            i = max(range(len(runs)), key=lambda k: runs[k][1] - runs[k][0])
+            left, right = runs[i]
+            if right - left < 2:
+                break
+            middle = (left + right) // 2
+            runs[i:i + 1] = [[left, middle], [middle, right]]
+
+        glyphs = []
+        for left, right in runs:
+            glyph = binary.crop((left, 0, right, height))
+            bbox = glyph.getbbox()
+            if bbox:
+                glyph = glyph.crop(bbox)
+            glyphs.append(glyph.resize(cls.GLYPH_SIZE))
+        return glyphs
+
+    @staticmethod
+    def _otsu_threshold(histogram: List[int]) -> int:
+        """以 Otsu 法計算灰階二值化門檻"""
+        total = sum(histogram)
+        weighted_total = sum(i * count for i, count in enumerate(histogram))
+        background_weight = 0
+        background_sum = 0
+        best_threshold, best_variance = 0, -1.0
+        for i, count in enumerate(histogram):
+            background_weight += count
+            if background_weight == 0:
+                continue
+            foreground_weight = total - background_weight
+            if foreground_weight == 0:
+                break
+            background_sum += i * count
+            mean_background = background_sum / background_weight
+            mean_foreground = (weighted_total - background_sum) / foreground_weight
+            variance = background_weight * foreground_weight * (mean_background - mean_foreground) ** 2
+            if variance > best_variance:
+                best_threshold, best_variance = i + 1, variance
+        return best_threshold
+
+    @classmethod
+    def _to_vector(cls, glyph: Image.Image) -> List[int]:
+        if glyph.size != cls.GLYPH_SIZE:
+            glyph = glyph.resize(cls.GLYPH_SIZE)
+        return [1 if p > 127 else 0 for p in glyph.getdata()]
+
+    @staticmethod
+    def _similarity(a: List[int], b: List[int]) -> float:
+        return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+    @classmethod
+    def build_templates(cls, labelled_dir: str, templates_dir: str, filenames: Optional[Iterable[str]] = None) -> int:
+        """
+        從已標註的驗證碼建立樣板
+
+        Args:
+            labelled_dir: 驗證碼資料夾，檔名前 5 碼為正確答案 (例如 12345.png、12345_a.png)
+            templates_dir: 樣板輸出資料夾
+            filenames: 只使用這些檔案 (例如切分出的訓練集)，預設為資料夾中全部
+
+        Returns:
+            產生的樣板數量
+        """
+        os.makedirs(templates_dir, exist_ok=True)
+        selected = set(filenames) if filenames is not None else None
+        count = 0
+        for filename, label in iter_labelled_captchas(labelled_dir):
+            if selected is not None and filename not in selected:
+                continue
+            with open(os.path.join(labelled_dir, filename), 'rb') as f:
+                glyphs = cls.segment(f.read())
+            if len(glyphs) != CAPTCHA_LENGTH:
+                continue
+            stem = os.path.splitext(filename)[0]
+            for index, (digit, glyph) in enumerate(zip(label, glyphs)):
+                glyph.save(os.path.join(templates_dir, f"{digit}_{stem}_{index}.png"))
+                count += 1
+        return count
+
+
+class FallbackCaptchaRecognizer(CaptchaRecognizer):
+    """先用主要辨識器，信心低於門檻時改用備援辨識器"""
+
+    name = 'auto'
+
+    def __init__(self, primary: CaptchaRecognizer, fallback: CaptchaRecognizer, min_confidence: float):
+        self.primary = primary
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+
+    def recognize(self, captcha_png: bytes) -> Tuple[str, float]:
+        text, confidence = self.primary.recognize(captcha_png)
+        if len(text) == CAPTCHA_LENGTH and confidence >= self.min_confidence:
+            return text, confidence
+
+        logger.info(f"{self.primary.name} 辨識信心不足 ({confidence:.2f})，改用 {self.fallback.name}")
+        return self.fallback.recognize(captcha_png)
+
+
+def iter_labelled_captchas(labelled_dir: str):
+    """列出已標註的驗證碼檔案，產生 (檔名, 5 位數答案)"""
+    for filename in sorted(os.listdir(labelled_dir)):
+        match = re.match(r'^(\d{5})(?:[_\-.].*)?\.png$', filename)
+        if match:
+            yield filename, match.group(1)
+
+
+def create_captcha_recognizer(mode: Optional[str] = None) -> CaptchaRecognizer:
+    """
+    依環境變數建立驗證碼辨識器
+
+    - EINVOICE_CAPTCHA_RECOGNIZER: 'auto' (預設，本機優先、信心不足退回 OpenAI)、'local' 或 'openai'
+    - EINVOICE_CAPTCHA_TEMPLATES_DIR: 樣板資料夾 (預設 captcha_templates)
+    - EINVOICE_CAPTCHA_MIN_CONFIDENCE: 本機辨識採用的最低信心 (預設 0.85)
+    """
+    mode = (mode or os.getenv('EINVOICE_CAPTCHA_RECOGNIZER', 'auto')).lower()
+    if mode == 'openai':
+        return OpenAICaptchaRecognizer()
+
+    local = TemplateCaptchaRecognizer(os.getenv('EINVOICE_CAPTCHA_TEMPLATES_DIR', 'captcha_templates'))
+    if mode == 'local':
+        return local
+
+    return FallbackCaptchaRecognizer(
+        primary=local,
+        fallback=OpenAICaptchaRecognizer(),
+        min_confidence=float(os.getenv('EINVOICE_CAPTCHA_MIN_CONFIDENCE', '0.85'))
+    )
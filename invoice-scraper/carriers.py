@@ -0,0 +1,75 @@
+"""
+手機條碼載具設定
+支援多個載具（多組財政部平台帳號）同時同步到同一個 Notion 資料庫
+"""
+
+import os
+import json
+from dataclasses import dataclass
+from typing import List, Optional
+
+DEFAULT_CARRIER = 'default'  # 僅以 EINVOICE_PHONE / EINVOICE_PASSWORD 設定時的載具名稱
+
+
+@dataclass
+class CarrierConfig:
+    """單一載具的登入資訊與對應的 Notion 帳戶"""
+    name: str                       # 載具名稱，同時作為 session / 同步狀態的命名空間
+    phone: str                      # 手機號碼
+    password: str                   # 驗證碼 (平台密碼)
+    account: Optional[str] = None   # Notion 帳戶名稱，未設定時依載具名稱查詢載具帳戶
+
+
+def load_carriers() -> List[CarrierConfig]:
+    """
+    從環境變數讀取載具設定
+
+    - EINVOICE_CARRIERS: JSON 陣列，例如
+      [{"name": "小明", "phone": "0912...", "password": "...", "account": "小明信用卡"}]
+    - 未設定時使用 EINVOICE_PHONE / EINVOICE_PASSWORD 作為單一載具
+
+    Raises:
+        ValueError: EINVOICE_CARRIERS 格式錯誤、缺少欄位、名稱重複或使用保留名稱 default
+    """
+    raw = os.getenv('EINVOICE_CARRIERS', '').strip()
+    if not raw:
+        phone = os.getenv('EINVOICE_PHONE')
+        password = os.getenv('EINVOICE_PASSWORD')
+        if not phone or not password:
+            return []
+        return [CarrierConfig(name=DEFAULT_CARRIER, phone=phone, password=password)]
+
+    try:
+        entries = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"EINVOICE_CARRIERS 不是有效的 JSON: {e}")
+    if not isinstance(entries, list):
+        raise ValueError("EINVOICE_CARRIERS 必須是 JSON 陣列")
+
+    carriers = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('phone') or not entry.get('password'):
+            raise ValueError(f"EINVOICE_CARRIERS 第 {index + 1} 筆缺少 phone 或 password")
+        name = str(entry.get('name') or entry['phone'])
+        if name == DEFAULT_CARRIER:
+            # 保留給單一載具設定，使用同一個名稱會共用其 session 與同步狀態
+            raise ValueError(f"EINVOICE_CARRIERS 第 {index + 1} 筆不可使用保留名稱: {DEFAULT_CARRIER}")
+        # 名稱不同但轉成檔名後相同 (例如「a b」與「a_b」) 也會共用 session 與同步狀態
+        if any(namespaced_path('', carrier.name) == namespaced_path('', name) for carrier in carriers):
+            raise ValueError(f"EINVOICE_CARRIERS 載具名稱重複: {name}")
+        carriers.append(CarrierConfig(
+            name=name,
+            phone=str(entry['phone']),
+            password=str(entry['password']),
+            account=entry.get('account')
+        ))
+    return carriers
+
+
+def namespaced_path(path: str, carrier: str) -> str:
+    """依載具名稱區分檔案路徑（預設載具沿用原路徑），例如 .sync_state.json -> .sync_state.小明.json"""
+    if carrier == DEFAULT_CARRIER:
+        return path
+    safe_name = ''.join(ch if ch.isalnum() or ch in '-_' else '_' for ch in carrier)
+    root, ext = os.path.splitext(path)
+    return f"{root}.{safe_name}{ext}"
@@ -1,13 +1,28 @@
 """
 OpenAI 發票分類服務
 根據商店名稱和明細自動判斷名稱和分類
+熟悉的店家由本機店家分類器直接回答，重複的消費使用本機快取，其餘才呼叫 OpenAI
 """
 
-from openai import OpenAI
+import os
+import re
+import json
+import asyncio
+import logging
+import weakref
+import unicodedata
+
 from dotenv import load_dotenv
 
+from disk_cache import DiskLRUCache, content_key
+from merchant_classifier import MerchantClassifier
+from openai_client import get_async_openai_client, get_openai_client, record_usage, track_latency
+from seller_normalizer import create_seller_normalizer
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # 分類及其名稱建議
 CATEGORY_SUGGESTIONS = {
     "餐飲": ["早餐", "午餐", "晚餐", "零食", "宵夜", "飲料", "咖啡", "外送"],
@@ -24,101 +39,612 @@ CATEGORY_SUGGESTIONS = {
 # 可用分類 (支出類)
 CATEGORIES = list(CATEGORY_SUGGESTIONS.keys())
 
+# 分類提示（所有請求共用，只建立一次）
+CATEGORY_HINTS = "\n".join([
+    f"- {cat}: {', '.join(names)}"
+    for cat, names in CATEGORY_SUGGESTIONS.items()
+]) # 讓每個分類群裡面的類別都先顯示 - "分類1":"分類名稱1", "分類名稱2", ...}，然後再換行換下一個分類
+   # 用來做prompt的提示詞，讓AI知道我有這些分類，要將其從陣列轉成一般字串會比較好懂
+
+CLASSIFICATION_RULES = """規則:
+- 名稱優先選建議名稱，否則自訂 2-4 字；分類必須是上列之一
+- 便利商店買食物/飲料→餐飲，買日用品→購物
+- 餐飲名稱依序判斷: 只有飲料→飲料；只有零食(軟糖、巧克力、餅乾等)→零食；有食物依交易時間 05:00-10:59 早餐、11:00-13:59 午餐、18:00-21:59 晚餐、22:00-04:59 宵夜"""
+
+# 精簡提示詞（規則與分類放在 system 訊息，只在載入時建立一次；每次請求只送發票本身）
+SYSTEM_PROMPT = f"""依發票的商店、明細與交易時間判斷消費的「名稱」與「分類」。
+分類: 建議名稱
+{CATEGORY_HINTS}
+{CLASSIFICATION_RULES}
+只回覆 JSON: {{"name": "名稱", "category": "分類"}}"""
+
+BATCH_SYSTEM_PROMPT = f"""依每張發票的商店、明細與交易時間判斷消費的「名稱」與「分類」。
+分類: 建議名稱
+{CATEGORY_HINTS}
+{CLASSIFICATION_RULES}
+只回覆 JSON 陣列，每張發票一個物件，index 為發票編號: [{{"index": 0, "name": "名稱", "category": "分類"}}]"""
+
+CLASSIFY_BATCH_SIZE = int(os.getenv('EINVOICE_CLASSIFY_BATCH_SIZE', '10'))  # 批次分類時每次請求的發票數
+CLASSIFY_TIMEOUT = float(os.getenv('EINVOICE_CLASSIFY_TIMEOUT', '20'))        # 單次分類請求逾時秒數
+CLASSIFY_CONCURRENCY = int(os.getenv('EINVOICE_CLASSIFY_CONCURRENCY', '4'))  # 同時進行的分類請求上限
+CLASSIFY_MAX_ITEMS = int(os.getenv('EINVOICE_CLASSIFY_MAX_ITEMS', '8'))      # 提示詞中最多列出的明細項目 (依金額取前幾項)
+CLASSIFY_ITEM_MAX_CHARS = 30                                                  # 單一品名最多字數
+CLASSIFY_MODEL = "gpt-4.1-mini"
+
+# 提示詞版本：模型、提示詞或明細摘要設定改變時快取鍵跟著改變，舊提示詞的結果不再被沿用
+PROMPT_VERSION = content_key(CLASSIFY_MODEL, SYSTEM_PROMPT, BATCH_SYSTEM_PROMPT, CLASSIFY_MAX_ITEMS, CLASSIFY_ITEM_MAX_CHARS)[:12]
+
+# 分類快取（以正規化店家 + 正規化明細 + 時段為鍵，EINVOICE_CLASSIFY_CACHE=0 可停用）
+classification_cache = DiskLRUCache(
+    os.getenv('EINVOICE_CLASSIFY_CACHE_PATH', '.invoice_cache.sqlite3'),
+    max_entries=int(os.getenv('EINVOICE_CLASSIFY_CACHE_MAX_ENTRIES', '2000')),
+    namespace='classification'
+) if os.getenv('EINVOICE_CLASSIFY_CACHE', '1') == '1' else None
+
+# 本機店家分類器（由 Notion 歷史交易建立，EINVOICE_MERCHANT_CLASSIFIER=0 可停用）
+merchant_classifier = MerchantClassifier(
+    os.getenv('EINVOICE_MERCHANT_MODEL_PATH', '.merchant_model.json')
+) if os.getenv('EINVOICE_MERCHANT_CLASSIFIER', '1') == '1' else None
+MERCHANT_MIN_CONFIDENCE = float(os.getenv('EINVOICE_MERCHANT_MIN_CONFIDENCE', '0.8'))  # 低於此信心交給 OpenAI
+
+# 店家名稱正規化（別名表 + 公司型態字尾與分店去除），分類快取、本機分類器與 Notion 店家欄位共用
+seller_normalizer = create_seller_normalizer()
+
+# 明細行尾的數量與金額，例如 " x2 $76"
+ITEM_SUFFIX_PATTERN = re.compile(r'\s*x\s*[\d.]+\s*\$\s*-?[\d.,]*\s*$')
+ITEM_AMOUNT_PATTERN = re.compile(r'\$\s*(-?[\d.,]+)\s*$')
+
+
+def normalize_seller(seller_name: str) -> str:
+    """正規化店家名稱為標準店家 ID，同一店家的不同分店 / 寫法得到相同結果"""
+    return seller_normalizer.canonical_id(seller_name)
+
+
+def normalize_items(details: str) -> str:
+    """正規化明細：只保留品名（去除數量、金額與折扣行），排序後合併，讓價格或順序不同的同一消費得到相同結果"""
+    items = set()
+    for line in (details or '').splitlines():
+        line = unicodedata.normalize('NFKC', line).strip()
+        if not line or re.search(r'\$\s*-', line):  # 折扣行 (負金額) 不影響分類
+            continue
+        item = ITEM_SUFFIX_PATTERN.sub('', line).strip().lower()
+        if item:
+            items.add(item)
+    return '\n'.join(sorted(items))
+
+
+def summarize_details(details: str, max_items: int | None = None) -> str:
+    """
+    提示詞用的明細摘要：去除數量、金額與折扣行，只保留金額最高的 max_items 項 (維持原本順序)
+
+    例如大賣場的長明細只送出主要品項，其餘以「等 N 項」帶過
+    """
+    max_items = max_items or CLASSIFY_MAX_ITEMS
+    items = []  # (金額, 順序, 品名)
+    seen = set()
+    for order, line in enumerate((details or '').splitlines()):
+        line = unicodedata.normalize('NFKC', line).strip()
+        if not line or re.search(r'\$\s*-', line):  # 折扣行不影響分類
+            continue
+        name = ITEM_SUFFIX_PATTERN.sub('', line).strip()[:CLASSIFY_ITEM_MAX_CHARS]
+        if not name or name in seen:
+            continue
+        seen.add(name)
+        amount = ITEM_AMOUNT_PATTERN.search(line)
+        try:
+            value = float(amount.group(1).replace(',', '')) if amount else 0.0
+        except ValueError:
+            value = 0.0
+        items.append((value, order, name))
+
+    kept = sorted(sorted(items, key=lambda item: -item[0])[:max_items], key=lambda item: item[1])
+    summary = '; '.join(name for _, _, name in kept)
+    if len(items) > len(kept):
+        summary += f" 等 {len(items)} 項"
+    return summary
+
+
+def time_bucket(transaction_time: str | None) -> str:
+    """依提示詞中的餐飲時段規則將交易時間分桶"""
+    if not transaction_time:
+        return ''
+    try:
+        hour = int(transaction_time.split(':')[0])
+    except ValueError:
+        return ''
+
+    if 5 <= hour <= 10:
+        return 'breakfast'
+    if 11 <= hour <= 13:
+        return 'lunch'
+    if 14 <= hour <= 17:
+        return 'afternoon'
+    if 18 <= hour <= 21:
+        return 'dinner'
+    return 'late_night'
+
+
+def classification_cache_key(seller_name: str, details: str, transaction_time: str | None = None) -> str:
+    """分類快取鍵 (包含提示詞版本)"""
+    return content_key(
+        PROMPT_VERSION, normalize_seller(seller_name), normalize_items(details), time_bucket(transaction_time)
+    )
+
+
+def classification_cache_stats() -> dict | None:
+    """分類快取命中統計 (未啟用時為 None)"""
+    return classification_cache.stats() if classification_cache is not None else None
+
+
+def merchant_classifier_stats() -> dict | None:
+    """本機店家分類器的大小與命中統計 (未啟用時為 None)"""
+    return merchant_classifier.stats() if merchant_classifier is not None else None
+
+
+def history_time(date_str: str) -> str | None:
+    """從 Notion 日期 (例如 2026-01-07T12:19:00.000+08:00) 取出 HH:MM"""
+    if date_str and 'T' in date_str:
+        return date_str.split('T')[1][:5]
+    return None
+
+
+def rebuild_merchant_classifier(history: list[dict]) -> int:
+    """
+    以 Notion 歷史交易重建本機店家分類器並存檔
+
+    Args:
+        history: NotionService.get_transaction_history 的結果
+
+    Returns:
+        索引中的店家數
+    """
+    if merchant_classifier is None:
+        return 0
+
+    count = merchant_classifier.build(
+        (normalize_seller(record["店家"]), time_bucket(history_time(record["日期"])), record["名稱"], record["分類"])
+        for record in history
+        if record.get("店家") and record.get("分類") in CATEGORIES
+    )
+    merchant_classifier.save()
+    return count
+
+
+def _predict_merchant(seller_name: str, transaction_time: str | None) -> tuple:
+    """本機店家分類器的猜測，回傳 (結果或 None, 是否達到採用門檻)"""
+    if merchant_classifier is None:
+        return None, False
+
+    result, confidence = merchant_classifier.predict(normalize_seller(seller_name), time_bucket(transaction_time))
+    return result, result is not None and confidence >= MERCHANT_MIN_CONFIDENCE
+
+
+def predict_locally(seller_name: str, transaction_time: str | None = None, record: bool = True) -> dict | None:
+    """
+    本機店家分類器有足夠信心時回傳分類，否則回傳 None
+
+    Args:
+        record: 是否計入本機分類器的命中統計 (同一張發票重複查詢時傳 False)
+    """
+    result, hit = _predict_merchant(seller_name, transaction_time)
+    if record and merchant_classifier is not None:
+        merchant_classifier.record(hit)
+    return result if hit else None
+
+
+def _lookup(seller_name: str, details: str, transaction_time: str | None, record: bool = True) -> tuple:
+    """依序查快取 (含明細) 與本機店家分類器，回傳 (結果或 None, 快取鍵)"""
+    cached, cache_key = _lookup_cache(seller_name, details, transaction_time)
+    if cached is not None:
+        return cached, cache_key
+    local = predict_locally(seller_name, transaction_time, record)
+    if local is not None:
+        return local, None
+    return None, cache_key
+
+
+def _lookup_cache(seller_name: str, details: str, transaction_time: str | None) -> tuple:
+    """查分類快取，回傳 (結果或 None, 快取鍵)"""
+    cache_key = None
+    if classification_cache is not None:
+        cache_key = classification_cache_key(seller_name, details, transaction_time)
+        cached = classification_cache.get(cache_key)
+        if cached is not None:
+            return cached, cache_key
+    return None, cache_key
+
 
 def classify_invoice(seller_name: str, details: str, transaction_time: str | None = None) -> dict:
     """
-    使用 OpenAI 分類發票
-    
+    分類發票：先查快取，其次由本機店家分類器回答有把握的店家，最後才使用 OpenAI
+
     Args:
         seller_name: 商店名稱
         details: 消費明細
         transaction_time: 交易時間 (HH:MM 格式，例如 "12:30")
-    
+
     Returns:
         {
             "name": "飲料",
             "category": "餐飲"
         }
     """
-    client = OpenAI()
-    
-    # 建立分類提示
-    category_hints = "\n".join([   
-        f"- {cat}: {', '.join(names)}"
-        for cat, names in CATEGORY_SUGGESTIONS.items()
-    ]) # 讓每個分類群裡面的類別都先顯示 - "分類1":"分類名稱1", "分類名稱2", ...}，然後再換行換下一個分類
-       # 用來做prompt的提示詞，讓AI知道我有這些分類，要將其從陣列轉成一般字串會比較好懂
-    
+    result, cache_key = _lookup(seller_name, details, transaction_time)
+    if result is not None:
+        return result
+
+    return _classify_uncached(seller_name, details, transaction_time, cache_key)
+
+
+async def classify_invoice_async(seller_name: str, details: str, transaction_time: str | None = None) -> dict:
+    """classify_invoice 的非同步版本（使用共用的 AsyncOpenAI 用戶端，快取讀寫在背景執行緒進行）"""
+    result, cache_key = await asyncio.to_thread(_lookup, seller_name, details, transaction_time)
+    if result is not None:
+        return result
+
+    return await _classify_uncached_async(seller_name, details, transaction_time, cache_key)
+
+
+def classify_provisionally(invoices: list[dict]) -> list[tuple]:
+    """
+    不呼叫 OpenAI 的暫定分類，讓交易可以先寫入 Notion
+
+    快取命中或本機店家分類器有把握時為確定結果；否則採用本機分類器信心不足的猜測
+    (沒有時為預設分類)，並標記為暫定，之後再由 OpenAI 修正
+
+    Args:
+        invoices: [{"seller_name": ..., "details": ..., "transaction_time": ...}, ...]
+
+    Returns:
+        與輸入順序相同的 [({"name": ..., "category": ...}, 是否為暫定), ...]
+    """
+    results = []
+    for invoice in invoices:
+        cached, _ = _lookup_cache(invoice["seller_name"], invoice.get("details") or "", invoice.get("transaction_time"))
+        if cached is not None:
+            results.append((cached, False))
+            continue
+
+        # 只查一次本機分類器：達到門檻時為確定結果，否則作為暫定的猜測
+        guess, hit = _predict_merchant(invoice["seller_name"], invoice.get("transaction_time"))
+        if merchant_classifier is not None:
+            merchant_classifier.record(hit)
+        results.append((guess, False) if hit else (guess or _default_classification(), True))
+    return results
+
+
+def is_default_classification(result: dict) -> bool:
+    """是否為 OpenAI 失敗時的預設分類"""
+    return result == _default_classification()
+
+
+def _default_classification() -> dict:
+    # 預設回傳（不寫入快取，下次仍會重新分類）
+    return {
+        "name": "消費",
+        "category": "其他"
+    }
+
+
+def _classify_uncached(seller_name: str, details: str, transaction_time: str | None, cache_key: str | None) -> dict:
+    """呼叫 OpenAI 分類單張發票並寫入快取，失敗時回傳預設分類"""
+    try:
+        result, valid = _validate_classification(_request_classification_text(seller_name, details, transaction_time))
+    except Exception as e:
+        logger.error(f"OpenAI 分類失敗: {e}")
+        return _default_classification()
+
+    # 只快取合法的回覆；分類不合法或缺少名稱時本次使用修正後的結果，下次重新詢問
+    if cache_key is not None and valid:
+        classification_cache.set(cache_key, result)
+    return result
+
+
+async def _classify_uncached_async(seller_name: str, details: str, transaction_time: str | None, cache_key: str | None) -> dict:
+    """_classify_uncached 的非同步版本"""
+    try:
+        result, valid = _validate_classification(
+            await _request_classification_text_async(seller_name, details, transaction_time)
+        )
+    except Exception as e:
+        logger.error(f"OpenAI 分類失敗: {e}")
+        return _default_classification()
+
+    if cache_key is not None and valid:
+        await asyncio.to_thread(classification_cache.set, cache_key, result)
+    return result
+
+
+def _classification_request(seller_name: str, details: str, transaction_time: str | None = None) -> dict:
+    """單張發票分類請求的參數"""
     # 時間相關提示
     time_context = ""
     if transaction_time:
         time_context = f"\n交易時間: {transaction_time}"
 
-    prompt = f"""根據以下發票資訊，判斷消費的「名稱」和「分類」。
+    prompt = f"商店: {seller_name}\n明細: {summarize_details(details)}{time_context}"
+
+    return dict( # 等於是建立AI新對話
+        model=CLASSIFY_MODEL, # 要使用gpt-4.1-mini模型，也可換其他模型
 
-商店: {seller_name}
-明細: {details}{time_context}
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT}, # 分類規則，所有請求共用 (固定的開頭也較容易命中 OpenAI 的提示詞快取)
+            {"role": "user", "content": prompt} # 這次要分類的發票
+        ],
+        max_tokens=50, # 回覆固定是一個小 JSON 物件，約 20 tokens
+        temperature=0.3, # 控制模型輸出的隨機性，所以可能會一樣的prompt有不同結果，設定0的話是越不會改變
+        timeout=CLASSIFY_TIMEOUT # 單次請求逾時，避免一張發票卡住整批同步
+    )
 
-分類及建議名稱:
-{category_hints}
 
-請回覆 JSON 格式:
-{{"name": "簡短名稱", "category": "分類"}}
+def _validate_classification(result_text: str) -> tuple:
+    """
+    解析並驗證單張發票的回覆
 
-規則:
-- 名稱從建議名稱中選擇最合適的，或自行判斷簡短精確的名稱 (2-4字)
-- 分類必須是上述分類之一
-- 便利商店購買食物/飲料歸類為「餐飲」，名稱可為「飲料」或「早餐」等
-- 便利商店購買日用品歸類為「購物」
+    Returns:
+        (結果, 是否合法)；分類不在 CATEGORIES 中時改為其他、缺少名稱時改為消費，並標記為不合法
+    """
+    result = _parse_json_response(result_text)
+    name = result.get("name")
+    category = result.get("category")
+    valid = category in CATEGORIES and isinstance(name, str) and bool(name.strip())
 
-餐飲名稱判斷規則 (依優先順序):
-1. 若明細「只有飲料」(無任何食物)，名稱必須是「飲料」，不管什麼時間
-2. 若判斷食物名稱都是零食(不是飲料也不是正餐)，則名稱為「零食」，例如，軟糖、巧克力、餅乾等等
-2. 若有食物，根據交易時間判斷:
-   - 05:00-10:59 → 早餐
-   - 11:00-13:59 → 午餐
-   - 18:00-21:59 → 晚餐
-   - 22:00-04:59 → 宵夜
+    if category not in CATEGORIES: # 如果分類不在CATEGORIES中，就回傳其他
+        category = "其他"
+    if not isinstance(name, str) or not name.strip():
+        name = "消費"
 
-只回覆 JSON，不要有其他文字。"""
+    return {"name": name.strip(), "category": category}, valid
 
-    try:
-        response = client.chat.completions.create( # 等於是建立AI新對話
-            model="gpt-4.1-mini", # 要使用gpt-4.1-mini模型，也可換其他模型
-            
-            messages=[
-                {"role": "user", "content": prompt} # 要傳給AI的訊息，可以先設定角色，像是assistant或是system，類似這個對話的規則或是範例，但我這些都寫在prompt，所以已經夠清楚就直接使用user就好，content就是輸入內容，也就是上面的prompt
-            ],
-            max_tokens=100, # 限制回復的最大token數為100，但基本不會超過，因為我規則有固定回傳格式
-            temperature=0.3 # 控制模型輸出的隨機性，所以可能會一樣的prompt有不同結果，設定0的話是越不會改變
+
+def _request_classification_text(seller_name: str, details: str, transaction_time: str | None = None) -> str:
+    """呼叫 OpenAI 分類並回傳原始回覆，失敗時拋出例外"""
+    with track_latency('classify'):
+        response = get_openai_client().chat.completions.create(
+            **_classification_request(seller_name, details, transaction_time)
         )
-        
-        result_text = response.choices[0].message.content.strip() # 取得結果後將其前後的空白去除
-        
-        # 移除可能的 markdown 標記
-        if result_text.startswith("```"): # 因為markdown可能會有這個符號，需要先去除掉
-            result_text = result_text.split("```")[1] # 去除掉後取後面的字串
-            if result_text.startswith("json"): # 如果又有json開頭，就再去除掉
-                result_text = result_text[4:] # 那因為去除Json開頭，所以要從前面數4個字開始取
-        
-        import json
-        result = json.loads(result_text) # 將字串轉成json格式
-        
-        # 驗證分類
-        if result.get("category") not in CATEGORIES: # 如果分類不在CATEGORIES中，就回傳其他
-            result["category"] = "其他"
-        
-        return result
-        
-    except Exception as e:
-        print(f"OpenAI 分類失敗: {e}")
-        # 預設回傳
+    record_usage('classify', response.usage)
+    return response.choices[0].message.content
+
+
+async def _request_classification_text_async(seller_name: str, details: str, transaction_time: str | None = None) -> str:
+    """_request_classification_text 的非同步版本"""
+    with track_latency('classify'):
+        response = await get_async_openai_client().chat.completions.create(
+            **_classification_request(seller_name, details, transaction_time)
+        )
+    record_usage('classify', response.usage)
+    return response.choices[0].message.content
+
+
+def _parse_json_response(result_text: str):
+    """解析模型回覆的 JSON（移除可能的 markdown 標記）"""
+    result_text = result_text.strip() # 取得結果後將其前後的空白去除
+
+    # 移除可能的 markdown 標記
+    if result_text.startswith("```"): # 因為markdown可能會有這個符號，需要先去除掉
+        result_text = result_text.split("```")[1] # 去除掉後取後面的字串
+        if result_text.startswith("json"): # 如果又有json開頭，就再去除掉
+            result_text = result_text[4:] # 那因為去除Json開頭，所以要從前面數4個字開始取
+
+    return json.loads(result_text) # 將字串轉成json格式
+
+
+def _lookup_all(invoices: list[dict], record: bool = True) -> tuple:
+    """批次查快取與本機分類器，回傳 (結果列表, 未命中的 [(index, cache_key)])"""
+    results: list[dict | None] = [None] * len(invoices)
+    misses = []  # (index, cache_key)
+
+    for index, invoice in enumerate(invoices):
+        result, cache_key = _lookup(
+            invoice["seller_name"], invoice.get("details") or "", invoice.get("transaction_time"), record
+        )
+        if result is not None:
+            results[index] = result
+        else:
+            misses.append((index, cache_key))
+    return results, misses
+
+
+def classify_invoices(invoices: list[dict], batch_size: int | None = None) -> list[dict]:
+    """
+    批次分類多張發票：本機分類器與快取都無法回答的發票每 batch_size 張合併成一次 OpenAI 請求
+
+    回覆中缺少或分類不合法的項目會改為逐張重新分類
+
+    Args:
+        invoices: [{"seller_name": ..., "details": ..., "transaction_time": ...}, ...]
+        batch_size: 每次請求的發票數 (預設 EINVOICE_CLASSIFY_BATCH_SIZE)
+
+    Returns:
+        與輸入順序相同的 [{"name": ..., "category": ...}, ...]
+    """
+    batch_size = batch_size or CLASSIFY_BATCH_SIZE
+    results, misses = _lookup_all(invoices)
+
+    for start in range(0, len(misses), batch_size):
+        chunk = misses[start:start + batch_size]
+        try:
+            batch_results = _request_batch_classification([invoices[index] for index, _ in chunk])
+        except Exception as e:
+            logger.warning(f"OpenAI 批次分類失敗，改為逐張分類: {e}")
+            batch_results = [None] * len(chunk)
+
+        for (index, cache_key), result in zip(chunk, batch_results):
+            if result is None:
+                invoice = invoices[index]
+                results[index] = _classify_uncached(
+                    invoice["seller_name"], invoice.get("details") or "", invoice.get("transaction_time"), cache_key
+                )
+                continue
+
+            results[index] = result
+            if cache_key is not None:
+                classification_cache.set(cache_key, result)
+
+    return results
+
+
+def _batch_classification_request(invoices: list[dict]) -> dict:
+    """多張發票分類請求的參數"""
+    invoice_lines = []
+    for index, invoice in enumerate(invoices):
+        details = summarize_details(invoice.get("details") or "")
+        time_context = f" | 交易時間: {invoice['transaction_time']}" if invoice.get("transaction_time") else ""
+        invoice_lines.append(f"{index}. 商店: {invoice['seller_name']} | 明細: {details}{time_context}")
+
+    return dict(
+        model=CLASSIFY_MODEL,
+        messages=[
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": "\n".join(invoice_lines)}
+        ],
+        max_tokens=30 * len(invoices) + 20,  # 每張發票的物件約 20~30 tokens
+        temperature=0.3,
+        timeout=CLASSIFY_TIMEOUT * 2  # 回覆較長，給批次請求較寬的逾時
+    )
+
+
+def _parse_batch_classification(result_text: str, count: int) -> list[dict | None]:
+    """解析批次回覆，缺少或不合法的項目為 None"""
+    items = _parse_json_response(result_text)
+    if not isinstance(items, list):
+        raise ValueError("回覆不是 JSON 陣列")
+
+    results: list[dict | None] = [None] * count
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index")
+        name = item.get("name")
+        # 分類不合法或名稱缺漏的項目保留為 None，交由逐張分類重試；bool 是 int 的子類別，需另外排除
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < count:
+            continue
+        if item.get("category") not in CATEGORIES or not isinstance(name, str) or not name.strip():
+            continue
+        results[index] = {"name": name.strip(), "category": item["category"]}
+    return results
+
+
+def _request_batch_classification(invoices: list[dict]) -> list[dict | None]:
+    """
+    一次請求分類多張發票，失敗時拋出例外
+
+    Returns:
+        與輸入順序相同的結果，回覆中缺少或不合法的項目為 None
+    """
+    with track_latency('classify_batch'):
+        response = get_openai_client().chat.completions.create(**_batch_classification_request(invoices))
+    record_usage('classify_batch', response.usage)
+    return _parse_batch_classification(response.choices[0].message.content, len(invoices))
+
+
+async def _request_batch_classification_async(invoices: list[dict]) -> list[dict | None]:
+    """_request_batch_classification 的非同步版本"""
+    with track_latency('classify_batch'):
+        response = await get_async_openai_client().chat.completions.create(**_batch_classification_request(invoices))
+    record_usage('classify_batch', response.usage)
+    return _parse_batch_classification(response.choices[0].message.content, len(invoices))
+
+
+def _store_cache_entries(entries: list[tuple]):
+    """寫入多筆 (快取鍵, 分類結果)"""
+    for cache_key, result in entries:
+        classification_cache.set(cache_key, result)
+
+
+class ClassificationPool:
+    """
+    非同步分類池：以 semaphore 限制同時進行的 OpenAI 請求數
+
+    同步 / 回填流程把待分類的批次丟進來即可，多個批次會並行分類，
+    但同時在途的請求不超過 concurrency，避免觸發 OpenAI 的速率限制
+    """
+
+    def __init__(self, concurrency: int = 4, batch_size: int | None = None):
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size or CLASSIFY_BATCH_SIZE
+        self._semaphores = weakref.WeakKeyDictionary()  # event loop -> Semaphore
+        self.in_flight = 0
+        self.requests = 0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Semaphore 綁定建立時的 event loop，每個 loop 各用一個
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    async def _limited(self, request):
+        async with self._semaphore():
+            self.in_flight += 1
+            self.requests += 1
+            try:
+                return await request
+            finally:
+                self.in_flight -= 1
+
+    async def classify(self, invoices: list[dict], record_local: bool = True) -> list[dict]:
+        """
+        與 classify_invoices 相同的結果，但各批次並行送出
+
+        Args:
+            invoices: [{"seller_name": ..., "details": ..., "transaction_time": ...}, ...]
+            record_local: 是否計入本機分類器的命中統計 (背景修正重新查詢已計過的發票時傳 False)
+
+        Returns:
+            與輸入順序相同的 [{"name": ..., "category": ...}, ...]
+        """
+        # 快取 (SQLite) 與本機分類器的查詢在背景執行緒進行，不阻塞 event loop
+        results, misses = await asyncio.to_thread(_lookup_all, invoices, record_local)
+        chunks = [misses[start:start + self.batch_size] for start in range(0, len(misses), self.batch_size)]
+        await asyncio.gather(*(self._classify_chunk(invoices, chunk, results) for chunk in chunks))
+        return results
+
+    async def _classify_chunk(self, invoices: list[dict], chunk: list, results: list):
+        try:
+            batch_results = await self._limited(
+                _request_batch_classification_async([invoices[index] for index, _ in chunk])
+            )
+        except Exception as e:
+            logger.warning(f"OpenAI 批次分類失敗，改為逐張分類: {e}")
+            batch_results = [None] * len(chunk)
+
+        retries = []
+        cache_entries = []
+        for (index, cache_key), result in zip(chunk, batch_results):
+            if result is None:
+                retries.append((index, cache_key))
+                continue
+
+            results[index] = result
+            if cache_key is not None:
+                cache_entries.append((cache_key, result))
+        if cache_entries:
+            await asyncio.to_thread(_store_cache_entries, cache_entries)
+
+        retried = await asyncio.gather(*(
+            self._limited(_classify_uncached_async(
+                invoices[index]["seller_name"], invoices[index].get("details") or "",
+                invoices[index].get("transaction_time"), cache_key
+            ))
+            for index, cache_key in retries
+        ))
+        for (index, _), result in zip(retries, retried):
+            results[index] = result
+
+    def stats(self) -> dict:
         return {
-            "name": "消費",
-            "category": "其他"
+            'concurrency': self.concurrency,
+            'in_flight': self.in_flight,
+            'requests': self.requests
         }
 
 
+classification_pool = ClassificationPool(CLASSIFY_CONCURRENCY)
+
+
 if __name__ == "__main__":
     # 測試 1: 午餐時段買食物 + 飲料 → 午餐
     result = classify_invoice(
@@ -0,0 +1,143 @@
+"""
+分類背景修正佇列
+同步時先以本機規則 / 快取的暫定分類寫入 Notion，再於背景以 OpenAI 重新分類，
+結果不同時才更新 Notion 頁面，讓同步不必等待 OpenAI
+"""
+
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ClassificationRefiner:
+    """由 FastAPI lifespan 啟動的背景分類修正佇列"""
+
+    def __init__(
+        self,
+        classify: Callable[[list], Awaitable[list]],
+        update_page: Callable[[str, dict], None],
+        is_fallback: Callable[[dict], bool] = lambda result: False,
+        batch_size: int = 10,
+        batch_wait: float = 2.0
+    ):
+        """
+        Args:
+            classify: 非同步批次分類函數 (ClassificationPool.classify)
+            update_page: 更新 Notion 頁面分類的函數 (page_id, 分類)，在背景執行緒執行
+            is_fallback: 判斷分類結果是否為失敗時的預設值 (不以預設值覆蓋暫定分類)
+            batch_size: 每批最多幾張發票
+            batch_wait: 湊批次時最多等待秒數
+        """
+        self.classify = classify
+        self.update_page = update_page
+        self.is_fallback = is_fallback
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+        # 統計
+        self.in_flight = 0
+        self.refined = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.last_refined_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        """開始背景修正"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name='classification-refiner')
+            logger.info("分類背景修正佇列已啟動")
+
+    async def stop(self):
+        """停止背景修正 (尚未處理的項目保留暫定分類)"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self.pending:
+            logger.warning(f"分類背景修正佇列停止，{self.pending} 筆保留暫定分類")
+
+    def submit(self, page_id: str, invoice: dict, provisional: dict):
+        """
+        加入待修正的交易
+
+        Args:
+            page_id: Notion 頁面 ID
+            invoice: {"seller_name": ..., "details": ..., "transaction_time": ...}
+            provisional: 已寫入的暫定分類
+        """
+        self._queue.put_nowait((page_id, invoice, provisional))
+
+    @property
+    def pending(self) -> int:
+        """等待中與處理中的項目數"""
+        return self._queue.qsize() + self.in_flight
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            self.in_flight = len(batch)
+            try:
+                await self._refine(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                self.last_error = str(e)
+                logger.error(f"背景分類修正失敗: {e}")
+            finally:
+                self.in_flight = 0
+
+    async def _refine(self, batch: list):
+        results = await self.classify([invoice for _, invoice, _ in batch])
+
+        for (page_id, invoice, provisional), result in zip(batch, results):
+            self.refined += 1
+            if self.is_fallback(result) or result == provisional:
+                self.unchanged += 1
+                continue
+
+            try:
+                await asyncio.to_thread(self.update_page, page_id, result)
+                self.updated += 1
+                logger.info(
+                    f"修正分類 {invoice['seller_name']}: "
+                    f"{provisional['name']}/{provisional['category']} → {result['name']}/{result['category']}"
+                )
+            except Exception as e:
+                self.failed += 1
+                self.last_error = str(e)
+                logger.error(f"更新 Notion 分類失敗 ({page_id}): {e}")
+
+        self.last_refined_at = time.time()
+
+    def stats(self) -> dict:
+        """佇列狀態"""
+        return {
+            'running': self._task is not None and not self._task.done(),
+            'pending': self.pending,
+            'refined': self.refined,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'last_refined_at': self.last_refined_at,
+            'last_error': self.last_error
+        }
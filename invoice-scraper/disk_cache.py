@@ -0,0 +1,117 @@
+"""
+本機磁碟 LRU 快取
+以 SQLite 儲存 JSON 值，超過容量時淘汰最久未使用的項目
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(*parts: Any) -> str:
+    """將多個欄位組合成固定長度的內容定址鍵 (sha256)"""
+    raw = "\x1f".join("" if part is None else str(part) for part in parts)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class DiskLRUCache:
+    """SQLite 實作的持久化 LRU 快取（執行緒安全）"""
+
+    def __init__(self, path: str, max_entries: int, namespace: str = 'default'):
+        """
+        Args:
+            path: SQLite 檔案路徑
+            max_entries: 此 namespace 最多保留的項目數
+            namespace: 同一檔案中區分不同用途的名稱
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """延遲建立連線，避免 import 時就產生檔案"""
+        if self._conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, last_access REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_cache_entries_access ON cache_entries (namespace, last_access)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """取得快取值，不存在回傳 None（同時更新最近使用時間）"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT value FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                conn.execute(
+                    "UPDATE cache_entries SET last_access = ? WHERE namespace = ? AND key = ?",
+                    (time.time(), self.namespace, key)
+                )
+                conn.commit()
+                self.hits += 1
+                return json.loads(row[0])
+            except Exception as e:
+                logger.warning(f"讀取快取失敗: {e}")
+                self.misses += 1
+                return None
+
+    def set(self, key: str, value: Any):
+        """寫入快取值，超過容量時淘汰最久未使用的項目"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, value, last_access) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, json.dumps(value, ensure_ascii=False), time.time())
+                )
+                conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+                    "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.namespace, self.namespace, self.max_entries)
+                )
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"寫入快取失敗: {e}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+            return row[0]
+
+    def stats(self) -> dict:
+        """命中統計"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+        }
@@ -1,17 +1,26 @@
 """
 財政部電子發票平台爬蟲
-使用 Selenium 模擬瀏覽器登入 + OpenAI 驗證碼辨識
+使用 Selenium 模擬瀏覽器登入 + 本機樣板 / OpenAI 驗證碼辨識
 """
 
 import os
-import re
 import time
+import queue
+import random
+import itertools
 import base64
 import logging
-from datetime import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Set, Iterator
+from urllib.parse import urlparse
 
+import requests
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -19,9 +28,16 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
-from openai import OpenAI
 from dotenv import load_dotenv
 
+from captcha_recognizer import create_captcha_recognizer
+from carriers import DEFAULT_CARRIER, namespaced_path
+from disk_cache import DiskLRUCache, content_key
+from rate_limiter import AdaptiveRateLimiter, EndpointStats
+from session_store import SessionHealth, create_session_store, jwt_expiry
+from sync_state import SyncState
+from webdriver_pool import WarmDriverPool
+
 # 載入環境變數 (包含 OPENAI_API_KEY)
 load_dotenv()
 
@@ -34,6 +50,55 @@ logger = logging.getLogger(__name__)
 # 建立一個logger的object，名稱為__name__，也就是這個檔案的名稱，確保每個檔案都能有自己的logger
 
 
+TAIPEI_TZ = ZoneInfo('Asia/Taipei')
+
+# 並行度設定：回補時每個月份各自開分頁與明細執行緒，同時在途的請求最多為 月份數 × max(分頁, 明細)
+HYDRATE_WORKERS = int(os.getenv('EINVOICE_HYDRATE_WORKERS', '4'))
+PAGE_WORKERS = int(os.getenv('EINVOICE_PAGE_WORKERS', '4'))
+BACKFILL_WINDOWS = int(os.getenv('EINVOICE_BACKFILL_WINDOWS', '3'))
+
+# 共用的 HTTP 連線池（整個程序共用，維持 keep-alive 避免每次請求重新 TLS 握手）
+# 預設依上述並行度計算，避免執行緒數超過連線數時連線被丟棄、無法重用
+HTTP_POOL_SIZE = int(os.getenv(
+    'EINVOICE_HTTP_POOL_SIZE',
+    str(max(10, BACKFILL_WINDOWS * max(PAGE_WORKERS, HYDRATE_WORKERS)))
+))
+_http_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE)
+
+
+def get_http_stats() -> dict:
+    """
+    取得共用連線池的統計資料
+
+    Returns:
+        {"requests": 送出請求數, "connections": 建立連線數, "reused": 重用連線的請求數}
+    """
+    requests_count = 0
+    connections_count = 0
+    pools = _http_adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        requests_count += pool.num_requests
+        connections_count += pool.num_connections
+
+    return {
+        'requests': requests_count,
+        'connections': connections_count,
+        'reused': max(0, requests_count - connections_count)
+    }
+
+
+def http_stats_delta(before: dict, after: dict) -> dict:
+    """兩次 get_http_stats 之間的差額（期間其他載具的請求也會計入）"""
+    return {key: max(0, after[key] - before[key]) for key in after}
+
+
+class InvoiceFetchError(Exception):
+    """取得發票資料或明細失敗（暫時性錯誤，該發票本次不處理、下次同步重試）"""
+
+
 @dataclass
 class Invoice:
     """發票資料結構"""
@@ -49,16 +114,71 @@ class EInvoiceScraper:
 
     BASE_URL = "https://www.einvoice.nat.gov.tw"
     MOBILE_CARRIER_URL = "https://www.einvoice.nat.gov.tw/portal/btc/mobile"  # 手機條碼發票查詢
-
-    # 類別變數：Session 緩存（在同一個服務實例中共享）
-    _session_cache = {
-        'cookies': None,
-        'auth_token': None,
-        'cached_at': None
+    API_BASE_URL = "https://service-mc.einvoice.nat.gov.tw/btc/cloud/api"
+
+    # 所有平台 API 共用的預設 headers
+    DEFAULT_HEADERS = {
+        'Accept': 'application/json, text/plain, */*',
+        'Content-Type': 'application/json',
+        'Origin': 'https://www.einvoice.nat.gov.tw',
+        'Referer': 'https://www.einvoice.nat.gov.tw/',
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
     }
-    SESSION_TTL = 900  # Session 有效期 15 分鐘
-
-    def __init__(self, phone: str, password: str, headless: bool = True):
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('EINVOICE_HTTP_CONNECT_TIMEOUT', '5'))  # 建立連線逾時 (秒)
+    HTTP_READ_TIMEOUT = float(os.getenv('EINVOICE_HTTP_READ_TIMEOUT', '30'))  # 讀取回應逾時 (秒)
+
+    # 類別變數：各載具的 Session 儲存與健康追蹤（檔案後端可跨重啟與 worker 共用，並提供跨程序登入鎖）
+    _session_stores: dict = {}
+    _session_stores_lock = threading.Lock()
+    SESSION_TTL = 900  # Session 閒置有效期 15 分鐘（每次成功請求重新起算）
+    SESSION_TRUST_WINDOW = float(os.getenv('EINVOICE_SESSION_TRUST_WINDOW', '120'))  # 此秒數內驗證過的 session 不再探測
+    LOGIN_LOCK_TIMEOUT = 180  # 等待其他登入流程完成的最長秒數
+    SESSION_REFRESH_MARGIN = float(os.getenv('EINVOICE_SESSION_REFRESH_MARGIN', '180'))  # 距到期多少秒內主動更新
+
+    # 發票資料 / 明細快取（以發票號碼 + 日期為鍵，EINVOICE_DETAIL_CACHE=0 可停用）
+    detail_cache = DiskLRUCache(
+        os.getenv('EINVOICE_DETAIL_CACHE_PATH', '.invoice_cache.sqlite3'),
+        max_entries=int(os.getenv('EINVOICE_DETAIL_CACHE_MAX_ENTRIES', '5000')),
+        namespace='invoice_detail'
+    ) if os.getenv('EINVOICE_DETAIL_CACHE', '1') == '1' else None
+
+    captcha_recognizer = create_captcha_recognizer()  # 驗證碼辨識器 (EINVOICE_CAPTCHA_RECOGNIZER)
+
+    # 常駐 WebDriver：以記憶體換取登入延遲，閒置逾時後自動關閉
+    WARM_DRIVER_ENABLED = os.getenv('EINVOICE_WARM_DRIVER', '0') == '1'
+    CHROME_PROFILE_DIR = os.getenv('EINVOICE_CHROME_PROFILE_DIR', '')
+    driver_pool = WarmDriverPool(idle_timeout=float(os.getenv('EINVOICE_DRIVER_IDLE_TIMEOUT', '300')))
+
+    # 登入後端：'selenium' (預設) 或 'http' (不啟動瀏覽器，失敗時自動退回 Selenium)
+    LOGIN_BACKEND = os.getenv('EINVOICE_LOGIN_BACKEND', 'selenium').lower()
+    # HTTP 登入端點（依平台登入頁的實際 API 設定，未設定時停用 HTTP 登入）
+    HTTP_LOGIN_CAPTCHA_URL = os.getenv('EINVOICE_HTTP_LOGIN_CAPTCHA_URL', '')
+    HTTP_LOGIN_URL = os.getenv('EINVOICE_HTTP_LOGIN_URL', '')
+    HTTP_LOGIN_FIELDS = {
+        'phone': os.getenv('EINVOICE_HTTP_LOGIN_PHONE_FIELD', 'mobilePhone'),
+        'password': os.getenv('EINVOICE_HTTP_LOGIN_PASSWORD_FIELD', 'password'),
+        'captcha': os.getenv('EINVOICE_HTTP_LOGIN_CAPTCHA_FIELD', 'captcha'),
+        'captcha_token': os.getenv('EINVOICE_HTTP_LOGIN_CAPTCHA_TOKEN_FIELD', 'captchaToken')
+    }
+    DEFAULT_HYDRATE_WORKERS = HYDRATE_WORKERS  # 並行取得明細的執行緒數
+    PAGE_WORKERS = PAGE_WORKERS  # 並行取得分頁的執行緒數
+    BACKFILL_WINDOWS = BACKFILL_WINDOWS  # 回補時同時處理的月份數
+    BACKFILL_QUEUE_SIZE = int(os.getenv('EINVOICE_BACKFILL_QUEUE_SIZE', '50'))  # 同步 / 回補時等待呼叫端處理的發票上限
+
+    # 全域速率限制：所有爬蟲實例與執行緒共用，遇到節流時自動降速、成功後逐步回復
+    rate_limiter = AdaptiveRateLimiter(
+        rate=float(os.getenv('EINVOICE_API_RATE', '10')),
+        burst=int(os.getenv('EINVOICE_API_BURST', '10')),
+        min_rate=float(os.getenv('EINVOICE_API_MIN_RATE', '1'))
+    )
+    # 重試：429 / 5xx / 逾時 / 連線錯誤時以指數退避 + 抖動重試
+    API_RETRIES = int(os.getenv('EINVOICE_API_RETRIES', '2'))  # 每個請求失敗後的最多重試次數
+    API_BACKOFF_BASE = float(os.getenv('EINVOICE_API_BACKOFF_BASE', '0.5'))  # 退避基準秒數
+    API_BACKOFF_MAX = float(os.getenv('EINVOICE_API_BACKOFF_MAX', '8'))  # 單次退避上限秒數
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, phone: str, password: str, headless: bool = True, hydrate_workers: Optional[int] = None,
+                 carrier: str = DEFAULT_CARRIER):
         """
         初始化爬蟲
 
@@ -66,57 +186,195 @@ class EInvoiceScraper:
             phone: 手機號碼
             password: 密碼
             headless: 是否使用無頭模式
+            hydrate_workers: 並行取得發票明細的最大執行緒數 (1 = 依序處理，預設讀取 EINVOICE_HYDRATE_WORKERS)
+            carrier: 載具名稱，決定使用哪一份 session 快取與登入鎖
         """
         self.phone = phone
         self.password = password
+        self.carrier = carrier
+        self.session_store, self.session_health = self.session_for(carrier)
         self.headless = headless
+        self.hydrate_workers = hydrate_workers or self.DEFAULT_HYDRATE_WORKERS
         self.driver = None
         self.cookies = {}           # 登入後的 cookies
         self.auth_token = None      # Authorization token
+        self.http = self._create_http_session()  # 共用連線池的 HTTP session
         self.last_filtered_count = 0  # 最後一次過濾的發票數量
         self.last_total_count = 0     # 最後一次 API 回傳的總發票數量
+        self.last_pending_count = 0   # 最後一次需要補齊明細的發票數量
+        self.last_failed_pages = []   # 最後一次重試後仍取得失敗的頁碼 (1-based)
+        self.last_fetch_failed_count = 0  # 最後一次因資料 / 明細取得失敗而未處理的發票數量 (下次同步重試)
+        self.last_already_synced_count = 0  # 最後一次因增量同步而跳過的發票數量
+        self.last_known_skipped_count = 0   # 最後一次因已存在而跳過明細取得的發票數量
+        self.last_detail_cache_stats = {'hits': 0, 'misses': 0}  # 最後一次明細快取命中統計
+        self._detail_cache_lock = threading.Lock()
+        self.api_stats = EndpointStats()  # 各 API 端點的請求 / 重試 / 節流 / 連線錯誤 / 放棄統計
+
+    def _create_http_session(self) -> requests.Session:
+        """建立使用共用連線池的 HTTP session（預設 headers 在此統一設定）"""
+        session = requests.Session()
+        session.headers.update(self.DEFAULT_HEADERS)
+        session.mount('https://', _http_adapter)
+        return session
+
+    def _apply_session_auth(self):
+        """將目前的 cookies 與 auth token 套用到 HTTP session"""
+        self.http.cookies.clear()
+        self.http.cookies.update(self.cookies or {})
+        if self.auth_token:
+            self.http.headers['Authorization'] = f'Bearer {self.auth_token}'
+        else:
+            self.http.headers.pop('Authorization', None)
+
+    def _post(self, url: str, timeout: Optional[float] = None, retries: Optional[int] = None, **kwargs) -> requests.Response:
+        """
+        透過共用 session 送出 POST 請求（受全域速率限制，節流或暫時性錯誤時自動重試）
+
+        Args:
+            url: 請求網址
+            timeout: 讀取逾時秒數 (預設 HTTP_READ_TIMEOUT)
+            retries: 失敗後的最多重試次數 (預設 API_RETRIES，0 = 不重試)
+            **kwargs: 其餘傳給 requests 的參數 (json, data, headers, cookies...)
+
+        Returns:
+            最後一次的回應；重試用盡時仍回傳最後的 429 / 5xx 回應
+
+        Raises:
+            requests.Timeout / requests.ConnectionError: 重試用盡仍逾時或無法連線
+        """
+        read_timeout = timeout if timeout is not None else self.HTTP_READ_TIMEOUT
+        max_retries = self.API_RETRIES if retries is None else retries
+        endpoint = urlparse(url).path.rstrip('/').rsplit('/', 1)[-1] or url
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                self.api_stats.record(endpoint, 'retries')
+            self.api_stats.record(endpoint, 'requests')
+            self.rate_limiter.acquire()
+
+            try:
+                response = self.http.post(url, timeout=(self.HTTP_CONNECT_TIMEOUT, read_timeout), **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                self.rate_limiter.on_throttle()
+                self.api_stats.record(endpoint, 'errors')
+                if attempt >= max_retries:
+                    self.api_stats.record(endpoint, 'give_ups')
+                    raise
+                logger.warning(f"{endpoint} 請求失敗 (第 {attempt+1} 次): {e}")
+                time.sleep(self._backoff_seconds(attempt))
+                continue
+
+            if response.status_code not in self.RETRY_STATUS_CODES:
+                self.rate_limiter.on_success()
+                session_cookies = kwargs.get('cookies') or self.cookies
+                if response.status_code == 200 and session_cookies and url != self.HTTP_LOGIN_URL:
+                    self.session_health.record_success(session_cookies)
+                return response
+
+            self.rate_limiter.on_throttle()
+            self.api_stats.record(endpoint, 'throttles')
+            if attempt >= max_retries:
+                self.api_stats.record(endpoint, 'give_ups')
+                return response
+            logger.warning(f"{endpoint} 回應 HTTP {response.status_code} (第 {attempt+1} 次)，稍後重試")
+            time.sleep(self._backoff_seconds(attempt, response.headers.get('Retry-After')))
+
+    def _backoff_seconds(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """計算重試前等待秒數：優先採用 Retry-After，否則為指數退避加上完整抖動"""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.API_BACKOFF_MAX)
+        return random.uniform(0, min(self.API_BACKOFF_MAX, self.API_BACKOFF_BASE * (2 ** attempt)))
 
     def _is_session_valid(self) -> bool:
         """檢查緩存的 session 是否仍有效"""
-        cache = EInvoiceScraper._session_cache
+        expires_at = self.session_expires_at(self.session_store.load())
+        return expires_at is not None and time.time() < expires_at
+
+    @classmethod
+    def session_expires_at(cls, cache: dict) -> Optional[float]:
+        """
+        Session 的實際到期時間：最近驗證時間 + TTL (滑動) 與 JWT exp 取較早者
+
+        Returns:
+            到期時間 (epoch 秒)；沒有快取時回傳 None
+        """
         if not cache['cookies'] or not cache['cached_at']:
-            return False
+            return None
 
-        # 檢查是否過期
-        elapsed = time.time() - cache['cached_at']
-        if elapsed > self.SESSION_TTL:
-            return False
+        expires_at = SessionHealth.last_validated(cache) + cls.SESSION_TTL
+        token_exp = jwt_expiry(cache['auth_token'])
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        return expires_at
+
+    def refresh_session(self, margin: Optional[float] = None) -> str:
+        """
+        主動維護 session（供背景排程呼叫）
+
+        - 距到期還久：不做任何事
+        - 接近 TTL：先以輕量請求探測，成功就沿用並重新起算 TTL
+        - 探測失敗或 JWT 即將到期：重新登入
+
+        Args:
+            margin: 距到期多少秒內視為需要更新 (預設 SESSION_REFRESH_MARGIN)
+
+        Returns:
+            'fresh' / 'extended' / 'relogin' / 'busy' (其他流程正在登入) / 'failed'
+        """
+        margin = self.SESSION_REFRESH_MARGIN if margin is None else margin
 
-        return True
+        login_lock = self.session_store.login_lock
+        if not login_lock.acquire(blocking=False):
+            return 'busy'
+
+        try:
+            cache = self.session_store.load()
+            expires_at = self.session_expires_at(cache)
+            now = time.time()
+            if expires_at is not None and expires_at - now > margin:
+                return 'fresh'
+
+            token_exp = jwt_expiry(cache['auth_token'])
+            token_usable = token_exp is None or token_exp - now > margin
+            if expires_at is not None and token_usable and self._probe_session(cache['cookies'], cache['auth_token']):
+                self.cookies = cache['cookies']
+                self.auth_token = cache['auth_token']
+                self.session_store.touch(cache['cookies'], time.time())
+                logger.info("Session 探測成功，延長有效期")
+                return 'extended'
+
+            logger.info("Session 即將到期或已失效，重新登入")
+            return 'relogin' if self.login(force_refresh=True) else 'failed'
+        finally:
+            login_lock.release()
 
     def _try_cached_session(self) -> bool:
         """嘗試使用緩存的 session"""
-        import requests
-        from datetime import timezone
-        from zoneinfo import ZoneInfo
-
         if not self._is_session_valid():
             return False
 
-        cache = EInvoiceScraper._session_cache
+        cache = self.session_store.load()
 
-        # 用發票查詢 API 測試 session 是否有效
-        test_url = "https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/getSearchCarrierInvoiceListJWT"
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json',
-            'Origin': 'https://www.einvoice.nat.gov.tw',
-            'Referer': 'https://www.einvoice.nat.gov.tw/',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
+        # 近期有成功的已驗證請求時直接沿用，省下一次探測請求
+        recently_validated = time.time() - SessionHealth.last_validated(cache) < self.SESSION_TRUST_WINDOW
+        if recently_validated or self._probe_session(cache['cookies'], cache['auth_token']):
+            # Session 有效，使用緩存
+            self.cookies = cache['cookies']
+            self.auth_token = cache['auth_token']
+            self._apply_session_auth()
+            return True
+        return False
+
+    def _probe_session(self, cookies: dict, auth_token: Optional[str]) -> bool:
+        """以發票查詢 API 測試 cookies / token 是否可用"""
+        test_url = f"{self.API_BASE_URL}/btc502w/getSearchCarrierInvoiceListJWT"
+        headers = {}
 
-        if cache['auth_token']:
-            headers['Authorization'] = f'Bearer {cache["auth_token"]}'
+        if auth_token:
+            headers['Authorization'] = f'Bearer {auth_token}'
 
         # 只查詢今天的資料來測試
-        taipei_tz = ZoneInfo('Asia/Taipei')
-        now = datetime.now(taipei_tz)
-        now_utc = now.astimezone(timezone.utc)
+        now_utc = datetime.now(TAIPEI_TZ).astimezone(timezone.utc)
 
         payload = {
             "cardCode": "",
@@ -128,39 +386,77 @@ class EInvoiceScraper:
         }
 
         try:
-            response = requests.post(test_url, json=payload, headers=headers, cookies=cache['cookies'], timeout=5)
-            if response.status_code == 200:
-                # Session 有效，使用緩存
-                self.cookies = cache['cookies']
-                self.auth_token = cache['auth_token']
-                return True
-            else:
-                return False
+            response = self._post(test_url, json=payload, headers=headers, cookies=cookies, timeout=5, retries=0)
+            return response.status_code == 200
         except Exception as e:
             logger.warning(f"Session 驗證失敗: {e}")
             return False
 
     def _cache_session(self):
         """緩存當前的 session"""
-        EInvoiceScraper._session_cache = {
+        now = time.time()
+        self.session_store.save({
             'cookies': self.cookies.copy(),
             'auth_token': self.auth_token,
-            'cached_at': time.time()
-        }
+            'cached_at': now,
+            'validated_at': now
+        })
+        self.session_health.reset()
         logger.info("Session 已緩存")
 
     @classmethod
-    def clear_session_cache(cls):
+    def session_for(cls, carrier: str = DEFAULT_CARRIER) -> tuple:
+        """
+        取得載具的 session 儲存與健康追蹤（同一程序內共用同一份）
+
+        Returns:
+            (SessionStore, SessionHealth)
+        """
+        with cls._session_stores_lock:
+            if carrier not in cls._session_stores:
+                store = create_session_store(carrier)
+                cls._session_stores[carrier] = (store, SessionHealth(store))
+            return cls._session_stores[carrier]
+
+    @classmethod
+    def clear_session_cache(cls, carrier: str = DEFAULT_CARRIER):
         """清除 session 快取，強制下次重新登入"""
-        cls._session_cache = {
-            'cookies': None,
-            'auth_token': None,
-            'cached_at': None
-        }
-        logger.info("Session 快取已清除")
+        store, health = cls.session_for(carrier)
+        store.clear()
+        health.reset()
+        logger.info(f"Session 快取已清除 ({carrier})")
 
     def _init_driver(self):
-        """初始化 Chrome/Chromium WebDriver"""
+        """初始化 Chrome/Chromium WebDriver（啟用常駐模式時重用已啟動的瀏覽器）"""
+        if self.WARM_DRIVER_ENABLED:
+            self.driver = self.driver_pool.acquire(self._create_driver, owner=self.carrier)
+        else:
+            self.driver = self._create_driver()
+
+    def _release_driver(self):
+        """登入流程結束後歸還或關閉 WebDriver"""
+        if not self.driver:
+            return
+
+        if self.WARM_DRIVER_ENABLED:
+            self.driver_pool.release(self.driver)
+        else:
+            self.driver.quit()
+        self.driver = None
+
+    def _discard_driver(self):
+        """登入失敗或發生錯誤時丟棄 WebDriver，瀏覽器狀態可能已異常，不再重用"""
+        if not self.driver:
+            return
+
+        if self.WARM_DRIVER_ENABLED:
+            self.driver_pool.discard(self.driver)
+        else:
+            self.driver.quit()
+        self.driver = None
+
+    def _create_driver(self):
+        """啟動新的 Chrome/Chromium WebDriver"""
         options = Options()
 
         if self.headless:
@@ -190,6 +486,11 @@ class EInvoiceScraper:
         options.add_argument('--disable-logging')
         options.add_argument('--log-level=3')  # 只顯示嚴重錯誤
 
+        # 常駐模式使用固定的使用者資料目錄，重啟瀏覽器後仍保留登入狀態與快取
+        if self.CHROME_PROFILE_DIR:
+            # 每個載具使用各自的 profile，避免沿用其他載具的登入狀態
+            options.add_argument(f'--user-data-dir={namespaced_path(self.CHROME_PROFILE_DIR, self.carrier)}')
+
         # 注意：不能禁用圖片，因為需要載入驗證碼
         prefs = {
             'profile.managed_default_content_settings.fonts': 2,  # 禁用字體下載
@@ -210,12 +511,12 @@ class EInvoiceScraper:
         chromedriver_path = os.environ.get('CHROMEDRIVER_PATH')
         if chromedriver_path:
             service = Service(executable_path=chromedriver_path)
-            self.driver = webdriver.Chrome(service=service, options=options)
+            driver = webdriver.Chrome(service=service, options=options)
         else:
-            self.driver = webdriver.Chrome(options=options)
+            driver = webdriver.Chrome(options=options)
 
         # 執行 CDP 指令來隱藏 webdriver 特徵
-        self.driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {
+        driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {
             'source': '''
                 Object.defineProperty(navigator, 'webdriver', {
                     get: () => undefined
@@ -223,11 +524,12 @@ class EInvoiceScraper:
             '''
         })
 
+        return driver
 
 
     def _recognize_captcha(self, captcha_element) -> str:
         """
-        辨識驗證碼 (使用 OpenAI gpt-4o-mini)
+        辨識驗證碼 (本機樣板比對優先，信心不足時使用 OpenAI)
 
         Args:
             captcha_element: 驗證碼圖片元素
@@ -236,45 +538,21 @@ class EInvoiceScraper:
             辨識出的驗證碼文字
         """
         # 截取驗證碼圖片
-        captcha_png = captcha_element.screenshot_as_png
-        
-        # 轉換為 base64
-        base64_image = base64.b64encode(captcha_png).decode('utf-8')
-        
-        try:
-            # 使用 OpenAI API 辨識
-            client = OpenAI()  # 會從環境變數 OPENAI_API_KEY 讀取
-            
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "請辨識這張驗證碼圖片中的5位數字，只回覆數字本身，不要有任何其他文字或說明。"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=10
-            )
-            
-            result = response.choices[0].message.content.strip()
-            # 只保留數字
-            result = re.sub(r'[^0-9]', '', result)
-            
-            return result
-            
-        except Exception:
-            return ""
+        return self._recognize_captcha_image(captcha_element.screenshot_as_png)
+
+    def _recognize_captcha_image(self, captcha_png: bytes) -> str:
+        """
+        辨識驗證碼圖片位元組 (Selenium 截圖或 HTTP 下載皆可)
+
+        Args:
+            captcha_png: 驗證碼圖片
+
+        Returns:
+            辨識出的驗證碼文字
+        """
+        text, confidence = self.captcha_recognizer.recognize(captcha_png)
+        logger.info(f"驗證碼辨識結果長度 {len(text)}，信心 {confidence:.2f}")
+        return text
 
     def _click_login_button(self):
         """點擊登入按鈕進入登入頁面"""
@@ -323,24 +601,152 @@ class EInvoiceScraper:
         Returns:
             是否登入成功
         """
-        logger.info("開始登入流程...")
+        logger.info(f"開始登入流程 ({self.carrier})...")
 
         # 先嘗試使用緩存的 session (如果沒有強制刷新)
         if not force_refresh and self._try_cached_session():
             logger.info("使用緩存的 session 成功")
             return True
-        
-        logger.info("緩存無效，需要重新登入")
 
+        # 單一飛行：同一時間（跨 worker）只允許一個登入流程
+        login_lock = self.session_store.login_lock
+        if not login_lock.acquire(timeout=self.LOGIN_LOCK_TIMEOUT):
+            raise TimeoutError("等待其他登入流程逾時")
+
+        try:
+            # 等待期間其他程序可能已完成登入，再檢查一次快取
+            if not force_refresh and self._try_cached_session():
+                logger.info("使用其他流程剛建立的 session 成功")
+                return True
+
+            logger.info("緩存無效，需要重新登入")
+
+            # 優先使用不需瀏覽器的 HTTP 登入，失敗時自動退回 Selenium
+            if self.LOGIN_BACKEND == 'http' and self._http_login_available():
+                try:
+                    if self._login_with_http(max_retries):
+                        return True
+                except Exception as e:
+                    logger.warning(f"HTTP 登入發生錯誤: {e}")
+                logger.info("HTTP 登入失敗，改用 Selenium 登入")
+
+            return self._login_with_browser(max_retries)
+        finally:
+            login_lock.release()
+
+    def _http_login_available(self) -> bool:
+        """HTTP 登入所需的端點是否已設定"""
+        return bool(self.HTTP_LOGIN_CAPTCHA_URL and self.HTTP_LOGIN_URL)
+
+    def _fetch_http_captcha(self) -> tuple[bytes, Optional[str]]:
+        """
+        下載驗證碼圖片
+
+        Returns:
+            (圖片位元組, 驗證碼識別 token)；端點直接回傳圖片時 token 為 None
+        """
+        response = self.http.get(
+            self.HTTP_LOGIN_CAPTCHA_URL,
+            timeout=(self.HTTP_CONNECT_TIMEOUT, self.HTTP_READ_TIMEOUT)
+        )
+        response.raise_for_status()
+
+        if response.headers.get('Content-Type', '').startswith('image/'):
+            return response.content, None
+
+        # JSON 回應：圖片為 base64 (可能帶 data URL 前綴)，另附驗證碼 token
+        data = response.json()
+        image = next((data[key] for key in ('image', 'captchaImage', 'img', 'base64') if data.get(key)), '')
+        if ',' in image:
+            image = image.split(',', 1)[1]
+        captcha_token = next((data[key] for key in ('captchaToken', 'token', 'uuid', 'key') if data.get(key)), None)
+        return base64.b64decode(image), captcha_token
+
+    def _login_with_http(self, max_retries: int) -> bool:
+        """
+        不啟動瀏覽器，直接以 HTTP 完成登入（呼叫端需持有登入鎖）
+
+        流程：下載驗證碼 → 辨識 → 送出登入表單 → 從回應取得 cookies 與 JWT → 以查詢 API 驗證
+        """
+        logger.info("使用 HTTP 登入...")
+
+        for attempt in range(max_retries):
+            captcha_png, captcha_token = self._fetch_http_captcha()
+            captcha_text = self._recognize_captcha_image(captcha_png)
+            if len(captcha_text) != 5:
+                continue
+
+            payload = {
+                self.HTTP_LOGIN_FIELDS['phone']: self.phone,
+                self.HTTP_LOGIN_FIELDS['password']: self.password,
+                self.HTTP_LOGIN_FIELDS['captcha']: captcha_text
+            }
+            if captcha_token:
+                payload[self.HTTP_LOGIN_FIELDS['captcha_token']] = captcha_token
+
+            response = self._post(self.HTTP_LOGIN_URL, json=payload, retries=0)  # 驗證碼只能用一次，不重試
+            if response.status_code != 200:
+                logger.warning(f"HTTP 登入失敗 (第 {attempt+1} 次): HTTP {response.status_code}")
+                continue
+
+            # JWT 可能在 Authorization header 或 JSON body 中
+            auth_token = None
+            auth_header = response.headers.get('Authorization', '')
+            if auth_header.startswith('Bearer '):
+                auth_token = auth_header[len('Bearer '):]
+            if not auth_token:
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                if isinstance(body, dict):
+                    nested = body.get('data')
+                    auth_token = self._extract_auth_token([body, nested] if isinstance(nested, dict) else [body])
+
+            cookies = self.http.cookies.get_dict()
+            if not self._probe_session(cookies, auth_token):
+                logger.warning(f"HTTP 登入後 session 驗證失敗 (第 {attempt+1} 次)")
+                continue
+
+            self.cookies = cookies
+            self.auth_token = auth_token
+            self._apply_session_auth()
+            self._cache_session()
+            logger.info("HTTP 登入成功")
+            return True
+
+        return False
+
+    def _login_with_browser(self, max_retries: int) -> bool:
+        """使用 Selenium 瀏覽器登入（呼叫端需持有登入鎖）"""
         # 初始化瀏覽器
         self._init_driver()
 
+        # 成功時 _save_session 會歸還瀏覽器；失敗或發生錯誤時丟棄，避免下次重用異常的實例
+        try:
+            logged_in = self._browser_login_attempts(max_retries)
+        except Exception:
+            self._discard_driver()
+            raise
+        if not logged_in:
+            self._discard_driver()
+        return logged_in
+
+    def _browser_login_attempts(self, max_retries: int) -> bool:
+        """在已初始化的瀏覽器中執行登入流程"""
         # 前往「手機條碼發票查詢」頁面，會自動導向登入
         self.driver.get(self.MOBILE_CARRIER_URL)
 
         wait = WebDriverWait(self.driver, 10)  # 減少等待時間
         short_wait = WebDriverWait(self.driver, 5)
 
+        # 常駐瀏覽器的 profile 可能仍保有登入狀態，此時直接取用 session
+        if self.WARM_DRIVER_ENABLED and self._is_already_logged_in(wait):
+            logger.info("常駐瀏覽器仍為登入狀態，直接取用 session")
+            self._save_session()
+            self._cache_session()
+            return True
+
         for attempt in range(max_retries):
             try:
                 # 等待登入表單載入
@@ -427,6 +833,16 @@ class EInvoiceScraper:
 
         return False
 
+    def _is_already_logged_in(self, wait: WebDriverWait) -> bool:
+        """等待頁面出現登入表單或登出按鈕，判斷是否已登入"""
+        logout_xpath = "//*[contains(text(), '登出')]"
+        try:
+            wait.until(lambda d: d.find_elements(By.ID, "mobile_phone") or d.find_elements(By.XPATH, logout_xpath))
+        except TimeoutException:
+            return False
+
+        return 'login' not in self.driver.current_url.lower() and bool(self.driver.find_elements(By.XPATH, logout_xpath))
+
     def _save_session(self):
         """登入成功後保存 session (cookies + JWT token)"""
         # 取得所有 cookies
@@ -440,70 +856,325 @@ class EInvoiceScraper:
             session_storage = self.driver.execute_script(
                 "return Object.entries(sessionStorage).reduce((acc, [k, v]) => ({...acc, [k]: v}), {});"
             )
-
-            token_keys = ['token', 'authToken', 'jwt', 'accessToken', 'jwtToken', 'auth_token', 'access_token']
-            for _, storage in [('localStorage', local_storage), ('sessionStorage', session_storage)]:
-                for key in token_keys:
-                    if key in storage:
-                        self.auth_token = storage[key]
-                        break
-                    for k, v in storage.items():
-                        if any(tk in k.lower() for tk in ['token', 'jwt', 'auth']):
-                            if isinstance(v, str) and len(v) > 50:
-                                self.auth_token = v
-                                break
-                if self.auth_token:
-                    break
+            self.auth_token = self._extract_auth_token([local_storage, session_storage])
 
         except Exception:
             pass
 
-        self.driver.quit()
-        self.driver = None
+        self._apply_session_auth()
+
+        self._release_driver()
+
+    @staticmethod
+    def _extract_auth_token(storages: list) -> Optional[str]:
+        """從 storage 或 JSON 回應等 key/value 集合中找出 JWT token"""
+        token_keys = ['token', 'authToken', 'jwt', 'accessToken', 'jwtToken', 'auth_token', 'access_token']
+        for storage in storages:
+            for key in token_keys:
+                if key in storage:
+                    return storage[key]
+                for k, v in storage.items():
+                    if any(tk in k.lower() for tk in ['token', 'jwt', 'auth']):
+                        if isinstance(v, str) and len(v) > 50:
+                            return v
+        return None
 
-    def get_invoices(self, progress_callback=None) -> List[Invoice]:
+    def get_invoices(self, progress_callback=None, **kwargs) -> List[Invoice]:
         """
-        使用 requests 取得發票列表
+        使用 requests 取得發票列表（iter_invoices 的列表版本）
+
+        Args:
+            progress_callback: 可選的進度回調函數，見 iter_invoices
+            **kwargs: sync_state / known_invoice_numbers / start_date / end_date，見 iter_invoices
+
+        Returns:
+            發票列表
+        """
+        return list(self.iter_invoices(progress_callback=progress_callback, **kwargs))
+
+    def iter_invoices(
+        self,
+        progress_callback=None,
+        sync_state: Optional[SyncState] = None,
+        known_invoice_numbers: Optional[Set[str]] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None
+    ) -> Iterator[Invoice]:
+        """
+        使用 requests 取得發票，每張發票補齊明細後立即產出（依列表順序）
+
+        呼叫端可邊取得邊分類、寫入 Notion；last_* 統計在迭代結束後才會完整
 
         Args:
             progress_callback: 可選的進度回調函數，簽名為 (current, total, stage, message)
                 - current: 當前處理的發票索引 (1-based)
                 - total: 發票總數
-                - stage: 階段 ('fetching_list', 'processing', 'done')
+                - stage: 階段 ('fetching_list', 'skipped', 'processing', 'done')
                 - message: 狀態訊息
+            sync_state: 增量同步狀態，若提供則跳過先前已同步的發票（不取得明細也不回傳）
+            known_invoice_numbers: 已知已存在的發票號碼（例如已寫入 Notion），這些發票不取得明細也不回傳
+            start_date: 查詢起始時間 (台北時區，預設為當月 1 日)
+            end_date: 查詢結束時間 (台北時區，預設為現在)
+
+        Yields:
+            Invoice
+        """
+        if not self.cookies:
+            raise Exception("尚未登入，請先呼叫 login()")
+
+        invoice_count = 0
+        self.last_detail_cache_stats = {'hits': 0, 'misses': 0}
+        http_stats_before = get_http_stats()  # 連線池為程序共用，記錄開始時的數字以計算本次同步的差額
+
+        # 計算日期範圍 (使用台北時區)
+        end_date = end_date or datetime.now(TAIPEI_TZ)
+        start_date = start_date or end_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+        try:
+            invoice_list, failed_pages = self._fetch_invoice_list(start_date, end_date)
+
+            self.last_failed_pages = failed_pages  # 儲存失敗頁碼供外部讀取
+            if failed_pages and progress_callback:
+                progress_callback(0, 0, 'fetching_list', f"第 {', '.join(map(str, failed_pages))} 頁取得失敗，該頁發票本次未處理")
+
+            total_count = len(invoice_list)
+            self.last_total_count = total_count  # 儲存總數供外部讀取
+            self.last_pending_count = 0
+            logger.info(f"API 返回 {total_count} 筆發票")
+
+            # 增量同步：跳過先前已同步的發票
+            pending_list = invoice_list
+            if sync_state is not None:
+                sync_state.prune(start_date.strftime('%Y-%m-%d'))
+                pending_list = [item for item in pending_list if not sync_state.is_synced(item.get('invoiceNumber', ''))]
+            self.last_already_synced_count = total_count - len(pending_list)
+
+            # 取得明細前先去除已知已存在的發票，省下兩次明細 API 呼叫
+            known_count = 0
+            if known_invoice_numbers:
+                remaining = []
+                for item in pending_list:
+                    invoice_number = item.get('invoiceNumber', '')
+                    if invoice_number and invoice_number in known_invoice_numbers:
+                        known_count += 1
+                        if sync_state is not None:
+                            sync_state.mark_synced(invoice_number, '')
+                        continue
+                    remaining.append(item)
+                pending_list = remaining
+            self.last_known_skipped_count = known_count
+
+            if known_count > 0:
+                logger.info(f"跳過 {known_count} 筆已存在的發票，不取得明細")
+                if progress_callback:
+                    progress_callback(known_count, total_count, 'skipped', f'跳過 {known_count} 筆已存在的發票')
+
+            self.last_pending_count = len(pending_list)  # 需要補齊明細的發票數量
+
+            # 回報取得列表完成
+            if progress_callback:
+                skipped_total = total_count - len(pending_list)
+                if skipped_total > 0:
+                    progress_callback(0, len(pending_list), 'fetching_list', f'取得 {total_count} 筆發票，{skipped_total} 筆已處理過，開始處理 {len(pending_list)} 筆...')
+                else:
+                    progress_callback(0, total_count, 'fetching_list', f'取得 {total_count} 筆發票，開始處理...')
+
+            filtered_count = 0  # 追蹤被過濾的發票數量
+            self.last_fetch_failed_count = 0
+
+            if isinstance(pending_list, list) and pending_list:
+                hydrated = self._iter_hydrated(pending_list, progress_callback)
+                for item, invoice in zip(pending_list, hydrated):
+                    if isinstance(invoice, InvoiceFetchError):
+                        # 不標記為已同步，下次同步重新取得
+                        self.last_fetch_failed_count += 1
+                        continue
+                    if invoice is None:
+                        filtered_count += 1
+                        # 被過濾的發票不會進入 Notion，直接視為已同步
+                        if sync_state is not None:
+                            sync_state.mark_synced(item.get('invoiceNumber', ''), '')
+                        continue
+                    invoice_count += 1
+                    yield invoice
+
+            # 儲存過濾數量供外部讀取
+            self.last_filtered_count = filtered_count
+
+            if self.detail_cache is not None:
+                logger.info(f"明細快取: 命中 {self.last_detail_cache_stats['hits']} 筆，未命中 {self.last_detail_cache_stats['misses']} 筆")
+
+            http_stats = http_stats_delta(http_stats_before, get_http_stats())
+            logger.info(f"本次同步 HTTP 連線統計: {http_stats['requests']} 次請求，建立 {http_stats['connections']} 條連線，重用 {http_stats['reused']} 次")
+
+            if self.last_fetch_failed_count:
+                logger.warning(f"{self.last_fetch_failed_count} 筆發票的資料或明細取得失敗，本次未處理，下次同步重試")
+                if progress_callback:
+                    progress_callback(0, 0, 'fetching_list', f'{self.last_fetch_failed_count} 筆發票取得明細失敗，下次同步重試')
+
+            # 記錄處理結果
+            if filtered_count > 0:
+                logger.info(f"成功處理 {invoice_count} 筆發票（API 返回 {total_count} 筆，已過濾 {filtered_count} 筆）")
+            else:
+                logger.info(f"成功處理 {invoice_count} 筆發票")
+
+            # 回報處理完成
+            if progress_callback:
+                if filtered_count > 0:
+                    progress_callback(total_count, total_count, 'done', f'完成！API 返回 {total_count} 筆，已過濾 {filtered_count} 筆，處理 {invoice_count} 筆發票')
+                else:
+                    progress_callback(total_count, total_count, 'done', f'完成！共處理 {invoice_count} 筆發票')
+
+        except Exception as e:
+            logger.error(f"取得發票列表時發生錯誤: {e}")
+            # 重新拋出異常，讓上層處理
+            raise
+    
+    @staticmethod
+    def month_windows(start_date: datetime, end_date: datetime) -> List[tuple]:
+        """
+        將日期範圍切成以月為單位的查詢區間
 
         Returns:
-            發票列表
+            [(區間起始, 區間結束), ...]，依時間先後排列
+        """
+        windows = []
+        window_start = start_date
+        while window_start <= end_date:
+            if window_start.month == 12:
+                next_month = window_start.replace(year=window_start.year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+            else:
+                next_month = window_start.replace(month=window_start.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+            window_end = min(end_date, next_month - timedelta(milliseconds=1))
+            windows.append((window_start, window_end))
+            window_start = next_month
+        return windows
+
+    def iter_backfill(
+        self,
+        start_date: datetime,
+        end_date: datetime,
+        known_invoice_numbers: Optional[Set[str]] = None
+    ) -> Iterator[tuple]:
         """
-        import requests
+        回補任意日期範圍的發票：依月份切段並行查詢，每張發票補齊後立即產出
 
+        同時處理的月份數由 BACKFILL_WINDOWS 控制，所有請求受全域 rate_limiter 限制；
+        各月份的工作執行緒透過有上限的 queue (BACKFILL_QUEUE_SIZE) 交出發票，呼叫端處理較慢時會等待，
+        大範圍回補時記憶體不會隨月份的發票數成長
+
+        Args:
+            start_date: 起始時間 (台北時區)
+            end_date: 結束時間 (台北時區，超過現在時以現在為準)
+            known_invoice_numbers: 已存在的發票號碼，這些發票不取得明細
+
+        Yields:
+            ('invoice', 月份起始日 YYYY-MM-DD, Invoice)：補齊的發票 (同一月份依列表順序)
+            ('window', 結果)：該月份的發票都已產出，結果為
+            {'start', 'end', 'total_count', 'skipped_count', 'filtered_count', 'fetch_failed_count', 'failed_pages', 'error'}
+        """
         if not self.cookies:
             raise Exception("尚未登入，請先呼叫 login()")
 
-        invoices = []
+        self.last_detail_cache_stats = {'hits': 0, 'misses': 0}
+        end_date = min(end_date, datetime.now(TAIPEI_TZ))
+        windows = self.month_windows(start_date, end_date)
+        logger.info(f"回補 {len(windows)} 個月份，同時處理 {self.BACKFILL_WINDOWS} 個")
 
-        # 計算日期範圍 (使用台北時區)
-        from zoneinfo import ZoneInfo
-        taipei_tz = ZoneInfo('Asia/Taipei')
-        end_date = datetime.now(taipei_tz)
-        start_date = end_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        events = queue.Queue(maxsize=self.BACKFILL_QUEUE_SIZE)
+        stopped = threading.Event()  # 呼叫端提前結束迭代時通知工作執行緒停止
 
+        def emit(event: tuple) -> bool:
+            while not stopped.is_set():
+                try:
+                    events.put(event, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
 
-        api_url = "https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/getSearchCarrierInvoiceListJWT"
+        workers = max(1, min(self.BACKFILL_WINDOWS, len(windows)))
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='invoice-backfill')
+        try:
+            for window_start, window_end in windows:
+                executor.submit(self._collect_window, window_start, window_end, known_invoice_numbers, emit)
+
+            remaining = len(windows)
+            while remaining:
+                event = events.get()
+                if event[0] == 'window':
+                    remaining -= 1
+                yield event
+        finally:
+            stopped.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _collect_window(
+        self,
+        start_date: datetime,
+        end_date: datetime,
+        known_invoice_numbers: Optional[Set[str]],
+        emit
+    ):
+        """
+        取得並補齊單一月份的發票，逐張交給 emit，最後交出月份結果（錯誤記錄在結果中，不影響其他月份）
 
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json',
-            'Origin': 'https://www.einvoice.nat.gov.tw',
-            'Referer': 'https://www.einvoice.nat.gov.tw/',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        Args:
+            emit: 交出事件的函數，回傳 False 表示呼叫端已停止迭代
+        """
+        result = {
+            'start': start_date.strftime('%Y-%m-%d'),
+            'end': end_date.strftime('%Y-%m-%d'),
+            'total_count': 0,
+            'skipped_count': 0,
+            'filtered_count': 0,
+            'fetch_failed_count': 0,
+            'failed_pages': [],
+            'error': None
         }
+        new_count = 0
 
-        if self.auth_token:
-            headers['Authorization'] = f'Bearer {self.auth_token}'
+        try:
+            invoice_list, failed_pages = self._fetch_invoice_list(start_date, end_date)
+            result['total_count'] = len(invoice_list)
+            result['failed_pages'] = failed_pages
+
+            pending_list = invoice_list
+            if known_invoice_numbers:
+                pending_list = [item for item in invoice_list if item.get('invoiceNumber', '') not in known_invoice_numbers]
+            result['skipped_count'] = len(invoice_list) - len(pending_list)
+
+            for invoice in self._iter_hydrated(pending_list) if pending_list else []:
+                if isinstance(invoice, InvoiceFetchError):
+                    result['fetch_failed_count'] += 1
+                elif invoice is None:
+                    result['filtered_count'] += 1
+                else:
+                    if not emit(('invoice', result['start'], invoice)):
+                        return
+                    new_count += 1
+
+            logger.info(f"{result['start']} ~ {result['end']}: 取得 {result['total_count']} 筆，新發票 {new_count} 筆")
+        except Exception as e:
+            logger.error(f"回補 {result['start']} ~ {result['end']} 失敗: {e}")
+            result['error'] = str(e)
+
+        emit(('window', result))
+
+    def _fetch_invoice_list(self, start_date: datetime, end_date: datetime) -> tuple[list, list]:
+        """
+        查詢日期範圍內的發票列表（JWT → 第一頁 → 並行取得後續頁面）
+
+        Args:
+            start_date: 查詢起始時間 (含時區)
+            end_date: 查詢結束時間 (含時區)
+
+        Returns:
+            (依頁碼順序合併的發票列表, 重試後仍失敗的頁碼列表)
+        """
+        api_url = f"{self.API_BASE_URL}/btc502w/getSearchCarrierInvoiceListJWT"
 
         # 轉換為 UTC 時間（台北 UTC+8）
-        from datetime import timezone
         start_utc = start_date.astimezone(timezone.utc)
         end_utc = end_date.astimezone(timezone.utc)
 
@@ -516,162 +1187,241 @@ class EInvoiceScraper:
             "searchEndDate": end_utc.strftime('%Y-%m-%dT%H:%M:%S.') + f"{end_utc.microsecond // 1000:03d}Z"
         }
 
-        try:
-            # 步驟1: 取得查詢用的 JWT token
-            logger.info(f"查詢發票列表，日期範圍: {start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}")
-            response = requests.post(api_url, headers=headers, cookies=self.cookies, json=payload, timeout=30)
+        # 步驟1: 取得查詢用的 JWT token
+        logger.info(f"查詢發票列表，日期範圍: {start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}")
+        response = self._post(api_url, json=payload)
 
-            if response.status_code != 200:
-                error_msg = f"取得 JWT token 失敗: HTTP {response.status_code}"
-                logger.error(error_msg)
-                # 清除快取，下次強制重新登入
-                self.clear_session_cache()
-                raise Exception(error_msg)
-
-            jwt_token = response.text.strip()
-
-            # 步驟2: 查詢發票列表
-            search_url = "https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/searchCarrierInvoice"
-            search_headers = {
-                'Accept': 'application/json, text/plain, */*',
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.auth_token}' if self.auth_token else '',
-                'Origin': 'https://www.einvoice.nat.gov.tw',
-                'Referer': 'https://www.einvoice.nat.gov.tw/',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            search_payload = {"token": jwt_token}
+        if response.status_code != 200:
+            error_msg = f"取得 JWT token 失敗: HTTP {response.status_code}"
+            logger.error(error_msg)
+            # 清除快取，下次強制重新登入
+            self.clear_session_cache(self.carrier)
+            raise Exception(error_msg)
 
-            search_response = requests.post(search_url, headers=search_headers, cookies=self.cookies, json=search_payload, timeout=30)
+        jwt_token = response.text.strip()
 
-            if search_response.status_code != 200:
-                error_msg = f"查詢發票列表失敗: HTTP {search_response.status_code}"
-                logger.error(error_msg)
-                # 清除快取，下次強制重新登入
-                self.clear_session_cache()
-                raise Exception(error_msg)
+        # 步驟2: 查詢發票列表
+        search_url = f"{self.API_BASE_URL}/btc502w/searchCarrierInvoice"
+        search_payload = {"token": jwt_token}
 
-            data = search_response.json()
-            invoice_list = data.get('content', [])
+        search_response = self._post(search_url, json=search_payload)
 
-            # 處理分頁 (如果有第2頁以上)
-            total_pages = data.get('totalPages', 0)
-            if total_pages > 1:
-                logger.info(f"發現共有 {total_pages} 頁，開始取得後續頁面...")
-                for page in range(1, total_pages):
-                    try:
-                        # 依據使用者需求：第二頁開始使用 GET 加上 query params: ?page={page}&size=10
-                        page_url = f"{search_url}?page={page}&size=10"
-                        logger.info(f"取得第 {page+1}/{total_pages} 頁: {page_url}")
-                        
-                        page_resp = requests.post(page_url, headers=search_headers, cookies=self.cookies, json=search_payload, timeout=30)
-                        
-                        if page_resp.status_code == 200:
-                            page_data = page_resp.json()
-                            content = page_data.get('content', [])
-                            if content:
-                                invoice_list.extend(content)
-                                logger.info(f"第 {page+1} 頁取得 {len(content)} 筆資料")
-                        else:
-                            logger.warning(f"取得第 {page+1} 頁失敗: HTTP {page_resp.status_code}")
-                    except Exception as e:
-                        logger.error(f"取得第 {page+1} 頁時發生錯誤: {e}")
-            total_count = len(invoice_list)
-            self.last_total_count = total_count  # 儲存總數供外部讀取
-            logger.info(f"API 返回 {total_count} 筆發票")
+        if search_response.status_code != 200:
+            error_msg = f"查詢發票列表失敗: HTTP {search_response.status_code}"
+            logger.error(error_msg)
+            # 清除快取，下次強制重新登入
+            self.clear_session_cache(self.carrier)
+            raise Exception(error_msg)
 
-            # 回報取得列表完成
-            if progress_callback:
-                progress_callback(0, total_count, 'fetching_list', f'取得 {total_count} 筆發票，開始處理...')
+        data = search_response.json()
+        invoice_list = data.get('content', [])
 
-            filtered_count = 0  # 追蹤被過濾的發票數量
+        # 處理分頁 (如果有第2頁以上)，後續頁面並行取得
+        total_pages = data.get('totalPages', 0)
+        failed_pages = []
+        if total_pages > 1:
+            logger.info(f"發現共有 {total_pages} 頁，開始並行取得後續頁面...")
+            remaining, failed_pages = self._fetch_remaining_pages(search_url, search_payload, total_pages)
+            invoice_list.extend(remaining)
 
-            if isinstance(invoice_list, list) and total_count > 0:
-                for idx, item in enumerate(invoice_list, 1):
-                    invoice_token = item.get('token', '')
-                    invoice_number = item.get('invoiceNumber', '')
+        return invoice_list, failed_pages
 
-                    # 回報處理進度
-                    if progress_callback:
-                        progress_callback(idx, total_count, 'processing', f'處理發票 {idx}/{total_count}: {invoice_number}')
-
-                    invoice_date = None
-                    seller_name = None
-                    amount = None
-                    details = None
-
-                    if invoice_token:
-                        invoice_data = self._get_invoice_data(invoice_token)
-                        if invoice_data:
-                            raw_date = invoice_data.get('invoiceDate', '')
-                            raw_time = invoice_data.get('invoiceTime', '')
-
-                            if raw_date and len(raw_date) == 8:
-                                formatted_date = f"{raw_date[:4]}-{raw_date[4:6]}-{raw_date[6:8]}"
-                                if raw_time:
-                                    invoice_date = f"{formatted_date}T{raw_time}+08:00"
-                                else:
-                                    invoice_date = f"{formatted_date}T00:00:00+08:00"
-
-                            total_amount = invoice_data.get('totalAmount', '')
-                            if total_amount:
-                                # 移除千位分隔符逗號後再轉換
-                                amount = int(str(total_amount).replace(',', ''))
-
-                            seller_name = invoice_data.get('sellerName', '')
-                            details = self._get_invoice_details(invoice_token)
-
-                    # Fallback
-                    if not invoice_date:
-                        invoice_date_raw = item.get('invoiceDate', '')
-                        invoice_date = str(invoice_date_raw) if invoice_date_raw else datetime.now().strftime('%Y-%m-%dT%H:%M:%S+08:00')
-
-                    if not seller_name:
-                        seller_name = item.get('sellerName', '未知商店')
-
-                    if amount is None:
-                        # 移除千位分隔符逗號後再轉換
-                        raw_amount = str(item.get('totalAmount', 0)).replace(',', '')
-                        amount = int(raw_amount) if raw_amount else 0
-
-                    # 過濾特定賣家
-                    if seller_name == "幣託科技股份有限公司":
-                        logger.info(f"過濾賣家: {seller_name} (發票: {invoice_number})")
-                        filtered_count += 1
-                        continue
-
-                    invoice = Invoice(
-                        invoice_number=invoice_number,
-                        invoice_date=invoice_date,
-                        seller_name=seller_name,
-                        amount=amount,
-                        details=details
-                    )
-                    invoices.append(invoice)
+    def _fetch_remaining_pages(self, search_url: str, search_payload: dict, total_pages: int) -> tuple[list, list]:
+        """
+        並行取得第 2 頁之後的發票列表
 
-            # 儲存過濾數量供外部讀取
-            self.last_filtered_count = filtered_count
+        Args:
+            search_url: searchCarrierInvoice API 網址
+            search_payload: 與第一頁相同的查詢 payload
+            total_pages: API 回傳的總頁數
 
-            # 記錄處理結果
-            if filtered_count > 0:
-                logger.info(f"成功處理 {len(invoices)} 筆發票（API 返回 {total_count} 筆，已過濾 {filtered_count} 筆）")
+        Returns:
+            (依頁碼順序合併的發票列表, 重試後仍失敗的頁碼列表 (1-based))
+        """
+        def fetch_page(page: int) -> Optional[list]:
+            # 第二頁開始加上 query params: ?page={page}&size=10 (page 為 0-based)
+            page_url = f"{search_url}?page={page}&size=10"
+            # 重試與退避由 _post 統一處理
+            try:
+                page_resp = self._post(page_url, json=search_payload)
+                if page_resp.status_code == 200:
+                    content = page_resp.json().get('content', [])
+                    logger.info(f"第 {page+1}/{total_pages} 頁取得 {len(content)} 筆資料")
+                    return content
+                logger.warning(f"取得第 {page+1} 頁失敗: HTTP {page_resp.status_code}")
+            except Exception as e:
+                logger.warning(f"取得第 {page+1} 頁時發生錯誤: {e}")
+            return None
+
+        pages = list(range(1, total_pages))
+        workers = max(1, min(self.PAGE_WORKERS, len(pages)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='invoice-page') as executor:
+            results = list(executor.map(fetch_page, pages))
+
+        merged = []
+        failed_pages = []
+        for page, content in zip(pages, results):
+            if content is None:
+                failed_pages.append(page + 1)
             else:
-                logger.info(f"成功處理 {len(invoices)} 筆發票")
+                merged.extend(content)
 
-            # 回報處理完成
+        if failed_pages:
+            logger.error(f"共 {len(failed_pages)} 頁重試後仍取得失敗: {failed_pages}")
+
+        return merged, failed_pages
+
+    def _iter_hydrated(self, invoice_list: list, progress_callback=None) -> Iterator[Optional[Invoice]]:
+        """
+        以有上限的並行度補齊發票資料與明細，依列表順序逐筆產出
+
+        同時在途的工作最多為 hydrate_workers 的兩倍，大量發票時記憶體維持平穩
+
+        Args:
+            invoice_list: searchCarrierInvoice 回傳的發票列表
+            progress_callback: 進度回調函數，會在工作執行緒中被呼叫（已加鎖，current 依完成順序遞增）
+
+        Yields:
+            與 invoice_list 同順序的結果，被過濾的發票為 None，資料或明細取得失敗的為 InvoiceFetchError
+        """
+        total_count = len(invoice_list)
+        workers = max(1, min(self.hydrate_workers, total_count))
+        completed = 0
+        progress_lock = threading.Lock()
+
+        def hydrate(item: dict):
+            nonlocal completed
+            try:
+                invoice = self._hydrate_invoice(item)
+            except InvoiceFetchError as e:
+                logger.warning(f"發票 {item.get('invoiceNumber', '')} 本次未處理: {e}")
+                invoice = e
+
+            # 回報處理進度
             if progress_callback:
-                if filtered_count > 0:
-                    progress_callback(total_count, total_count, 'done', f'完成！API 返回 {total_count} 筆，已過濾 {filtered_count} 筆，處理 {len(invoices)} 筆發票')
-                else:
-                    progress_callback(total_count, total_count, 'done', f'完成！共處理 {len(invoices)} 筆發票')
+                with progress_lock:
+                    completed += 1
+                    progress_callback(
+                        completed, total_count, 'processing',
+                        f"處理發票 {completed}/{total_count}: {item.get('invoiceNumber', '')}"
+                    )
+            return invoice
+
+        if workers == 1:
+            for item in invoice_list:
+                yield hydrate(item)
+            return
+
+        logger.info(f"使用 {workers} 個執行緒並行取得發票明細")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='invoice-hydrate') as executor:
+            in_flight = deque()
+            items = iter(invoice_list)
+            for item in itertools.islice(items, workers * 2):
+                in_flight.append(executor.submit(hydrate, item))
+
+            # 依順序取出最前面的結果，每取出一筆就補上一筆新的工作
+            while in_flight:
+                invoice = in_flight.popleft().result()
+                next_item = next(items, None)
+                if next_item is not None:
+                    in_flight.append(executor.submit(hydrate, next_item))
+                yield invoice
+
+    def _load_invoice_payload(self, item: dict) -> tuple[Optional[dict], Optional[str]]:
+        """
+        取得發票資料與明細，優先讀取本機快取（發票開立後內容不會再變動）
 
-        except Exception as e:
-            logger.error(f"取得發票列表時發生錯誤: {e}")
-            # 重新拋出異常，讓上層處理
-            raise
+        Returns:
+            (getCarrierInvoiceData 回傳的資料, 格式化後的明細)
+
+        Raises:
+            InvoiceFetchError: 任一 API 取得失敗
+        """
+        invoice_token = item.get('token', '')
+        cache_key = content_key(item.get('invoiceNumber', ''), item.get('invoiceDate', ''))
+
+        if self.detail_cache is not None:
+            cached = self.detail_cache.get(cache_key)
+            with self._detail_cache_lock:
+                if cached is not None:
+                    self.last_detail_cache_stats['hits'] += 1
+                    return cached['data'], cached['details']
+                self.last_detail_cache_stats['misses'] += 1
+
+        invoice_data = self._get_invoice_data(invoice_token)
+        details = self._get_invoice_details(invoice_token)
+
+        # 兩個 API 都成功才會到這裡，暫時性錯誤的結果不會被永久保存；
+        # 發票資料為空時不寫入快取，下次仍會重新取得正確的日期與金額
+        if self.detail_cache is not None and invoice_data:
+            self.detail_cache.set(cache_key, {'data': invoice_data, 'details': details})
+
+        return invoice_data, details
+
+    def _hydrate_invoice(self, item: dict) -> Optional[Invoice]:
+        """
+        取得單張發票的資料與明細，並組成 Invoice
+
+        Returns:
+            Invoice，若為需過濾的賣家則回傳 None
+
+        Raises:
+            InvoiceFetchError: 發票資料或明細取得失敗（不以今天日期與空明細代替）
+        """
+        invoice_token = item.get('token', '')
+        invoice_number = item.get('invoiceNumber', '')
+
+        invoice_date = None
+        seller_name = None
+        amount = None
+        details = None
+
+        if invoice_token:
+            invoice_data, details = self._load_invoice_payload(item)
+            if invoice_data:
+                raw_date = invoice_data.get('invoiceDate', '')
+                raw_time = invoice_data.get('invoiceTime', '')
+
+                if raw_date and len(raw_date) == 8:
+                    formatted_date = f"{raw_date[:4]}-{raw_date[4:6]}-{raw_date[6:8]}"
+                    if raw_time:
+                        invoice_date = f"{formatted_date}T{raw_time}+08:00"
+                    else:
+                        invoice_date = f"{formatted_date}T00:00:00+08:00"
+
+                total_amount = invoice_data.get('totalAmount', '')
+                if total_amount:
+                    # 移除千位分隔符逗號後再轉換
+                    amount = int(str(total_amount).replace(',', ''))
+
+                seller_name = invoice_data.get('sellerName', '')
+
+        # Fallback
+        if not invoice_date:
+            invoice_date_raw = item.get('invoiceDate', '')
+            invoice_date = str(invoice_date_raw) if invoice_date_raw else datetime.now().strftime('%Y-%m-%dT%H:%M:%S+08:00')
+
+        if not seller_name:
+            seller_name = item.get('sellerName', '未知商店')
+
+        if amount is None:
+            # 移除千位分隔符逗號後再轉換
+            raw_amount = str(item.get('totalAmount', 0)).replace(',', '')
+            amount = int(raw_amount) if raw_amount else 0
+
+        # 過濾特定賣家
+        if seller_name == "幣託科技股份有限公司":
+            logger.info(f"過濾賣家: {seller_name} (發票: {invoice_number})")
+            return None
+
+        return Invoice(
+            invoice_number=invoice_number,
+            invoice_date=invoice_date,
+            seller_name=seller_name,
+            amount=amount,
+            details=details
+        )
 
-        return invoices
-    
     def _get_invoice_data(self, token: str) -> Optional[dict]:
         """
         透過 token 呼叫 getCarrierInvoiceData API 取得發票資料（包含正確的日期）
@@ -680,69 +1430,54 @@ class EInvoiceScraper:
             token: 發票的 JWT token
             
         Returns:
-            包含 invoiceDate 等資訊的 dict，或 None
+            包含 invoiceDate 等資訊的 dict；回應為空時為 None (改用發票列表上的資料)
+
+        Raises:
+            InvoiceFetchError: 請求失敗 (非 200 或發生錯誤)
         """
-        import requests
-        
-        api_url = "https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/common/getCarrierInvoiceData"
-        
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.auth_token}' if self.auth_token else '',
-            'Origin': 'https://www.einvoice.nat.gov.tw',
-            'Referer': 'https://www.einvoice.nat.gov.tw/',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
+        api_url = f"{self.API_BASE_URL}/common/getCarrierInvoiceData"
         
         try:
             # Payload 是發票的 JWT token 字串 (帶雙引號)
-            response = requests.post(
+            response = self._post(
                 api_url,
-                headers=headers,
-                cookies=self.cookies,
                 data=f'"{token}"',
                 timeout=10
             )
             
-            if response.status_code == 200 and response.text:
-                data = response.json()
-                # 回傳整個資料物件
-                return data
-                    
-        except Exception:
-            pass
-        
-        return None
+            if response.status_code == 200:
+                data = response.json() if response.text else None
+                if isinstance(data, dict) and data:
+                    # 回傳整個資料物件
+                    return data
+                return None
+        except Exception as e:
+            raise InvoiceFetchError(f"取得發票資料時發生錯誤: {e}") from e
+
+        raise InvoiceFetchError(f"取得發票資料失敗: HTTP {response.status_code}")
     
-    def _get_invoice_details(self, token: str) -> Optional[str]:
-        """透過 token 取得發票消費明細"""
-        import requests
-        
-        detail_url = "https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/common/getCarrierInvoiceDetail"
-        
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.auth_token}' if self.auth_token else '',
-            'Origin': 'https://www.einvoice.nat.gov.tw',
-            'Referer': 'https://www.einvoice.nat.gov.tw/',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
+    def _get_invoice_details(self, token: str) -> str:
+        """
+        透過 token 取得發票消費明細（沒有明細時為空字串）
+
+        Raises:
+            InvoiceFetchError: 請求失敗 (非 200 或發生錯誤)
+        """
+        detail_url = f"{self.API_BASE_URL}/common/getCarrierInvoiceDetail"
         
         try:
             # Payload 是發票的 JWT token 字串 (不是 JSON 物件)
-            response = requests.post(
+            response = self._post(
                 detail_url,
-                headers=headers,
-                cookies=self.cookies,
                 data=f'"{token}"',  # 直接發送 JWT token 字串 (帶雙引號)
                 timeout=10
             )
             
-            if response.status_code == 200 and response.text:
+            if response.status_code == 200:
+                if not response.text:
+                    return ""
                 data = response.json()
-                content = data.get('content', [])
+                content = data.get('content', []) if isinstance(data, dict) else []
                 if content:
                     # 組合明細資訊: "品名 x數量 $金額; ..."
                     details_list = []
@@ -753,13 +1488,12 @@ class EInvoiceScraper:
                         details_list.append(f"{item_name} x{quantity} ${amount}")
                     
                     return "\n".join(details_list)
-                    
-        except Exception:
-            pass
-        
-        return None
+                return ""
+        except Exception as e:
+            raise InvoiceFetchError(f"取得發票明細時發生錯誤: {e}") from e
+
+        raise InvoiceFetchError(f"取得發票明細失敗: HTTP {response.status_code}")
 
     def close(self):
-        """關閉瀏覽器"""
-        if self.driver:
-            self.driver.quit()
+        """關閉（或歸還常駐）瀏覽器（連線池為程序共用，不在此關閉）"""
+        self._release_driver()
@@ -3,7 +3,7 @@
 提供 API 介面取得電子發票並儲存到 Notion
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional, List
 import time
 import os
@@ -11,6 +11,8 @@ import json
 import asyncio
 import queue
 import threading
+from collections import deque
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
@@ -30,13 +32,42 @@ logging.basicConfig(
 )
 
 # 載入爬蟲和 Notion 服務
-from einvoice_scraper import EInvoiceScraper, Invoice
+from einvoice_scraper import EInvoiceScraper, Invoice, TAIPEI_TZ
 from notion_service import NotionService
-from category_classifier import classify_invoice
+from sync_state import SyncState
+from category_classifier import (
+    CLASSIFY_BATCH_SIZE,
+    classification_cache_stats,
+    classification_pool,
+    classify_provisionally,
+    is_default_classification,
+    merchant_classifier,
+    merchant_classifier_stats,
+    rebuild_merchant_classifier,
+    seller_normalizer,
+)
+from session_refresher import SessionRefresher
+from classification_refiner import ClassificationRefiner
+from session_store import SessionHealth
+from carriers import CarrierConfig, load_carriers
+from openai_client import begin_usage_scope, close_openai_clients, init_openai_clients, latency_stats, usage_stats
+
+# 程序內的 session 更新排程（EINVOICE_SESSION_REFRESH=0 可停用），於 lifespan 啟動，每個載具一個
+SESSION_REFRESH_ENABLED = os.getenv('EINVOICE_SESSION_REFRESH', '1') == '1'
+session_refreshers: dict = {}  # 載具名稱 -> SessionRefresher
+
+# 同步時批次分類：湊滿 CLASSIFY_BATCH_SIZE 張或最早一張已等待 EINVOICE_CLASSIFY_BATCH_WAIT 秒就送出
+CLASSIFY_BATCH_WAIT = float(os.getenv('EINVOICE_CLASSIFY_BATCH_WAIT', '2'))
+
+# 暫定分類模式：先以本機規則 / 快取的分類寫入 Notion，OpenAI 分類於背景修正（EINVOICE_PROVISIONAL_CLASSIFY=1 時同步預設使用此模式）
+PROVISIONAL_CLASSIFY = os.getenv('EINVOICE_PROVISIONAL_CLASSIFY', '0') == '1'
+
+# Notion 店家欄位寫入標準店家名稱（例如「統一超商股份有限公司」→「7-ELEVEN」），EINVOICE_NOTION_CANONICAL_SELLER=0 保留平台原始名稱
+NOTION_CANONICAL_SELLER = os.getenv('EINVOICE_NOTION_CANONICAL_SELLER', '1') == '1'
 
-# Global lock for login process
-login_lock = threading.Lock()
-last_login_attempt = 0
+# 本機店家分類器：每 EINVOICE_MERCHANT_REBUILD_HOURS 小時以最近 EINVOICE_MERCHANT_HISTORY_MONTHS 個月的 Notion 記錄重建
+MERCHANT_REBUILD_INTERVAL = float(os.getenv('EINVOICE_MERCHANT_REBUILD_HOURS', '24')) * 3600
+MERCHANT_HISTORY_MONTHS = int(os.getenv('EINVOICE_MERCHANT_HISTORY_MONTHS', '12'))
 
 
 
@@ -100,10 +131,82 @@ class NotionInvoicesListResponse(BaseModel):
 
 # ============ FastAPI App ============
 
+def rebuild_merchant_model() -> int:
+    """以最近 MERCHANT_HISTORY_MONTHS 個月的 Notion 交易記錄重建本機店家分類器"""
+    start_date = (datetime.now() - timedelta(days=31 * MERCHANT_HISTORY_MONTHS)).strftime('%Y-%m-%d')
+    history = NotionService().get_transaction_history(start_date)
+    count = rebuild_merchant_classifier(history)
+    logger.info(f"店家分類器已重建：{len(history)} 筆記錄，{count} 個店家")
+    return count
+
+
+async def merchant_rebuild_loop():
+    """模型過期時在背景重建（每小時檢查一次）"""
+    while True:
+        if merchant_classifier.is_stale(MERCHANT_REBUILD_INTERVAL):
+            try:
+                await asyncio.to_thread(rebuild_merchant_model)
+            except Exception as e:
+                logger.warning(f"重建店家分類器失敗: {e}")
+        await asyncio.sleep(3600)
+
+
+def update_notion_classification(page_id: str, classification: dict):
+    """背景修正分類後更新 Notion 頁面"""
+    NotionService().update_transaction_classification(page_id, classification["name"], classification["category"])
+
+
+classification_refiner = ClassificationRefiner(
+    # 暫定分類時已計入本機分類器的命中統計，背景修正不重複計算
+    lambda invoices: classification_pool.classify(invoices, record_local=False),
+    update_notion_classification,
+    is_fallback=is_default_classification,
+    batch_size=CLASSIFY_BATCH_SIZE,
+    batch_wait=CLASSIFY_BATCH_WAIT
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """建立共用 OpenAI 用戶端，啟動分類背景修正佇列、各載具的 session 更新排程與店家分類器重建排程，結束時停止排程並關閉常駐瀏覽器"""
+    init_openai_clients()
+    classification_refiner.start()
+    merchant_task = asyncio.create_task(merchant_rebuild_loop()) if merchant_classifier is not None else None
+
+    if SESSION_REFRESH_ENABLED:
+        try:
+            carriers = load_carriers()
+        except ValueError as e:
+            logger.error(f"載具設定錯誤，不啟動 session 更新排程: {e}")
+            carriers = []
+
+        interval = float(os.getenv('EINVOICE_SESSION_REFRESH_INTERVAL', '60'))
+        max_backoff = float(os.getenv('EINVOICE_SESSION_REFRESH_MAX_BACKOFF', '1800'))
+        for carrier in carriers:
+            refresher = SessionRefresher(
+                lambda carrier=carrier: get_scraper(carrier), interval=interval, max_backoff=max_backoff
+            )
+            refresher.start()
+            session_refreshers[carrier.name] = refresher
+
+    try:
+        yield
+    finally:
+        for refresher in session_refreshers.values():
+            await refresher.stop()
+        session_refreshers.clear()
+        if merchant_task is not None:
+            merchant_task.cancel()
+        await classification_refiner.stop()
+        EInvoiceScraper.driver_pool.shutdown()
+        await close_openai_clients()
+
+
 app = FastAPI(
     title="電子發票爬蟲 API",
     description="從財政部電子發票平台爬取發票並儲存到 Notion",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS 設定
@@ -118,15 +221,87 @@ app.add_middleware(
 
 # ============ Helper Functions ============
 
-def get_scraper() -> EInvoiceScraper:
-    """取得爬蟲實例"""
-    phone = os.getenv("EINVOICE_PHONE")
-    password = os.getenv("EINVOICE_PASSWORD")
-    
-    if not phone or not password:
+def get_carriers() -> List[CarrierConfig]:
+    """取得所有設定的載具 (EINVOICE_CARRIERS 或 EINVOICE_PHONE / EINVOICE_PASSWORD)"""
+    try:
+        carriers = load_carriers()
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not carriers:
         raise HTTPException(status_code=500, detail="缺少 EINVOICE_PHONE 或 EINVOICE_PASSWORD 環境變數")
-    
-    return EInvoiceScraper(phone=phone, password=password, headless=True)
+
+    return carriers
+
+
+def get_scraper(carrier: Optional[CarrierConfig] = None) -> EInvoiceScraper:
+    """取得爬蟲實例（未指定載具時使用第一個）"""
+    carrier = carrier or get_carriers()[0]
+    return EInvoiceScraper(phone=carrier.phone, password=carrier.password, headless=True, carrier=carrier.name)
+
+
+def send_event(event_type: str, data: dict) -> str:
+    """格式化 SSE 事件"""
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def put_until_stopped(target: queue.Queue, item, stopped: threading.Event) -> bool:
+    """工作執行緒把項目放入有上限的 queue；串流已結束 (stopped) 時放棄並回傳 False"""
+    while not stopped.is_set():
+        try:
+            target.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no"  # 禁用 nginx 緩衝
+}
+
+
+def get_transaction_time(invoice: Invoice) -> Optional[str]:
+    """從發票日期提取交易時間 (HH:MM)"""
+    if invoice.invoice_date and 'T' in invoice.invoice_date:
+        try:
+            return invoice.invoice_date.split('T')[1][:5]
+        except Exception:
+            pass
+    return None
+
+
+def save_invoice_to_notion(notion: NotionService, invoice: Invoice, classification: dict, carrier_account: str) -> dict:
+    """將已分類的發票寫入 Notion，回傳 saved_invoices 的項目"""
+    # 準備備註（保留平台原始店家名稱）
+    note = invoice.details or f"{invoice.invoice_number} - {invoice.seller_name}"
+    seller_name = seller_normalizer.display_name(invoice.seller_name) if NOTION_CANONICAL_SELLER else invoice.seller_name
+
+    page_id = notion.create_transaction(
+        name=classification["name"],
+        category=classification["category"],
+        date=invoice.invoice_date,
+        amount=-abs(invoice.amount),
+        account=carrier_account,
+        note=note,
+        invoice_number=invoice.invoice_number,
+        seller_name=seller_name
+    )
+
+    return {
+        '日期': invoice.invoice_date,
+        '發票號碼': invoice.invoice_number,
+        '店家': seller_name,
+        '金額': -abs(invoice.amount),
+        '明細': invoice.details,
+        '名稱': classification["name"],
+        '分類': classification["category"],
+        '帳戶': carrier_account,
+        '備註': note,
+        'page_id': page_id
+    }
 
 
 def invoice_to_response(invoice: Invoice) -> InvoiceResponse:
@@ -140,16 +315,111 @@ def invoice_to_response(invoice: Invoice) -> InvoiceResponse:
     )
 
 
+def session_health(carrier: str) -> dict:
+    """載具目前快取 session 的年齡、最近驗證時間與剩餘有效秒數"""
+    store, _ = EInvoiceScraper.session_for(carrier)
+    cache = store.load()
+    if not cache['cookies'] or not cache['cached_at']:
+        return {"cached": False}
+
+    now = time.time()
+    last_validated = SessionHealth.last_validated(cache)
+    expires_at = EInvoiceScraper.session_expires_at(cache)
+    return {
+        "cached": True,
+        "age": round(now - cache['cached_at']),
+        "last_validated": datetime.fromtimestamp(last_validated).isoformat(),
+        "last_validated_ago": round(now - last_validated),
+        "expires_in": max(0, round(expires_at - now))
+    }
+
+
+def carrier_label(run: dict, runs: list) -> str:
+    """多載具時在訊息前加上載具名稱"""
+    return f"[{run['name']}] " if len(runs) > 1 else ""
+
+
+def create_carrier_runs(carriers: List[CarrierConfig], notion: NotionService) -> List[dict]:
+    """為每個載具建立爬蟲與對應的 Notion 帳戶"""
+    runs = []
+    for carrier in carriers:
+        account = carrier.account or notion.get_carrier_account(carrier.name)
+        logger.info(f"載具 {carrier.name} 使用帳戶: {account}")
+        runs.append({
+            'name': carrier.name,
+            'scraper': get_scraper(carrier),
+            'account': account,
+            'sync_state': None,
+            'saved_count': 0,
+            'skipped_count': 0,
+            'scraped_count': 0,
+            'error': None
+        })
+    return runs
+
+
+async def login_carriers(runs: List[dict]) -> List[dict]:
+    """
+    並行登入所有載具（各載具有獨立的 session 與登入鎖）
+
+    Returns:
+        登入成功的載具；失敗的載具會記錄於 run['error']
+    """
+    results = await asyncio.gather(
+        *(asyncio.to_thread(run['scraper'].login) for run in runs),
+        return_exceptions=True
+    )
+    for run, result in zip(runs, results):
+        if isinstance(result, Exception):
+            run['error'] = f'登入失敗: {result}'
+        elif not result:
+            run['error'] = '登入失敗，請檢查帳號密碼'
+        if run['error']:
+            logger.error(f"載具 {run['name']} {run['error']}")
+    return [run for run in runs if not run['error']]
+
+
+def carrier_summary(run: dict) -> dict:
+    """單一載具的同步結果"""
+    scraper = run['scraper']
+    return {
+        'account': run['account'],
+        'saved_count': run['saved_count'],
+        'skipped_count': run['skipped_count'],
+        'scraped_count': run['scraped_count'],
+        'total_count': scraper.last_total_count,
+        'already_synced_count': scraper.last_already_synced_count,
+        'detail_cache': scraper.last_detail_cache_stats,
+        'failed_pages': scraper.last_failed_pages,
+        'fetch_failed_count': scraper.last_fetch_failed_count,
+        'api_stats': scraper.api_stats.snapshot(),
+        'error': run['error']
+    }
+
+
 # ============ API Endpoints ============
 
 @app.get("/health")
 async def health_check():
     """健康檢查"""
-    return {
+    health = {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "version": "1.0.0"
     }
+    if EInvoiceScraper.WARM_DRIVER_ENABLED:
+        health["webdriver"] = EInvoiceScraper.driver_pool.stats()
+    try:
+        health["session"] = {carrier.name: session_health(carrier.name) for carrier in load_carriers()}
+    except ValueError as e:
+        health["session"] = {"error": str(e)}
+    if session_refreshers:
+        health["session_refresher"] = {name: refresher.stats() for name, refresher in session_refreshers.items()}
+    health["classification_pool"] = classification_pool.stats()
+    health["seller_normalizer"] = seller_normalizer.stats()
+    health["openai_latency"] = latency_stats()
+    health["openai_usage"] = usage_stats()
+    return health
 
 
 @app.post("/clear-session")
@@ -159,7 +429,8 @@ async def clear_session():
     
     當報告「儲存0筆跳過0筆重複」時，可以先呼叫此 API 清除快取
     """
-    EInvoiceScraper.clear_session_cache()
+    for carrier in get_carriers():
+        EInvoiceScraper.clear_session_cache(carrier.name)
     logger.info("已清除 session 快取")
     return {
         "success": True,
@@ -168,80 +439,84 @@ async def clear_session():
     }
 
 
-def perform_background_login():
-    """背景執行登入任務"""
-    global last_login_attempt
-    
-    # 再次檢查鎖，雖然 BackgroundTasks 是依序執行，但為了保險
-    if not login_lock.acquire(blocking=False):
-        logger.info("背景登入任務跳過：已有其他登入正在進行")
-        return
-
+def perform_background_login(carrier: CarrierConfig):
+    """背景執行一次 session 檢查（未啟用排程時使用，僅在需要時才重新登入）"""
+    scraper = get_scraper(carrier)
     try:
-        current_time = time.time()
-        # 防止短時間內頻繁重試 (例如 30 秒內不重試)
-        if current_time - last_login_attempt < 30:
-            logger.info("背景登入任務跳過：距離上次嘗試時間過短")
-            return
-
-        last_login_attempt = current_time
-        logger.info("開始執行背景登入流程...")
-        
-        scraper = get_scraper()
-        try:
-            # 強制刷新 Session
-            if scraper.login(force_refresh=True):
-                logger.info("背景登入成功，Session 已更新")
-            else:
-                logger.error("背景登入失敗")
-        except Exception as e:
-            logger.error(f"背景登入發生錯誤: {e}")
-        finally:
-            scraper.close()
-            
+        result = scraper.refresh_session()
+        logger.info(f"背景 session 檢查結果 ({carrier.name}): {result}")
+    except Exception as e:
+        logger.error(f"背景登入發生錯誤 ({carrier.name}): {e}")
     finally:
-        login_lock.release()
+        scraper.close()
 
 
 @app.get("/ensure-session")
 async def ensure_session(background_tasks: BackgroundTasks):
     """
-    不管 Session 是否有效，強制觸發背景登入以更新 Session
-    
-    為了防止 cron-job.org 超時 (30s)，此 API 會立即回應：
-    - 202 Accepted (並在背景開始登入)
+    確認各載具的 Session 可用：有效時不做任何事，接近到期時探測，失效才在背景重新登入
+
+    Session 平時由程序內排程維護，此 API 僅保留給外部排程相容使用，且會立即回應（避免 cron-job.org 30s 逾時）
     """
-    # 這裡只需要做簡單的狀態回報，不需要初始化 scraper
-    
+    carriers = get_carriers()
+
     try:
-        # 強制觸發背景登入，不檢查快取
-        
-        # 檢查是否已有登入正在進行
-        if login_lock.locked():
+        # 已有登入正在進行的載具不重複觸發
+        triggered = []
+        for carrier in carriers:
+            store, _ = EInvoiceScraper.session_for(carrier.name)
+            if store.login_lock.locked():
+                continue
+            if carrier.name in session_refreshers:
+                background_tasks.add_task(session_refreshers[carrier.name].refresh_once)
+            else:
+                background_tasks.add_task(perform_background_login, carrier)
+            triggered.append(carrier.name)
+
+        if not triggered:
             return {
                 "status": "pending",
                 "message": "登入程序已在背景執行中",
                 "timestamp": datetime.now().isoformat()
             }
-            
-        # 觸發背景登入
-        background_tasks.add_task(perform_background_login)
-        
-        # 立即回應
+
         return {
             "status": "accepted",
-            "message": "已觸發背景強制登入排程",
+            "message": "已觸發背景 Session 檢查",
+            "carriers": triggered,
             "timestamp": datetime.now().isoformat()
         }
-    
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Session 檢查失敗: {str(e)}")
-    
-    finally:
-        # 這裡不需要 close，因為 scraper 只是用來檢查 session，沒有啟動瀏覽器
-        # 如果 _try_cached_session 啟動了什麼資源，應該在那裡處理
-        # 目前 scraper 在沒 login 前幾乎沒有資源占用
-        pass
+
+
+@app.post("/merchant-classifier/rebuild")
+async def rebuild_merchant_classifier_endpoint():
+    """立即以 Notion 歷史交易重建本機店家分類器（例如手動修正大量分類之後）"""
+    if merchant_classifier is None:
+        raise HTTPException(status_code=400, detail="本機店家分類器未啟用 (EINVOICE_MERCHANT_CLASSIFIER=0)")
+
+    try:
+        count = await asyncio.to_thread(rebuild_merchant_model)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"重建店家分類器失敗: {str(e)}")
+
+    return {
+        "success": True,
+        "message": f"店家分類器已重建，共 {count} 個店家",
+        "stats": merchant_classifier_stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+@app.get("/classification-refinements")
+async def classification_refinements():
+    """暫定分類的背景修正狀態 (pending 為尚未以 OpenAI 修正的筆數)"""
+    return {
+        **classification_refiner.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
 
 
 @app.get("/notion-invoices", response_model=NotionInvoicesListResponse)
@@ -254,7 +529,7 @@ async def get_notion_invoices(year: int = None, month: int = None):
     """
     try:
         notion = NotionService()
-        invoices = notion.get_invoices_for_month(year, month)
+        invoices = await asyncio.to_thread(notion.get_invoices_for_month, year, month)
 
         return NotionInvoicesListResponse(
             success=True,
@@ -267,13 +542,21 @@ async def get_notion_invoices(year: int = None, month: int = None):
 
 
 @app.get("/scrape-and-save-stream")
-async def scrape_and_save_stream():
+async def scrape_and_save_stream(full_resync: bool = False, provisional: Optional[bool] = None):
     """
     執行爬蟲取得當月發票並儲存到 Notion（SSE 串流版本）
+
+    設定多個載具 (EINVOICE_CARRIERS) 時會並行登入與取得所有載具的發票，
+    各載具的發票寫入各自對應的 Notion 帳戶
+
+    預設為增量同步：先前已同步過的發票不會再取得明細與檢查 Notion
+    - full_resync: 設為 true 時忽略同步狀態，重新處理當月所有發票
+    - provisional: 設為 true 時不等待 OpenAI，先以本機規則 / 快取的暫定分類寫入，
+      OpenAI 分類於背景修正（進度見 /classification-refinements，預設依 EINVOICE_PROVISIONAL_CLASSIFY）
     
     使用 Server-Sent Events 即時回傳進度：
     - event: progress - 進度更新
-    - event: result - 最終結果
+    - event: result - 最終結果 (carriers 欄位為各載具的結果)
     - event: error - 錯誤訊息
     
     前端使用方式：
@@ -290,33 +573,46 @@ async def scrape_and_save_stream():
     });
     ```
     """
-    
+    carriers = get_carriers()
+    if provisional is None:
+        provisional = PROVISIONAL_CLASSIFY
+
     async def generate():
-        scraper = get_scraper()
+        sync_usage = begin_usage_scope()  # 此次同步的 OpenAI token 用量與延遲
         notion = NotionService()
+        runs = await asyncio.to_thread(create_carrier_runs, carriers, notion)
 
-        # 取得載具帳戶
-        carrier_account = notion.get_carrier_account()
-        logger.info(f"使用載具帳戶: {carrier_account}")
+        # 載入各載具的增量同步狀態
+        for run in runs:
+            run['sync_state'] = SyncState.for_carrier(run['name'])
+            if full_resync:
+                run['sync_state'].reset()
+        if full_resync:
+            logger.info("完整重新同步，忽略先前的同步狀態")
 
         saved_count = 0
         skipped_count = 0
         scraped_count = 0
         saved_invoices = []
         progress_queue = queue.Queue()
+        classifying = deque()  # 分類中的 (batch, task)，依送出順序寫入 Notion
+        provisional_count = 0
+        stopped = threading.Event()
+        fetch_threads = []
         
-        def send_event(event_type: str, data: dict):
-            """格式化 SSE 事件"""
-            return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
-        
-        def progress_callback(current, total, stage, message):
+        def make_progress_callback(run: dict):
             """進度回調 - 放入 queue 供 async generator 使用"""
-            progress_queue.put({
-                'current': current,
-                'total': total,
-                'stage': stage,
-                'message': message
-            })
+            label = carrier_label(run, runs)
+
+            def progress_callback(current, total, stage, message):
+                progress_queue.put({
+                    'current': current,
+                    'total': total,
+                    'stage': stage,
+                    'message': f"{label}{message}",
+                    'carrier': run['name']
+                })
+            return progress_callback
         
         try:
             # 發送開始事件
@@ -327,30 +623,23 @@ async def scrape_and_save_stream():
                 'message': '正在登入財政部電子發票平台...'
             })
             
-            # 登入（在背景執行緒中執行）
-            login_success = False
-            login_error = None
-            
-            def do_login():
-                nonlocal login_success, login_error
-                try:
-                    login_success = scraper.login()
-                except Exception as e:
-                    login_error = str(e)
-            
-            login_thread = threading.Thread(target=do_login)
-            login_thread.start()
-            
-            while login_thread.is_alive():
-                await asyncio.sleep(0.5)
-            
-            if login_error:
-                yield send_event('error', {'message': f'登入失敗: {login_error}'})
-                return
-            
-            if not login_success:
-                yield send_event('error', {'message': '登入失敗，請檢查帳號密碼'})
+            # 並行登入所有載具（在背景執行緒中執行）
+            active_runs = await login_carriers(runs)
+            if not active_runs:
+                yield send_event('error', {
+                    'message': '；'.join(f"{carrier_label(run, runs)}{run['error']}" for run in runs)
+                })
                 return
+
+            for run in runs:
+                if run['error']:
+                    yield send_event('progress', {
+                        'current': 0,
+                        'total': 0,
+                        'stage': 'login',
+                        'message': f"{carrier_label(run, runs)}{run['error']}，略過此載具",
+                        'carrier': run['name']
+                    })
             
             yield send_event('progress', {
                 'current': 0,
@@ -359,118 +648,206 @@ async def scrape_and_save_stream():
                 'message': '登入成功，正在取得發票列表...'
             })
             
-            # 取得發票（在背景執行緒中執行）
-            invoices = []
-            fetch_error = None
-            
-            def do_fetch():
-                nonlocal invoices, fetch_error
+            # 先一次取得 Notion 中當月已存在的發票號碼，讓爬蟲跳過這些發票的明細取得，重複檢查也直接查集合
+            try:
+                month_start = datetime.now(TAIPEI_TZ).strftime('%Y-%m-01')
+                known_invoice_numbers = await asyncio.to_thread(notion.prefetch_invoice_numbers, month_start)
+            except Exception as e:
+                logger.warning(f"取得 Notion 既有發票失敗，改為逐筆檢查: {e}")
+                known_invoice_numbers = set()
+
+            # 各載具在各自的背景執行緒取得發票，每補齊一張就放入共用 queue，分類與寫入 Notion 可與取得明細同時進行
+            # queue 有上限，寫入較慢時取得明細會等待；串流結束 (包含用戶端中斷) 時 stopped 通知執行緒停止
+            invoice_queue = queue.Queue(maxsize=EInvoiceScraper.BACKFILL_QUEUE_SIZE)
+
+            def do_fetch(run: dict):
+                fetched_invoices = run['scraper'].iter_invoices(
+                    progress_callback=make_progress_callback(run),
+                    sync_state=run['sync_state'],
+                    known_invoice_numbers=known_invoice_numbers
+                )
                 try:
-                    invoices = scraper.get_invoices(progress_callback=progress_callback)  # noqa: F841
+                    for fetched in fetched_invoices:
+                        if not put_until_stopped(invoice_queue, (run, fetched), stopped):
+                            break
                 except Exception as e:
-                    fetch_error = str(e)
-                    logger.error(f"取得發票失敗: {fetch_error}")
-            
-            fetch_thread = threading.Thread(target=do_fetch)
-            fetch_thread.start()
+                    run['error'] = f'取得發票失敗: {e}'
+                    logger.error(f"載具 {run['name']} 取得發票失敗: {e}")
+                finally:
+                    fetched_invoices.close()  # 提前結束時讓爬蟲停止取得剩餘的明細
+                    put_until_stopped(invoice_queue, (run, None), stopped)  # 結束標記
+
+            for run in active_runs:
+                thread = threading.Thread(target=do_fetch, args=(run,))
+                fetch_threads.append(thread)
+                thread.start()
             
-            # 持續發送進度更新
-            while fetch_thread.is_alive() or not progress_queue.empty():
+            idx = 0
+            finished = 0
+            pending = []  # 等待批次分類的 (run, invoice, idx)
+            pending_since = 0.0
+
+            def start_classification():
+                """把等待中的發票交給分類池，不等待結果（多個批次可同時分類）"""
+                batch = pending[:]
+                pending.clear()
+                task = asyncio.create_task(classification_pool.classify([
+                    {
+                        'seller_name': invoice.seller_name,
+                        'details': invoice.details or "",
+                        'transaction_time': get_transaction_time(invoice)
+                    }
+                    for _, invoice, _ in batch
+                ]))
+                classifying.append((batch, task))
+
+                pending_total = max(sum(r['scraper'].last_pending_count for r in active_runs), idx)
+                return send_event('progress', {
+                    'current': batch[-1][2],
+                    'total': pending_total,
+                    'stage': 'classifying',
+                    'message': f'分類發票 {len(batch)} 筆 ({batch[0][2]}-{batch[-1][2]}/{pending_total})'
+                })
+
+            async def save_one(run: dict, invoice: Invoice, classification: dict) -> dict:
+                """儲存到 Notion（寫入該載具對應的帳戶，在背景執行緒執行不阻塞分類請求），回傳 saved_invoices 的項目"""
+                nonlocal saved_count
+                saved = await asyncio.to_thread(save_invoice_to_notion, notion, invoice, classification, run['account'])
+                saved_invoices.append(saved)
+                run['sync_state'].mark_synced(invoice.invoice_number, invoice.invoice_date)
+                saved_count += 1
+                run['saved_count'] += 1
+                return saved
+
+            def saved_event(run: dict, invoice_idx: int, classification: dict, pending_total: int) -> str:
+                return send_event('progress', {
+                    'current': invoice_idx,
+                    'total': pending_total,
+                    'stage': 'saving',
+                    'message': f'{carrier_label(run, runs)}已儲存 {invoice_idx}/{pending_total}: {classification["name"]}',
+                    'carrier': run['name']
+                })
+
+            async def save_classified():
+                """依送出順序將已分類完成的批次寫入 Notion"""
+                while classifying and classifying[0][1].done():
+                    batch, task = classifying.popleft()
+                    classifications = task.result()
+                    pending_total = max(sum(r['scraper'].last_pending_count for r in active_runs), idx)
+
+                    for (run, invoice, invoice_idx), classification in zip(batch, classifications):
+                        await save_one(run, invoice, classification)
+                        yield saved_event(run, invoice_idx, classification, pending_total)
+
+            while finished < len(active_runs) or pending or classifying:
+                # 持續發送進度更新
+                while not progress_queue.empty():
+                    yield send_event('progress', progress_queue.get_nowait())
+
+                # 湊滿一批、等待過久或已取得所有發票時才送出分類，讓首次同步的大量發票合併成少數幾次請求
+                all_fetched = finished == len(active_runs)
+                if pending and (all_fetched or len(pending) >= CLASSIFY_BATCH_SIZE or time.time() - pending_since >= CLASSIFY_BATCH_WAIT):
+                    yield start_classification()
+
+                async for event in save_classified():
+                    yield event
+
+                if all_fetched:
+                    if classifying:
+                        await asyncio.wait([classifying[0][1]], timeout=0.1)
+                    continue
+
                 try:
-                    progress = progress_queue.get_nowait()
-                    yield send_event('progress', progress)
+                    run, invoice = invoice_queue.get_nowait()
                 except queue.Empty:
                     await asyncio.sleep(0.1)
-            
-            if fetch_error:
-                yield send_event('error', {'message': f'取得發票失敗: {fetch_error}'})
-                return
-            
-            scraped_count = len(invoices)
+                    continue
 
-            # 簡化進度訊息：只顯示總發票數
-            saving_message = f'取得 {scraper.last_total_count} 筆發票，開始儲存到 Notion...'
+                if invoice is None:
+                    finished += 1
+                    continue
 
-            yield send_event('progress', {
-                'current': 0,
-                'total': scraped_count,
-                'stage': 'saving',
-                'message': saving_message
-            })
-            
-            # 儲存到 Notion
-            for idx, invoice in enumerate(invoices, 1):
-                # 檢查是否已存在
-                if notion.invoice_exists(invoice.invoice_number):
+                idx += 1
+                scraped_count = idx
+                run['scraped_count'] += 1
+                pending_total = max(sum(r['scraper'].last_pending_count for r in active_runs), idx)
+
+                # 檢查是否已存在；無法確認時本次略過 (不標記已同步，下次同步再處理)
+                try:
+                    exists = await asyncio.to_thread(notion.invoice_exists, invoice.invoice_number, invoice.invoice_date)
+                except Exception as e:
+                    logger.warning(f"檢查發票 {invoice.invoice_number} 是否重複失敗，本次略過: {e}")
                     skipped_count += 1
+                    run['skipped_count'] += 1
                     yield send_event('progress', {
                         'current': idx,
-                        'total': scraped_count,
+                        'total': pending_total,
                         'stage': 'saving',
-                        'message': f'跳過重複發票 {idx}/{scraped_count}: {invoice.invoice_number}'
+                        'message': f'{carrier_label(run, runs)}無法確認是否重複，略過 {idx}/{pending_total}: {invoice.invoice_number}',
+                        'carrier': run['name']
                     })
                     continue
-                
-                # 從發票日期提取時間
-                transaction_time = None
-                if invoice.invoice_date and 'T' in invoice.invoice_date:
-                    try:
-                        time_part = invoice.invoice_date.split('T')[1][:5]
-                        transaction_time = time_part
-                    except:
-                        pass
-                
-                yield send_event('progress', {
-                    'current': idx,
-                    'total': scraped_count,
-                    'stage': 'classifying',
-                    'message': f'分類發票 {idx}/{scraped_count}: {invoice.seller_name}'
-                })
-                
-                # 使用 OpenAI 分類
-                classification = classify_invoice(
-                    seller_name=invoice.seller_name,
-                    details=invoice.details or "",
-                    transaction_time=transaction_time
-                )
-                
-                # 準備備註
-                note = invoice.details or f"{invoice.invoice_number} - {invoice.seller_name}"
-                
-                # 儲存到 Notion
-                notion.create_transaction(
-                    name=classification["name"],
-                    category=classification["category"],
-                    date=invoice.invoice_date,
-                    amount=-abs(invoice.amount),
-                    account=carrier_account,
-                    note=note,
-                    invoice_number=invoice.invoice_number,
-                    seller_name=invoice.seller_name
-                )
 
-                saved_count += 1
-                saved_invoices.append({
-                    '日期': invoice.invoice_date,
-                    '發票號碼': invoice.invoice_number,
-                    '店家': invoice.seller_name,
-                    '金額': -abs(invoice.amount),
-                    '明細': invoice.details,
-                    '名稱': classification["name"],
-                    '分類': classification["category"],
-                    '帳戶': carrier_account,
-                    '備註': note
-                })
-                
-                yield send_event('progress', {
-                    'current': idx,
-                    'total': scraped_count,
-                    'stage': 'saving',
-                    'message': f'已儲存 {idx}/{scraped_count}: {classification["name"]}'
+                if exists:
+                    skipped_count += 1
+                    run['skipped_count'] += 1
+                    run['sync_state'].mark_synced(invoice.invoice_number, invoice.invoice_date)
+                    yield send_event('progress', {
+                        'current': idx,
+                        'total': pending_total,
+                        'stage': 'saving',
+                        'message': f'{carrier_label(run, runs)}跳過重複發票 {idx}/{pending_total}: {invoice.invoice_number}',
+                        'carrier': run['name']
+                    })
+                    continue
+
+                if provisional:
+                    # 先以暫定分類寫入，需要 OpenAI 的交由背景修正
+                    invoice_input = {
+                        'seller_name': invoice.seller_name,
+                        'details': invoice.details or "",
+                        'transaction_time': get_transaction_time(invoice)
+                    }
+                    (classification, needs_refinement), = await asyncio.to_thread(classify_provisionally, [invoice_input])
+                    saved = await save_one(run, invoice, classification)
+                    if needs_refinement:
+                        classification_refiner.submit(saved['page_id'], invoice_input, classification)
+                        provisional_count += 1
+                    yield saved_event(run, idx, classification, pending_total)
+                    continue
+
+                if not pending:
+                    pending_since = time.time()
+                pending.append((run, invoice, idx))
+
+            # 送出剩餘的進度更新
+            while not progress_queue.empty():
+                yield send_event('progress', progress_queue.get_nowait())
+
+            for run in active_runs:
+                run['skipped_count'] += run['scraper'].last_known_skipped_count
+                skipped_count += run['scraper'].last_known_skipped_count
+
+            if all(run['error'] for run in active_runs):
+                yield send_event('error', {
+                    'message': '；'.join(f"{carrier_label(run, runs)}{run['error']}" for run in active_runs),
+                    'saved_count': saved_count,
+                    'skipped_count': skipped_count,
+                    'scraped_count': scraped_count
                 })
+                return
             
             # 簡化最終結果訊息：只顯示新增數量和總發票數
-            result_message = f'新增 {saved_count} 筆（共 {scraper.last_total_count} 筆發票）'
+            total_count = sum(run['scraper'].last_total_count for run in active_runs)
+            result_message = f'新增 {saved_count} 筆（共 {total_count} 筆發票）'
+            for run in runs:
+                label = carrier_label(run, runs)
+                if run['error']:
+                    result_message += f"，{label}{run['error']}"
+                elif run['scraper'].last_failed_pages:
+                    result_message += f"，{label}第 {', '.join(map(str, run['scraper'].last_failed_pages))} 頁取得失敗"
+                if not run['error'] and run['scraper'].last_fetch_failed_count:
+                    result_message += f"，{label}{run['scraper'].last_fetch_failed_count} 筆明細取得失敗，下次同步重試"
 
             yield send_event('result', {
                 'success': True,
@@ -478,6 +855,14 @@ async def scrape_and_save_stream():
                 'saved_count': saved_count,
                 'skipped_count': skipped_count,
                 'scraped_count': scraped_count,
+                'already_synced_count': sum(run['scraper'].last_already_synced_count for run in active_runs),
+                'carriers': {run['name']: carrier_summary(run) for run in runs},
+                'classification_cache': classification_cache_stats(),
+                'merchant_classifier': merchant_classifier_stats(),
+                'openai_latency': latency_stats(),
+                'openai_usage': sync_usage.snapshot(),
+                'provisional_count': provisional_count,
+                'pending_refinements': classification_refiner.pending,
                 'saved_invoices': saved_invoices
             })
             
@@ -492,17 +877,252 @@ async def scrape_and_save_stream():
             })
         
         finally:
-            scraper.close()
+            stopped.set()
+            # 中途失敗時尚未寫入的批次不需要再分類
+            for _, task in classifying:
+                task.cancel()
+
+            def finish_runs():
+                # 等取得發票的執行緒結束 (它們也會更新同步狀態) 後才儲存狀態並關閉瀏覽器；
+                # 在背景執行緒等待，用戶端中斷時不阻塞 event loop
+                for thread in fetch_threads:
+                    thread.join()
+                # 只有成功處理的發票會被記錄，因此中途失敗也可安全儲存
+                for run in runs:
+                    try:
+                        if run['sync_state'] is not None:
+                            run['sync_state'].save()
+                    except Exception as e:
+                        logger.error(f"儲存同步狀態失敗 ({run['name']}): {e}")
+                    run['scraper'].close()
+
+            threading.Thread(target=finish_runs).start()
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"  # 禁用 nginx 緩衝
-        }
-    )
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.get("/backfill-stream")
+async def backfill_stream(start: str, end: Optional[str] = None):
+    """
+    回補任意日期範圍的發票並儲存到 Notion（SSE 串流版本）
+
+    所有載具並行回補，日期範圍會依月份切段並行查詢，每個月份完成後立即儲存並回傳：
+    - event: progress - 進度更新
+    - event: window - 單一載具的單一月份完成 (carrier, start, end, scraped_count, saved_count, skipped_count, fetch_failed_count, failed_pages, error)
+    - event: result - 最終結果
+    - event: error - 錯誤訊息
+
+    - start: 起始日期 (YYYY-MM-DD)
+    - end: 結束日期 (YYYY-MM-DD，預設為今天，晚於今天時以今天為準)
+    """
+    try:
+        start_date = datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=TAIPEI_TZ)
+        end_date = (
+            datetime.strptime(end, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=TAIPEI_TZ)
+            if end else datetime.now(TAIPEI_TZ)
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日期格式錯誤，請使用 YYYY-MM-DD")
+
+    # 與爬蟲相同，結束日期超過現在時以現在為準，回報的月份數才會與實際處理的一致
+    end_date = min(end_date, datetime.now(TAIPEI_TZ))
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="起始日期不可晚於結束日期")
+
+    carriers = get_carriers()
+
+    async def generate():
+        sync_usage = begin_usage_scope()  # 此次同步的 OpenAI token 用量與延遲
+        notion = NotionService()
+        runs = await asyncio.to_thread(create_carrier_runs, carriers, notion)
+
+        saved_count = 0
+        skipped_count = 0
+        scraped_count = 0
+        saved_invoices = []
+        # 工作執行緒交出的 (run, 事件)；有上限，Notion 寫入較慢時回補會等待而不是把整個範圍的發票堆在記憶體中
+        window_queue = queue.Queue(maxsize=EInvoiceScraper.BACKFILL_QUEUE_SIZE)
+        stopped = threading.Event()  # 串流結束 (包含用戶端中斷) 時通知工作執行緒停止
+
+        try:
+            yield send_event('progress', {
+                'current': 0,
+                'total': 0,
+                'stage': 'login',
+                'message': '正在登入財政部電子發票平台...'
+            })
+
+            active_runs = await login_carriers(runs)
+            if not active_runs:
+                yield send_event('error', {
+                    'message': '；'.join(f"{carrier_label(run, runs)}{run['error']}" for run in runs)
+                })
+                return
+
+            # 一次取得範圍內 Notion 已存在的發票號碼 (自動翻頁)
+            windows = EInvoiceScraper.month_windows(start_date, end_date)
+            windows_total = len(windows) * len(active_runs)
+            try:
+                known_invoice_numbers = await asyncio.to_thread(
+                    notion.prefetch_invoice_numbers,
+                    start_date.strftime('%Y-%m-%d'),
+                    (end_date + timedelta(days=1)).strftime('%Y-%m-%d')
+                )
+            except Exception as e:
+                logger.warning(f"取得 Notion 既有發票失敗，改為逐筆檢查: {e}")
+                known_invoice_numbers = set()
+
+            yield send_event('progress', {
+                'current': 0,
+                'total': windows_total,
+                'stage': 'fetching',
+                'message': f'登入成功，開始回補 {len(windows)} 個月份...'
+            })
+
+            def do_backfill(run: dict):
+                events = run['scraper'].iter_backfill(start_date, end_date, known_invoice_numbers)
+                try:
+                    for event in events:
+                        if not put_until_stopped(window_queue, (run, event), stopped):
+                            break
+                except Exception as e:
+                    run['error'] = f'回補失敗: {e}'
+                    logger.error(f"載具 {run['name']} 回補失敗: {e}")
+                finally:
+                    events.close()  # 提前結束時讓爬蟲停止各月份的工作執行緒
+                    put_until_stopped(window_queue, (run, None), stopped)
+
+            for run in active_runs:
+                threading.Thread(target=do_backfill, args=(run,)).start()
+
+            window_counts = {}  # (載具, 月份起始日) -> 該月份的 scraped / saved / skipped
+            pending = {run['name']: [] for run in active_runs}  # 各載具等待分類的 (發票, 月份起始日)
+
+            async def save_pending(run: dict):
+                """將該載具等待中的新發票批次分類後寫入 Notion"""
+                nonlocal saved_count
+                batch = pending[run['name']]
+                pending[run['name']] = []
+                if not batch:
+                    return
+
+                classifications = await classification_pool.classify([
+                    {
+                        'seller_name': invoice.seller_name,
+                        'details': invoice.details or "",
+                        'transaction_time': get_transaction_time(invoice)
+                    }
+                    for invoice, _ in batch
+                ])
+                for (invoice, window_start), classification in zip(batch, classifications):
+                    saved_invoices.append(await asyncio.to_thread(
+                        save_invoice_to_notion, notion, invoice, classification, run['account']
+                    ))
+                    known_invoice_numbers.add(invoice.invoice_number)
+                    window_counts[(run['name'], window_start)]['saved'] += 1
+                    saved_count += 1
+                    run['saved_count'] += 1
+
+            windows_done = 0
+            finished = 0
+            while finished < len(active_runs):
+                try:
+                    run, event = window_queue.get_nowait()
+                except queue.Empty:
+                    await asyncio.sleep(0.1)
+                    continue
+
+                if event is None:
+                    await save_pending(run)
+                    finished += 1
+                    continue
+
+                if event[0] == 'invoice':
+                    _, window_start, invoice = event
+                    counts = window_counts.setdefault((run['name'], window_start), {'scraped': 0, 'saved': 0, 'skipped': 0})
+                    counts['scraped'] += 1
+                    scraped_count += 1
+                    run['scraped_count'] += 1
+
+                    try:
+                        exists = await asyncio.to_thread(notion.invoice_exists, invoice.invoice_number, invoice.invoice_date)
+                    except Exception as e:
+                        logger.warning(f"檢查發票 {invoice.invoice_number} 是否重複失敗，本次略過: {e}")
+                        exists = True
+                    if exists:
+                        counts['skipped'] += 1
+                        skipped_count += 1
+                        run['skipped_count'] += 1
+                        continue
+
+                    pending[run['name']].append((invoice, window_start))
+                    if len(pending[run['name']]) >= CLASSIFY_BATCH_SIZE:
+                        await save_pending(run)
+                    continue
+
+                # 月份完成：先寫入該載具剩餘的新發票，再回報該月份的結果
+                _, window = event
+                await save_pending(run)
+                windows_done += 1
+                counts = window_counts.pop((run['name'], window['start']), {'scraped': 0, 'saved': 0, 'skipped': 0})
+                window_skipped = counts['skipped'] + window['skipped_count']
+                skipped_count += window['skipped_count']
+                run['skipped_count'] += window['skipped_count']
+
+                yield send_event('window', {
+                    'carrier': run['name'],
+                    'start': window['start'],
+                    'end': window['end'],
+                    'scraped_count': counts['scraped'],
+                    'saved_count': counts['saved'],
+                    'skipped_count': window_skipped,
+                    'fetch_failed_count': window['fetch_failed_count'],
+                    'failed_pages': window['failed_pages'],
+                    'error': window['error']
+                })
+                yield send_event('progress', {
+                    'current': windows_done,
+                    'total': windows_total,
+                    'stage': 'saving',
+                    'message': f"{carrier_label(run, runs)}{window['start'][:7]} 完成，新增 {counts['saved']} 筆 ({windows_done}/{windows_total})",
+                    'carrier': run['name']
+                })
+
+            if all(run['error'] for run in active_runs):
+                yield send_event('error', {
+                    'message': '；'.join(f"{carrier_label(run, runs)}{run['error']}" for run in active_runs)
+                })
+                return
+
+            yield send_event('result', {
+                'success': True,
+                'message': f'回補完成，新增 {saved_count} 筆',
+                'saved_count': saved_count,
+                'skipped_count': skipped_count,
+                'scraped_count': scraped_count,
+                'carriers': {run['name']: carrier_summary(run) for run in runs},
+                'classification_cache': classification_cache_stats(),
+                'merchant_classifier': merchant_classifier_stats(),
+                'openai_latency': latency_stats(),
+                'openai_usage': sync_usage.snapshot(),
+                'saved_invoices': saved_invoices
+            })
+
+        except Exception as e:
+            logger.error(f"回補發票時發生錯誤: {e}")
+            yield send_event('error', {
+                'message': str(e),
+                'saved_count': saved_count,
+                'skipped_count': skipped_count,
+                'scraped_count': scraped_count
+            })
+
+        finally:
+            stopped.set()
+            for run in runs:
+                run['scraper'].close()
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 # ============ 直接執行 ============
@@ -0,0 +1,190 @@
+"""
+本機店家分類器
+從 Notion 歷史交易（包含手動修正過的分類）學習「店家 → 名稱 / 分類」，
+對熟悉且分類一致的店家直接回答，不確定的才交給 OpenAI
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+from typing import Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LABEL_SEPARATOR = "\x1f"
+# 依交易時段決定的餐飲名稱，不可從其他時段的記錄推論
+MEAL_NAMES = {"早餐", "午餐", "晚餐", "宵夜"}
+
+
+def char_ngrams(text: str, n: int = 2) -> set:
+    """字元 n-gram（長度不足 n 時以整個字串為一個 gram）"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def ngram_similarity(a: set, b: set) -> float:
+    """Dice 係數"""
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class MerchantClassifier:
+    """
+    店家分類索引
+
+    - 每個正規化店家記錄各時段 (早 / 午 / 晚 / 宵夜) 與整體的 (名稱, 分類) 次數
+    - 信心 = 最多次的標籤次數 / (總次數 + 1)，出現次數少或分類不一致的店家信心自然偏低
+    - 歷史上出現過多種分類的店家 (例如便利商店) 要看買了什麼才能判斷，信心為 0，只作為暫定猜測
+    - 未見過的店家以字元 bigram 相似度找最接近的已知店家，信心再乘上相似度
+    """
+
+    def __init__(self, path: str, similarity_threshold: float = 0.6):
+        """
+        Args:
+            path: 模型 JSON 檔路徑
+            similarity_threshold: 未見過的店家採用相似店家的最低相似度
+        """
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self.built_at: Optional[float] = None
+        self.merchants: dict = {}  # 店家 -> {"total": {標籤: 次數}, "buckets": {時段: {標籤: 次數}}}
+        self._ngrams: dict = {}    # 店家 -> bigram 集合
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """從模型檔載入，不存在或損毀時為空模型"""
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._replace(data.get('merchants', {}), data.get('built_at'))
+            logger.info(f"載入店家分類模型：{len(self.merchants)} 個店家")
+        except Exception as e:
+            logger.warning(f"讀取店家分類模型失敗: {e}")
+
+    def save(self):
+        """原子寫入模型檔"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.merchant_model.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'built_at': self.built_at, 'merchants': self.merchants}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def build(self, records: Iterable[Tuple[str, str, str, str]]) -> int:
+        """
+        以歷史記錄重建索引
+
+        Args:
+            records: (正規化店家, 時段, 名稱, 分類) 的序列
+
+        Returns:
+            索引中的店家數
+        """
+        merchants: dict = {}
+        for seller, bucket, name, category in records:
+            if not seller or not name or not category:
+                continue
+            label = f"{name}{LABEL_SEPARATOR}{category}"
+            entry = merchants.setdefault(seller, {'total': {}, 'buckets': {}})
+            entry['total'][label] = entry['total'].get(label, 0) + 1
+            bucket_counts = entry['buckets'].setdefault(bucket, {})
+            bucket_counts[label] = bucket_counts.get(label, 0) + 1
+
+        self._replace(merchants, time.time())
+        return len(merchants)
+
+    def _replace(self, merchants: dict, built_at: Optional[float]):
+        ngrams = {seller: char_ngrams(seller) for seller in merchants}
+        with self._lock:
+            self.merchants = merchants
+            self._ngrams = ngrams
+            self.built_at = built_at
+
+    def predict(self, seller: str, bucket: str = '') -> Tuple[Optional[dict], float]:
+        """
+        預測名稱與分類
+
+        Args:
+            seller: 正規化店家名稱
+            bucket: 交易時段
+
+        Returns:
+            ({"name": ..., "category": ...}, 信心 0~1)；完全無法判斷時為 (None, 0.0)
+        """
+        with self._lock:
+            merchants = self.merchants
+            ngrams = self._ngrams
+
+        similarity = 1.0
+        entry = merchants.get(seller)
+        if entry is None:
+            grams = char_ngrams(seller)
+            best_seller, similarity = None, 0.0
+            for candidate, candidate_grams in ngrams.items():
+                score = ngram_similarity(grams, candidate_grams)
+                if score > similarity:
+                    best_seller, similarity = candidate, score
+            if best_seller is None or similarity < self.similarity_threshold:
+                return None, 0.0
+            entry = merchants[best_seller]
+
+        # 同時段有足夠記錄時優先使用（餐飲名稱依時段而定），否則使用整體分布
+        counts = entry['buckets'].get(bucket) or {}
+        from_bucket = sum(counts.values()) >= 2
+        if not from_bucket:
+            counts = entry['total']
+
+        label, top = Counter(counts).most_common(1)[0]
+        name, category = label.split(LABEL_SEPARATOR, 1)
+        if not from_bucket and name in MEAL_NAMES:
+            # 此時段記錄不足，不以其他時段的餐別回答 (例如午餐店家的晚餐交易)
+            return None, 0.0
+        if not self.is_single_category(entry):
+            # 只憑店家與時段無法判斷明細 (例如便利商店的衛生紙與午餐)，猜測不直接採用
+            return {"name": name, "category": category}, 0.0
+        confidence = top / (sum(counts.values()) + 1) * similarity
+        return {"name": name, "category": category}, confidence
+
+    @staticmethod
+    def is_single_category(entry: dict) -> bool:
+        """店家的歷史記錄是否都屬於同一個分類"""
+        return len({label.split(LABEL_SEPARATOR, 1)[1] for label in entry['total']}) <= 1
+
+    def record(self, hit: bool):
+        """記錄一次查詢是否由本機分類器回答"""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def is_stale(self, max_age: float) -> bool:
+        """模型是否超過 max_age 秒未重建"""
+        return self.built_at is None or time.time() - self.built_at > max_age
+
+    def stats(self) -> dict:
+        """模型大小與命中統計"""
+        lookups = self.hits + self.misses
+        return {
+            'merchants': len(self.merchants),
+            'built_at': self.built_at,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+        }
@@ -5,6 +5,7 @@ Notion API 服務
 
 import os
 import requests
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -33,6 +34,11 @@ class NotionService:
         
         # 快取帳戶 ID
         self._account_cache = {}
+        self._carrier_accounts = None  # 被標記為載具帳戶的帳戶名稱
+
+        # 預先取得的發票號碼與涵蓋的日期範圍 (起始含、結束不含，None 為不限)
+        self._known_invoice_numbers = None
+        self._known_window = None
     
     def _query_database(self, database_id: str, filter_obj: dict = None) -> list:
         """查詢資料庫"""
@@ -63,6 +69,14 @@ class NotionService:
         
         return response.json()["id"]
     
+    def _update_page(self, page_id: str, properties: dict):
+        """更新頁面屬性"""
+        url = f"{self.BASE_URL}/pages/{page_id}"
+        response = requests.patch(url, headers=self.headers, json={"properties": properties})
+        
+        if response.status_code != 200:
+            raise Exception(f"Notion API 錯誤: {response.status_code} - {response.text}")
+    
     def get_account_id(self, account_name: str) -> str:
         """根據帳戶名稱取得帳戶頁面 ID"""
         if account_name in self._account_cache:
@@ -86,47 +100,101 @@ class NotionService:
         else:
             raise ValueError(f"找不到帳戶: {account_name}")
 
-    def get_carrier_account(self) -> str:
-        """取得被標記為載具帳戶的帳戶名稱，若無則回傳 Unicard"""
+    def get_carrier_account(self, carrier_name: str = None) -> str:
+        """
+        取得被標記為載具帳戶的帳戶名稱，若無則回傳 Unicard
+
+        有多個載具帳戶時，優先回傳帳戶名稱與 carrier_name 相同者，否則回傳第一個
+        """
         if not self.accounts_db_id:
             return "Unicard"
 
         try:
-            results = self._query_database(
-                self.accounts_db_id,
-                {
-                    "property": "載具帳戶",
-                    "checkbox": {"equals": True}
-                }
-            )
+            if self._carrier_accounts is None:
+                results = self._query_database(
+                    self.accounts_db_id,
+                    {
+                        "property": "載具帳戶",
+                        "checkbox": {"equals": True}
+                    }
+                )
+                self._carrier_accounts = []
+                for result in results:
+                    props = result.get("properties", {})
+                    if props.get("帳戶名稱", {}).get("title"):
+                        self._carrier_accounts.append(props["帳戶名稱"]["title"][0].get("text", {}).get("content", "Unicard"))
 
-            if results:
-                props = results[0].get("properties", {})
-                if props.get("帳戶名稱", {}).get("title"):
-                    return props["帳戶名稱"]["title"][0].get("text", {}).get("content", "Unicard")
+            if carrier_name in self._carrier_accounts:
+                return carrier_name
+            if self._carrier_accounts:
+                return self._carrier_accounts[0]
 
             return "Unicard"
         except Exception:
             return "Unicard"
     
-    def invoice_exists(self, invoice_number: str) -> bool:
-        """檢查發票是否已存在"""
-        try:
-            results = self._query_database(
-                self.transactions_db_id,
-                {
-                    "property": "發票號碼",
-                    "rich_text": {"contains": invoice_number}
-                }
-            )
-            return len(results) > 0
-        except Exception:
+    def prefetch_invoice_numbers(self, start_date: str, end_date: str = None) -> set:
+        """
+        一次取得日期範圍內所有已存在的發票號碼（自動翻頁），之後範圍內的 invoice_exists 直接查集合
+
+        回傳的集合會隨 create_transaction 更新，可直接交給爬蟲跳過已存在的發票
+
+        Args:
+            start_date: 起始日期 (YYYY-MM-DD，含)
+            end_date: 結束日期 (YYYY-MM-DD，不含)，預設不限
+        """
+        # Notion 以 UTC 比較日期，多查前一天避免遺漏台北時間凌晨的交易
+        query_start = (datetime.strptime(start_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        self._known_invoice_numbers = self.get_invoice_numbers(query_start, end_date)
+        self._known_window = (start_date, end_date)
+        return self._known_invoice_numbers
+
+    def get_invoice_numbers(self, start_date: str, end_date: str = None) -> set:
+        """取得日期範圍內所有交易的發票號碼（自動翻頁）"""
+        pages = self._query_all(self.transactions_db_id, {"filter": self._invoice_date_filter(start_date, end_date)})
+        invoice_numbers = set()
+        for page in pages:
+            rich_text = page.get("properties", {}).get("發票號碼", {}).get("rich_text", [])
+            invoice_number = "".join(part.get("text", {}).get("content", "") for part in rich_text).strip()
+            if invoice_number:
+                invoice_numbers.add(invoice_number)
+        return invoice_numbers
+
+    def _in_known_window(self, invoice_date: str) -> bool:
+        if self._known_window is None or not invoice_date:
             return False
+        start_date, end_date = self._known_window
+        date = invoice_date[:10]
+        return date >= start_date and (end_date is None or date < end_date)
+
+    def invoice_exists(self, invoice_number: str, invoice_date: str = None) -> bool:
+        """
+        檢查發票是否已存在
+
+        發票日期在 prefetch_invoice_numbers 的範圍內時直接查集合，否則以發票號碼完全比對查詢 Notion；
+        查詢失敗時拋出例外，避免誤判為不存在而重複寫入
+
+        Args:
+            invoice_number: 發票號碼
+            invoice_date: 發票日期 (YYYY-MM-DD 開頭)
+        """
+        if self._known_invoice_numbers is not None:
+            if invoice_number in self._known_invoice_numbers:
+                return True
+            if self._in_known_window(invoice_date):
+                return False
+
+        results = self._query_database(
+            self.transactions_db_id,
+            {
+                "property": "發票號碼",
+                "rich_text": {"equals": invoice_number}
+            }
+        )
+        return len(results) > 0
 
     def get_invoices_for_month(self, year: int = None, month: int = None) -> list:
         """取得指定月份有發票號碼的交易記錄"""
-        from datetime import datetime
-
         if year is None or month is None:
             now = datetime.now()
             year = now.year
@@ -176,45 +244,112 @@ class NotionService:
         # 解析結果
         invoices = []
         for page in results:
-            props = page.get("properties", {})
-
-            # 取得各欄位值
-            invoice_number = ""
-            if props.get("發票號碼", {}).get("rich_text"):
-                invoice_number = props["發票號碼"]["rich_text"][0].get("text", {}).get("content", "")
-
-            if not invoice_number:
-                continue
-
-            name = ""
-            if props.get("名稱", {}).get("title"):
-                name = props["名稱"]["title"][0].get("text", {}).get("content", "")
-
-            category = ""
-            if props.get("分類", {}).get("select"):
-                category = props["分類"]["select"].get("name", "")
-
-            date_str = ""
-            if props.get("日期", {}).get("date"):
-                date_str = props["日期"]["date"].get("start", "")
-
-            amount = props.get("金額", {}).get("number", 0) or 0
-
-            seller = ""
-            if props.get("店家", {}).get("rich_text"):
-                seller = props["店家"]["rich_text"][0].get("text", {}).get("content", "")
-
-            invoices.append({
-                "id": page["id"],
-                "日期": date_str,
-                "發票號碼": invoice_number,
-                "店家": seller,
-                "金額": int(amount),
-                "名稱": name,
-                "分類": category
-            })
+            invoice = self._parse_invoice_page(page)
+            if invoice:
+                invoices.append(invoice)
+
+        return invoices
+
+    def get_transaction_history(self, start_date: str, end_date: str = None) -> list:
+        """
+        取得日期範圍內所有有發票號碼的交易記錄（自動翻頁），格式同 get_invoices_for_month 並多了「備註」
+
+        Args:
+            start_date: 起始日期 (YYYY-MM-DD，含)
+            end_date: 結束日期 (YYYY-MM-DD，不含)，預設不限
+        """
+        pages = self._query_all(self.transactions_db_id, {"filter": self._invoice_date_filter(start_date, end_date)})
+
+        invoices = []
+        for page in pages:
+            invoice = self._parse_invoice_page(page)
+            if invoice:
+                props = page.get("properties", {})
+                invoice["備註"] = "".join(
+                    part.get("text", {}).get("content", "") for part in props.get("備註", {}).get("rich_text", [])
+                )
+                invoices.append(invoice)
 
         return invoices
+
+    @staticmethod
+    def _invoice_date_filter(start_date: str, end_date: str = None) -> dict:
+        """有發票號碼且日期在範圍內 (起始含、結束不含) 的篩選條件"""
+        conditions = [
+            {
+                "property": "發票號碼",
+                "rich_text": {"is_not_empty": True}
+            },
+            {
+                "property": "日期",
+                "date": {"on_or_after": start_date}
+            }
+        ]
+        if end_date:
+            conditions.append({
+                "property": "日期",
+                "date": {"before": end_date}
+            })
+        return {"and": conditions}
+
+    def _query_all(self, database_id: str, payload: dict) -> list:
+        """查詢資料庫並依 next_cursor 取得所有頁面"""
+        url = f"{self.BASE_URL}/databases/{database_id}/query"
+        payload = {**payload, "page_size": 100}
+        results = []
+
+        while True:
+            response = requests.post(url, headers=self.headers, json=payload)
+
+            if response.status_code != 200:
+                raise Exception(f"Notion API 錯誤: {response.status_code} - {response.text}")
+
+            data = response.json()
+            results.extend(data.get("results", []))
+            if not data.get("has_more") or not data.get("next_cursor"):
+                return results
+            payload["start_cursor"] = data["next_cursor"]
+
+    @staticmethod
+    def _parse_invoice_page(page: dict) -> dict:
+        """解析交易頁面，沒有發票號碼時回傳 None"""
+        props = page.get("properties", {})
+
+        # 取得各欄位值
+        invoice_number = ""
+        if props.get("發票號碼", {}).get("rich_text"):
+            invoice_number = props["發票號碼"]["rich_text"][0].get("text", {}).get("content", "")
+
+        if not invoice_number:
+            return None
+
+        name = ""
+        if props.get("名稱", {}).get("title"):
+            name = props["名稱"]["title"][0].get("text", {}).get("content", "")
+
+        category = ""
+        if props.get("分類", {}).get("select"):
+            category = props["分類"]["select"].get("name", "")
+
+        date_str = ""
+        if props.get("日期", {}).get("date"):
+            date_str = props["日期"]["date"].get("start", "")
+
+        amount = props.get("金額", {}).get("number", 0) or 0
+
+        seller = ""
+        if props.get("店家", {}).get("rich_text"):
+            seller = props["店家"]["rich_text"][0].get("text", {}).get("content", "")
+
+        return {
+            "id": page["id"],
+            "日期": date_str,
+            "發票號碼": invoice_number,
+            "店家": seller,
+            "金額": int(amount),
+            "名稱": name,
+            "分類": category
+        }
     
     def create_transaction(
         self,
@@ -264,7 +399,21 @@ class NotionService:
                 "rich_text": [{"text": {"content": invoice_number}}]
             }
         
-        return self._create_page(self.transactions_db_id, properties)
+        page_id = self._create_page(self.transactions_db_id, properties)
+        if invoice_number and self._known_invoice_numbers is not None:
+            self._known_invoice_numbers.add(invoice_number)
+        return page_id
+
+    def update_transaction_classification(self, page_id: str, name: str, category: str):
+        """更新交易記錄的名稱與分類"""
+        self._update_page(page_id, {
+            "名稱": {
+                "title": [{"text": {"content": name}}]
+            },
+            "分類": {
+                "select": {"name": category}
+            }
+        })
 
 
 if __name__ == "__main__":
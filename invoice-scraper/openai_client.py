@@ -0,0 +1,234 @@
+"""
+共用 OpenAI 用戶端
+整個程序共用一組同步 / 非同步用戶端（連線池），並記錄各用途的請求延遲分布與 token 用量
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger(__name__)
+
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '30'))          # 預設每次請求逾時秒數
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '2'))     # SDK 內建的重試次數
+
+# 估算費用用的單價 (美元 / 百萬 tokens，預設為 gpt-4.1-mini)
+PRICE_INPUT_PER_1M = float(os.getenv('OPENAI_PRICE_INPUT_PER_1M', '0.4'))
+PRICE_OUTPUT_PER_1M = float(os.getenv('OPENAI_PRICE_OUTPUT_PER_1M', '1.6'))
+
+
+def percentile(values: list, pct: float) -> float:
+    """取百分位數 (最近秩法)，values 不可為空"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))]
+
+
+_client_lock = threading.Lock()
+_sync_client: Optional[OpenAI] = None
+_async_client: Optional[AsyncOpenAI] = None
+
+
+def get_openai_client() -> OpenAI:
+    """取得共用的同步用戶端（第一次呼叫時建立，會從環境變數 OPENAI_API_KEY 讀取）"""
+    global _sync_client
+    if _sync_client is None:
+        with _client_lock:
+            if _sync_client is None:
+                _sync_client = OpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+    return _sync_client
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """取得共用的非同步用戶端"""
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncOpenAI(timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+    return _async_client
+
+
+def init_openai_clients() -> bool:
+    """服務啟動時先建立用戶端，缺少 API key 時回傳 False (之後使用時再建立)"""
+    try:
+        get_openai_client()
+        get_async_openai_client()
+        return True
+    except Exception as e:
+        logger.warning(f"建立 OpenAI 用戶端失敗: {e}")
+        return False
+
+
+async def close_openai_clients():
+    """關閉共用用戶端的連線池"""
+    global _sync_client, _async_client
+    with _client_lock:
+        sync_client, async_client = _sync_client, _async_client
+        _sync_client = _async_client = None
+
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None:
+        await async_client.close()
+
+
+class LatencyHistogram:
+    """請求延遲分布：固定區間的累計次數 + 最近樣本的百分位數（執行緒安全）"""
+
+    BUCKETS_MS = (100, 250, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self, max_samples: int = 1000):
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self._samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+
+    def observe(self, seconds: float, error: bool = False):
+        """記錄一次請求"""
+        elapsed_ms = seconds * 1000
+        index = next((i for i, bound in enumerate(self.BUCKETS_MS) if elapsed_ms <= bound), len(self.BUCKETS_MS))
+        with self._lock:
+            self._counts[index] += 1
+            self._samples.append(elapsed_ms)
+            self.count += 1
+            self.total_ms += elapsed_ms
+            if error:
+                self.errors += 1
+
+    def snapshot(self) -> dict:
+        """次數、錯誤數、平均 / p50 / p95 與各區間次數"""
+        with self._lock:
+            samples = sorted(self._samples)
+            counts = list(self._counts)
+            count, errors, total_ms = self.count, self.errors, self.total_ms
+
+        labels = [f"<={bound}ms" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        return {
+            'count': count,
+            'errors': errors,
+            'mean_ms': round(total_ms / count, 1) if count else None,
+            'p50_ms': round(percentile(samples, 50), 1) if samples else None,
+            'p95_ms': round(percentile(samples, 95), 1) if samples else None,
+            'buckets': dict(zip(labels, counts))
+        }
+
+
+_histograms: dict = {}
+_histograms_lock = threading.Lock()
+
+
+def get_histogram(name: str) -> LatencyHistogram:
+    """取得指定用途 (classify / classify_batch / captcha...) 的延遲分布"""
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram()
+        return _histograms[name]
+
+
+class UsageTracker:
+    """各用途的請求數、token 用量、延遲與估算費用累計（執行緒安全）"""
+
+    FIELDS = ('calls', 'errors', 'prompt_tokens', 'completion_tokens', 'cached_prompt_tokens', 'latency_ms')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage: dict = {}  # 用途 -> {欄位: 累計值}
+
+    def add(self, name: str, **amounts):
+        with self._lock:
+            entry = self._usage.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+            for field, amount in amounts.items():
+                entry[field] += amount
+
+    def snapshot(self) -> dict:
+        """各用途與合計 (total) 的用量"""
+        with self._lock:
+            usage = {name: dict(entry) for name, entry in self._usage.items()}
+
+        total = dict.fromkeys(self.FIELDS, 0)
+        for entry in usage.values():
+            for field in self.FIELDS:
+                total[field] += entry[field]
+        if usage:
+            usage['total'] = total
+
+        for entry in usage.values():
+            latency_ms = entry.pop('latency_ms')
+            entry['total_tokens'] = entry['prompt_tokens'] + entry['completion_tokens']
+            entry['mean_latency_ms'] = round(latency_ms / entry['calls'], 1) if entry['calls'] else None
+            entry['estimated_cost_usd'] = round(
+                (entry['prompt_tokens'] * PRICE_INPUT_PER_1M + entry['completion_tokens'] * PRICE_OUTPUT_PER_1M) / 1e6, 6
+            )
+        return usage
+
+
+_usage = UsageTracker()
+_scope_usage: ContextVar[Optional[UsageTracker]] = ContextVar('openai_scope_usage', default=None)
+
+
+def begin_usage_scope() -> UsageTracker:
+    """
+    開始新的用量累計範圍（例如一次同步），回傳該範圍的 UsageTracker
+
+    範圍涵蓋目前的 context，以及之後從這裡建立的 asyncio task 與 to_thread 執行緒
+    """
+    tracker = UsageTracker()
+    _scope_usage.set(tracker)
+    return tracker
+
+
+def _trackers() -> list:
+    scope = _scope_usage.get()
+    return [_usage, scope] if scope is not None else [_usage]
+
+
+def record_usage(name: str, usage) -> None:
+    """記錄回覆中的 usage 欄位 (沒有時略過)"""
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    amounts = {
+        'prompt_tokens': usage.prompt_tokens or 0,
+        'completion_tokens': usage.completion_tokens or 0,
+        'cached_prompt_tokens': (getattr(details, 'cached_tokens', None) or 0) if details else 0
+    }
+    for tracker in _trackers():
+        tracker.add(name, **amounts)
+
+
+def usage_stats() -> dict:
+    """程序啟動以來各用途的 token 用量"""
+    return _usage.snapshot()
+
+
+@contextmanager
+def track_latency(name: str):
+    """記錄區塊耗時，區塊拋出例外時計為錯誤（同步與 async 函數內皆可使用）"""
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        get_histogram(name).observe(elapsed, error=error)
+        for tracker in _trackers():
+            tracker.add(name, calls=1, errors=int(error), latency_ms=elapsed * 1000)
+
+
+def latency_stats() -> dict:
+    """各用途的延遲分布"""
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    return {name: histogram.snapshot() for name, histogram in histograms.items()}
@@ -0,0 +1,100 @@
+"""
+電子發票平台 API 速率限制
+以 token bucket 限制整個程序對平台的請求速率（所有爬蟲實例與執行緒共用），並依節流訊號自動調整
+"""
+
+import time
+import threading
+
+
+class RateLimiter:
+    """Token bucket 速率限制器（執行緒安全）"""
+
+    def __init__(self, rate: float, burst: int):
+        """
+        Args:
+            rate: 每秒補充的 token 數 (<= 0 表示不限制)
+            burst: bucket 容量，允許的瞬間請求數
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token，不足時等待"""
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait_seconds = (1 - self._tokens) / self.rate
+
+            time.sleep(wait_seconds)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    自適應速率限制器 (AIMD)
+
+    - 遇到節流訊號 (429 / 5xx / 逾時) 時速率減半
+    - 請求成功時逐步加回，最高不超過 max_rate
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float = 1.0, increase_step: float = 0.5):
+        """
+        Args:
+            rate: 初始 (同時也是最高) 每秒請求數
+            burst: bucket 容量
+            min_rate: 節流時最低的每秒請求數
+            increase_step: 每次成功時增加的每秒請求數
+        """
+        super().__init__(rate, burst)
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate) if rate > 0 else 0
+        self.increase_step = increase_step
+
+    def on_success(self):
+        """請求成功：緩慢放寬速率"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        """遇到節流：速率減半並清空 bucket，讓後續請求先等待"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+
+
+class EndpointStats:
+    """各 API 端點的請求 / 重試 / 節流 / 連線錯誤 / 放棄次數統計（執行緒安全）"""
+
+    FIELDS = ('requests', 'retries', 'throttles', 'errors', 'give_ups')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, endpoint: str, field: str):
+        """累加某端點的某項統計"""
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, dict.fromkeys(self.FIELDS, 0))
+            stats[field] += 1
+
+    def snapshot(self) -> dict:
+        """目前的統計 {端點: {requests, retries, throttles, errors, give_ups}}"""
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
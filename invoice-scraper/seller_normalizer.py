@@ -0,0 +1,222 @@
+"""
+店家名稱正規化
+將平台上的店家名稱（公司型態字尾、分店 / 分公司、全半形與台臺差異）對應到標準店家 ID，
+供分類快取鍵、本機店家分類器與 Notion 店家欄位共用
+"""
+
+import os
+import re
+import json
+import logging
+import unicodedata
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 內建別名表：店家 ID -> (顯示名稱, 別名)；別名須完全相同，或後面只接分店名稱，例如「統一超商台北南京門市」對應 7-eleven
+BUILTIN_ALIASES = {
+    '7-eleven': ('7-ELEVEN', ['統一超商', '7-eleven', '7eleven', '7-11', 'seven-eleven']),
+    'familymart': ('全家便利商店', ['全家便利商店', '全家便利', 'familymart']),
+    'hi-life': ('萊爾富', ['萊爾富國際', '萊爾富', 'hi-life']),
+    'okmart': ('OK超商', ['來來超商', 'ok超商', 'okmart']),
+    'pxmart': ('全聯', ['全聯實業', '全聯福利中心', '全聯', 'pxmart']),
+    'carrefour': ('家樂福', ['家樂福', 'carrefour']),
+    'costco': ('好市多', ['好市多', 'costco']),
+    'starbucks': ('星巴克', ['統一星巴克', '星巴克咖啡', '星巴克', 'starbucks']),
+    'louisa': ('路易莎', ['路易莎職人咖啡', '路易莎', 'louisa']),
+    'mcdonalds': ('麥當勞', ['麥當勞', 'mcdonald']),
+    'cpc': ('台灣中油', ['台灣中油', '中油']),
+    'formosa-petrochemical': ('台塑石油', ['台塑石化', '台塑石油']),
+    'taipei-metro': ('台北捷運', ['台北大眾捷運', '台北捷運']),
+    'thsr': ('台灣高鐵', ['台灣高速鐵路', '台灣高鐵']),
+    'tra': ('台鐵', ['台灣鐵路', '交通部台灣鐵路管理局', '台鐵']),
+    'cht': ('中華電信', ['中華電信']),
+    'taipower': ('台灣電力', ['台灣電力', '台電']),
+    'uniqlo': ('UNIQLO', ['優衣庫', 'uniqlo']),
+    'tkec': ('燦坤', ['燦坤實業', '燦坤']),
+    'eslite': ('誠品', ['誠品生活', '誠品']),
+    'netflix': ('Netflix', ['netflix international', 'netflix']),
+    'spotify': ('Spotify', ['spotify']),
+    'openai': ('OpenAI', ['openai']),
+    'uber': ('Uber', ['uber']),
+    'uber-eats': ('Uber Eats', ['ubereats']),
+    'foodpanda': ('foodpanda', ['foodpanda', '富胖達']),
+}
+
+# 公司型態字尾；英文字尾需以空白或逗號與店名隔開，避免誤刪店名結尾 (例如 kebab)
+LEGAL_SUFFIX_PATTERN = re.compile(
+    r'(\s*(股份有限公司|有限責任公司|有限公司|分公司|公司|企業社|商行|工作室)|'
+    r'[\s,]+(co\.?,?\s*ltd\.?|ltd\.?|inc\.?|llc|corp\.?|corporation|b\.v\.|gmbh|pte\.?|ab))$',
+    re.IGNORECASE
+)
+# 分店：以分隔符號接在後面的「XX店 / XX門市 / XX站」、結尾的括號、「公司XX分公司」
+# 英數字之間的連字號屬於品牌名稱 (7-ELEVEN、Hi-Life)，不視為分隔符號
+BRANCH_PATTERNS = (
+    re.compile(r'\s*(?<![A-Za-z0-9])[-_/|]\s*[^-_/|]*?(店|門市|分店|分公司|營業所|站)$'),
+    re.compile(r'\s*[(\[【][^)\]】]*[)\]】]$'),
+    re.compile(r'(股份有限公司|有限公司|公司).{1,10}?分公司$'),
+)
+KEY_STRIP_PATTERN = re.compile(r'[\s.,·・\'"]')
+# 別名後面允許接的分店名稱 (沒有分隔符號，例如「統一超商台北南京門市」)
+BRANCH_REMAINDER_PATTERN = re.compile(r'^.{1,12}?(店|門市|分店|分公司|營業所|營業處|站|服務區)$')
+# 不超過此長度的別名只接受完全相同，避免「中油化工」、「全聯通訊」之類的店家被併入
+SHORT_ALIAS_LENGTH = 2
+
+
+def strip_legal_suffix(seller_name: str) -> str:
+    """全半形與台臺統一後去除公司型態字尾（保留分店名稱）"""
+    name = unicodedata.normalize('NFKC', seller_name or '').strip().replace('臺', '台')
+    return LEGAL_SUFFIX_PATTERN.sub('', name).strip()
+
+
+def clean_seller_name(seller_name: str) -> str:
+    """去除公司型態字尾與分店名稱（保留大小寫，作為顯示名稱）"""
+    name = unicodedata.normalize('NFKC', seller_name or '').strip().replace('臺', '台')
+    for _ in range(3):  # 字尾可能層層相疊，例如「XX股份有限公司(南京門市)」
+        previous = name
+        for pattern in BRANCH_PATTERNS:
+            name = pattern.sub('', name).strip()
+        name = LEGAL_SUFFIX_PATTERN.sub('', name).strip()
+        if name == previous:
+            break
+    # 全部被去除時（例如店名就叫「公司」）保留原本的名稱
+    return name or unicodedata.normalize('NFKC', seller_name or '').strip()
+
+
+def seller_key(seller_name: str) -> str:
+    """比對用的鍵：小寫並去除空白與標點"""
+    return KEY_STRIP_PATTERN.sub('', seller_name.lower())
+
+
+def alias_covers(key: str, alias_length: int) -> bool:
+    """開頭長度 alias_length 的別名是否代表整個店家名稱：完全相同，或較長的別名後面只接分店名稱"""
+    remainder = key[alias_length:]
+    if not remainder:
+        return True
+    return alias_length > SHORT_ALIAS_LENGTH and BRANCH_REMAINDER_PATTERN.match(remainder) is not None
+
+
+class SellerMatch(NamedTuple):
+    merchant_id: str   # 標準店家 ID (已知店家為別名表的 ID，其餘為正規化後的名稱)
+    display_name: str  # 寫入 Notion 店家欄位的名稱
+    known: bool        # 是否由別名表比對到
+
+
+class AliasTrie:
+    """別名字元 trie，找出名稱開頭最長的已知別名"""
+
+    _END = '\0'
+
+    def __init__(self):
+        self._root: dict = {}
+        self.size = 0
+
+    def insert(self, alias: str, merchant_id: str):
+        node = self._root
+        for char in alias:
+            node = node.setdefault(char, {})
+        if self._END not in node:
+            self.size += 1
+        node[self._END] = merchant_id
+
+    def prefixes(self, key: str) -> List[Tuple[int, str]]:
+        """key 開頭的所有別名，回傳 (別名長度, 店家 ID)，由長到短"""
+        node = self._root
+        found = []
+        for length, char in enumerate(key, 1):
+            node = node.get(char)
+            if node is None:
+                break
+            if self._END in node:
+                found.append((length, node[self._END]))
+        return found[::-1]
+
+
+class SellerNormalizer:
+    """店家名稱 → 標準店家 ID / 顯示名稱"""
+
+    def __init__(self, aliases: Optional[dict] = None, cache_size: int = 4096):
+        """
+        Args:
+            aliases: {店家 ID: (顯示名稱, [別名, ...])}，預設為內建別名表
+            cache_size: 查詢結果的 LRU 快取大小 (0 為不快取)
+        """
+        self._trie = AliasTrie()
+        self._display_names: dict = {}
+        self.match = lru_cache(maxsize=cache_size)(self._match) if cache_size else self._match
+        self.add_aliases(BUILTIN_ALIASES if aliases is None else aliases)
+
+    def add_aliases(self, aliases: dict):
+        """加入別名 {店家 ID: (顯示名稱, [別名, ...])}，顯示名稱本身也視為別名"""
+        for merchant_id, (display_name, names) in aliases.items():
+            self._display_names[merchant_id] = display_name
+            for alias in [display_name, *names]:
+                key = seller_key(clean_seller_name(alias))
+                if key:
+                    self._trie.insert(key, merchant_id)
+        if hasattr(self.match, 'cache_clear'):
+            self.match.cache_clear()
+
+    def load_alias_file(self, path: str) -> int:
+        """
+        從 JSON 檔加入自訂別名，格式: {"店家 ID": {"name": "顯示名稱", "aliases": ["別名", ...]}}
+
+        Returns:
+            加入的店家數
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.add_aliases({
+            merchant_id: (entry.get('name') or merchant_id, entry.get('aliases') or [])
+            for merchant_id, entry in data.items()
+        })
+        return len(data)
+
+    def _match(self, seller_name: str) -> SellerMatch:
+        cleaned = clean_seller_name(seller_name)
+        key = seller_key(cleaned)
+        # 先以保留分店名稱的寫法比對別名，分店規則誤判時（例如「7-ELEVEN/台北站前門市」）仍能對應到已知店家
+        for candidate in dict.fromkeys((seller_key(strip_legal_suffix(seller_name)), key)):
+            for length, merchant_id in self._trie.prefixes(candidate):
+                if alias_covers(candidate, length):
+                    return SellerMatch(merchant_id, self._display_names[merchant_id], True)
+        return SellerMatch(key, cleaned, False)
+
+    def canonical_id(self, seller_name: str) -> str:
+        """標準店家 ID"""
+        return self.match(seller_name or '').merchant_id
+
+    def display_name(self, seller_name: str) -> str:
+        """標準顯示名稱"""
+        return self.match(seller_name or '').display_name
+
+    def stats(self) -> dict:
+        """別名數與查詢快取統計"""
+        stats = {'merchants': len(self._display_names), 'aliases': self._trie.size}
+        if hasattr(self.match, 'cache_info'):
+            info = self.match.cache_info()
+            lookups = info.hits + info.misses
+            stats.update({
+                'cache_hits': info.hits,
+                'cache_misses': info.misses,
+                'cache_hit_ratio': round(info.hits / lookups, 3) if lookups else None
+            })
+        return stats
+
+
+def create_seller_normalizer() -> SellerNormalizer:
+    """
+    建立店家正規化器
+
+    EINVOICE_SELLER_ALIASES_PATH 指向的 JSON 檔 (預設 seller_aliases.json，存在時) 會加入內建別名表
+    """
+    normalizer = SellerNormalizer()
+    path = os.getenv('EINVOICE_SELLER_ALIASES_PATH', 'seller_aliases.json')
+    if os.path.exists(path):
+        try:
+            count = normalizer.load_alias_file(path)
+            logger.info(f"載入自訂店家別名：{count} 個店家")
+        except Exception as e:
+            logger.warning(f"讀取自訂店家別名失敗: {e}")
+    return normalizer
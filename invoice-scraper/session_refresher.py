@@ -0,0 +1,115 @@
+"""
+Session 背景更新排程
+在服務程序內定期檢查 session，接近到期時才探測或重新登入，讓使用者觸發的同步不必在請求中啟動瀏覽器
+"""
+
+import time
+import asyncio
+import logging
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRefresher:
+    """由 FastAPI lifespan 啟動的 session 更新排程"""
+
+    def __init__(self, scraper_factory: Callable, interval: float = 60, max_backoff: float = 1800):
+        """
+        Args:
+            scraper_factory: 建立爬蟲實例的函數
+            interval: 檢查間隔秒數
+            max_backoff: 連續失敗時檢查間隔的上限秒數 (間隔每次失敗加倍，成功後恢復)
+        """
+        self.scraper_factory = scraper_factory
+        self.interval = interval
+        self.max_backoff = max(interval, max_backoff)
+        self._task: Optional[asyncio.Task] = None
+        self._run_lock = asyncio.Lock()
+
+        # 狀態
+        self.last_run_at: Optional[float] = None
+        self.last_result: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.relogin_count = 0
+        self.consecutive_failures = 0
+        self.next_run_at: Optional[float] = None
+
+    def start(self):
+        """開始背景排程"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name='session-refresher')
+            logger.info(f"Session 更新排程已啟動，每 {self.interval:.0f} 秒檢查一次")
+
+    async def stop(self):
+        """停止背景排程"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    @property
+    def backoff_seconds(self) -> float:
+        """下次檢查前等待的秒數 (密碼錯誤或平台故障時避免每分鐘重新啟動瀏覽器)"""
+        if self.consecutive_failures == 0:
+            return self.interval
+        return min(self.interval * 2 ** self.consecutive_failures, self.max_backoff)
+
+    async def _run(self):
+        while True:
+            await self.refresh_once()
+            delay = self.backoff_seconds
+            self.next_run_at = time.time() + delay
+            await asyncio.sleep(delay)
+
+    async def refresh_once(self) -> str:
+        """立即檢查一次 (已有檢查進行中時等待其完成並沿用結果)"""
+        if self._run_lock.locked():
+            async with self._run_lock:
+                return self.last_result
+        async with self._run_lock:
+            return await asyncio.to_thread(self._refresh)
+
+    def _refresh(self) -> str:
+        scraper = self.scraper_factory()
+        try:
+            result = scraper.refresh_session()
+            self.last_error = None
+        except Exception as e:
+            result = 'failed'
+            self.last_error = str(e)
+            logger.error(f"Session 更新失敗: {e}")
+        finally:
+            scraper.close()
+
+        if result == 'relogin':
+            self.relogin_count += 1
+        if result == 'failed':
+            self.consecutive_failures += 1
+            logger.warning(f"Session 連續更新失敗 {self.consecutive_failures} 次，{self.backoff_seconds:.0f} 秒後再試")
+        elif result != 'busy':
+            self.consecutive_failures = 0
+        if result != 'fresh':
+            logger.info(f"Session 更新結果: {result}")
+
+        self.last_run_at = time.time()
+        self.last_result = result
+        return result
+
+    def stats(self) -> dict:
+        """排程狀態"""
+        return {
+            'running': self._task is not None and not self._task.done(),
+            'interval': self.interval,
+            'consecutive_failures': self.consecutive_failures,
+            'backoff_seconds': self.backoff_seconds,
+            'next_run_at': self.next_run_at,
+            'last_run_at': self.last_run_at,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+            'relogin_count': self.relogin_count
+        }
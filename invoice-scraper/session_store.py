@@ -0,0 +1,278 @@
+"""
+電子發票平台 Session 儲存
+提供記憶體與檔案兩種後端，以及跨程序的登入鎖（確保同一時間只有一個登入流程）
+"""
+
+import os
+import json
+import base64
+import time
+import logging
+import tempfile
+import threading
+from typing import Optional
+
+from carriers import DEFAULT_CARRIER, namespaced_path
+
+try:
+    import fcntl  # 僅 POSIX 提供，Windows 開發環境下退回程序內鎖
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def empty_session() -> dict:
+    """空的 session 內容"""
+    return {
+        'cookies': None,
+        'auth_token': None,
+        'cached_at': None,
+        'validated_at': None  # 最近一次成功的已驗證請求時間 (滑動 TTL 的起點)
+    }
+
+
+def jwt_expiry(token: Optional[str]) -> Optional[float]:
+    """
+    讀取 JWT 的 exp (不驗證簽章，只用來判斷何時需要更新)
+
+    Returns:
+        到期時間 (epoch 秒)；不是 JWT 或沒有 exp 時回傳 None
+    """
+    if not token:
+        return None
+    token = token.removeprefix('Bearer ').strip()
+    if token.count('.') != 2:
+        return None
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+class LoginLock:
+    """
+    登入用的單一飛行鎖
+
+    - 同一執行緒可重入（背景登入持有鎖後再呼叫 scraper.login() 不會死鎖）
+    - 提供 lock_path 時，另以 flock 鎖定檔案，讓多個 uvicorn worker 或重啟後的程序共用同一把鎖
+    - 介面與 threading.Lock 相容：acquire / release / locked / with
+    """
+
+    def __init__(self, lock_path: Optional[str] = None):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._lock_path = lock_path if fcntl else None
+        self._fd = None
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        """取得鎖，成功回傳 True"""
+        deadline = time.time() + timeout if blocking and timeout >= 0 else None
+
+        if not self._lock.acquire(blocking, timeout if blocking else -1):
+            return False
+
+        if self._depth == 0 and self._lock_path:
+            fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not blocking or (deadline is not None and time.time() >= deadline):
+                        os.close(fd)
+                        self._lock.release()
+                        return False
+                    time.sleep(0.2)
+            self._fd = fd
+
+        self._depth += 1
+        return True
+
+    def release(self):
+        """釋放鎖"""
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def locked(self) -> bool:
+        """是否有登入正在進行（包含其他程序）"""
+        if self._depth > 0:
+            return True
+        if not self._lock_path:
+            return False
+
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class SessionStore:
+    """Session 儲存介面"""
+
+    def __init__(self, login_lock: LoginLock):
+        self.login_lock = login_lock
+
+    def load(self) -> dict:
+        """讀取 session，格式同 empty_session()"""
+        raise NotImplementedError
+
+    def save(self, session: dict):
+        """寫入 session"""
+        raise NotImplementedError
+
+    def clear(self):
+        """清除 session"""
+        self.save(empty_session())
+
+    def touch(self, cookies: dict, validated_at: float) -> bool:
+        """
+        更新 session 的最近驗證時間（僅在儲存的仍是同一組 cookies 時）
+
+        登入進行中時略過，避免覆蓋剛寫入的新 session
+
+        Returns:
+            是否有更新
+        """
+        if not self.login_lock.acquire(blocking=False):
+            return False
+        try:
+            session = self.load()
+            if not session['cookies'] or session['cookies'] != cookies:
+                return False
+            session['validated_at'] = validated_at
+            self.save(session)
+            return True
+        finally:
+            self.login_lock.release()
+
+
+class SessionHealth:
+    """
+    Session 健康追蹤
+
+    記錄任一爬蟲方法最近一次成功的已驗證請求，並節流寫回 session 儲存，
+    讓持續使用中的 session 不會在固定 TTL 後被判定過期，也讓近期驗證過的 session 可略過探測
+    """
+
+    def __init__(self, store: SessionStore, persist_interval: float = 30):
+        """
+        Args:
+            store: session 儲存
+            persist_interval: 寫回儲存的最短間隔秒數
+        """
+        self.store = store
+        self.persist_interval = persist_interval
+        self._lock = threading.Lock()
+        self._persisted_at = 0.0
+        self.last_success_at: Optional[float] = None
+
+    def record_success(self, cookies: dict):
+        """記錄一次成功的已驗證請求"""
+        now = time.time()
+        with self._lock:
+            self.last_success_at = now
+            if now - self._persisted_at < self.persist_interval:
+                return
+            self._persisted_at = now
+
+        try:
+            self.store.touch(cookies, now)
+        except Exception as e:
+            logger.warning(f"更新 session 驗證時間失敗: {e}")
+
+    def reset(self):
+        """session 更換或清除後重新計算寫回間隔"""
+        with self._lock:
+            self._persisted_at = 0.0
+
+    @staticmethod
+    def last_validated(session: dict) -> Optional[float]:
+        """Session 最近一次確認可用的時間 (登入或成功請求)"""
+        times = [t for t in (session['cached_at'], session['validated_at']) if t]
+        return max(times) if times else None
+
+
+class MemorySessionStore(SessionStore):
+    """程序內記憶體儲存（重啟即遺失，不跨 worker 共享）"""
+
+    def __init__(self):
+        super().__init__(LoginLock())
+        self._session = empty_session()
+
+    def load(self) -> dict:
+        return dict(self._session)
+
+    def save(self, session: dict):
+        self._session = dict(session)
+
+
+class FileSessionStore(SessionStore):
+    """JSON 檔案儲存（原子寫入，可跨重啟與 worker 共用）"""
+
+    def __init__(self, path: str):
+        super().__init__(LoginLock(f"{path}.lock"))
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return empty_session()
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            session = empty_session()
+            session.update({key: data.get(key) for key in session})
+            return session
+        except Exception as e:
+            logger.warning(f"讀取 session 檔案失敗: {e}")
+            return empty_session()
+
+    def save(self, session: dict):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # mkstemp 建立的檔案權限為 0600，避免其他使用者讀取 cookies
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.einvoice_session.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(session, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def create_session_store(carrier: str = DEFAULT_CARRIER) -> SessionStore:
+    """
+    依環境變數建立 session 儲存（每個載具各自一份，登入鎖也各自獨立）
+
+    - EINVOICE_SESSION_STORE: 'file' (預設) 或 'memory'
+    - EINVOICE_SESSION_PATH: 檔案路徑 (預設 .einvoice_session.json，非預設載具會加上載具名稱)
+    """
+    backend = os.getenv('EINVOICE_SESSION_STORE', 'file').lower()
+    if backend == 'memory':
+        return MemorySessionStore()
+
+    path = os.getenv('EINVOICE_SESSION_PATH', '.einvoice_session.json')
+    return FileSessionStore(namespaced_path(path, carrier))
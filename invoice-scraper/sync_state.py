@@ -0,0 +1,112 @@
+"""
+增量同步狀態
+記錄已同步的發票號碼與發票日期，存放於本機 JSON 檔；查詢範圍以外的舊記錄於每次同步時移除
+"""
+
+import os
+import re
+import json
+import logging
+import tempfile
+from datetime import datetime
+from typing import Optional
+
+from carriers import DEFAULT_CARRIER, namespaced_path
+
+logger = logging.getLogger(__name__)
+
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+class SyncState:
+    """增量同步狀態（已同步的發票號碼 -> 發票日期）"""
+
+    DEFAULT_PATH = os.getenv('EINVOICE_SYNC_STATE_PATH', '.sync_state.json')
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+            path: 狀態檔路徑 (預設讀取 EINVOICE_SYNC_STATE_PATH)
+        """
+        self.path = path or self.DEFAULT_PATH
+        self.last_synced_at: Optional[str] = None     # 最後一次寫入狀態的時間
+        self.invoice_numbers: dict = {}               # 已同步的發票號碼 -> 發票日期 (YYYY-MM-DD)
+
+    @classmethod
+    def for_carrier(cls, carrier: str = DEFAULT_CARRIER) -> "SyncState":
+        """載入指定載具的同步狀態（預設載具沿用 DEFAULT_PATH）"""
+        return cls.load(namespaced_path(cls.DEFAULT_PATH, carrier))
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> "SyncState":
+        """從狀態檔載入，檔案不存在或損毀時回傳空狀態"""
+        state = cls(path)
+        if not os.path.exists(state.path):
+            return state
+
+        try:
+            with open(state.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            state.last_synced_at = data.get('last_synced_at')
+            state.invoice_numbers = dict(data.get('invoice_numbers', {}))
+        except Exception as e:
+            logger.warning(f"讀取同步狀態失敗，改為完整同步: {e}")
+            state = cls(path)
+
+        return state
+
+    def is_synced(self, invoice_number: str) -> bool:
+        """發票是否已在先前的同步中處理過"""
+        return bool(invoice_number) and invoice_number in self.invoice_numbers
+
+    def mark_synced(self, invoice_number: str, invoice_date: str):
+        """
+        記錄一張已成功處理（已寫入或確認已存在於 Notion）的發票
+
+        Args:
+            invoice_number: 發票號碼
+            invoice_date: 發票日期 (ISO 格式，無法解析時以今天日期記錄)
+        """
+        if not invoice_number:
+            return
+
+        self.invoice_numbers[invoice_number] = self._date_key(invoice_date)
+
+    def prune(self, before_date: str):
+        """移除發票日期早於 before_date (YYYY-MM-DD) 的記錄，避免狀態檔無限成長"""
+        self.invoice_numbers = {
+            number: date_key
+            for number, date_key in self.invoice_numbers.items()
+            if date_key >= before_date
+        }
+
+    def reset(self):
+        """清除所有狀態（完整重新同步）"""
+        self.invoice_numbers = {}
+
+    def save(self):
+        """以原子寫入 (先寫暫存檔再 rename) 儲存狀態"""
+        self.last_synced_at = datetime.now().isoformat()
+        data = {
+            'last_synced_at': self.last_synced_at,
+            'invoice_numbers': self.invoice_numbers
+        }
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sync_state.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _date_key(invoice_date: str) -> str:
+        """取出 YYYY-MM-DD 作為日期鍵"""
+        if invoice_date and DATE_PATTERN.match(invoice_date):
+            return invoice_date[:10]
+        return datetime.now().strftime('%Y-%m-%d')
@@ -0,0 +1,159 @@
+"""
+常駐 WebDriver
+登入時重用同一個 Chromium，閒置超過時間後自動關閉以回收記憶體
+"""
+
+import time
+import atexit
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WarmDriverPool:
+    """單一常駐 WebDriver，記錄啟動與重用耗時以便權衡記憶體與登入延遲"""
+
+    def __init__(self, idle_timeout: float = 300):
+        """
+        Args:
+            idle_timeout: 閒置多少秒後關閉瀏覽器
+        """
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._driver = None
+        self._owner: Optional[str] = None  # 常駐實例目前屬於哪個載具（瀏覽器狀態含該載具的登入資訊）
+        self._in_use = False
+        self._idle_timer: Optional[threading.Timer] = None
+
+        # 指標
+        self._launch_count = 0
+        self._launch_seconds = 0.0
+        self._reuse_count = 0
+        self._reuse_seconds = 0.0
+
+        # 程序結束時確保瀏覽器被關閉
+        atexit.register(self.shutdown)
+
+    def acquire(self, factory: Callable, owner: Optional[str] = None):
+        """
+        取得 WebDriver：有存活且屬於同一載具的常駐實例就重用，否則用 factory 啟動新的
+
+        Args:
+            factory: 建立新 WebDriver 的函數
+            owner: 使用者（載具名稱），不同載具不共用瀏覽器狀態
+
+        Returns:
+            WebDriver 實例
+        """
+        # 重用與啟動都從呼叫 acquire 開始計時到瀏覽器可用為止
+        started = time.perf_counter()
+        with self._lock:
+            self._cancel_idle_timer()
+
+            if self._in_use:
+                # 常駐實例正被使用（理論上登入鎖會避免），啟動一個不納入常駐的臨時實例
+                logger.warning("常駐 WebDriver 使用中，改為啟動臨時實例")
+                return factory()
+
+            if self._driver is not None and self._owner != owner:
+                logger.info("切換載具，關閉常駐 WebDriver 後重新啟動")
+                self._quit(self._driver)
+                self._driver = None
+
+            if self._driver is not None:
+                if self._is_alive(self._driver):
+                    self._reuse_count += 1
+                    self._reuse_seconds += time.perf_counter() - started
+                    self._in_use = True
+                    logger.info("重用常駐 WebDriver")
+                    return self._driver
+                self._quit(self._driver)
+                self._driver = None
+
+            self._driver = factory()
+            self._owner = owner
+            elapsed = time.perf_counter() - started
+            self._launch_count += 1
+            self._launch_seconds += elapsed
+            self._in_use = True
+            logger.info(f"啟動常駐 WebDriver，耗時 {elapsed:.2f} 秒")
+            return self._driver
+
+    def release(self, driver):
+        """歸還 WebDriver：切到空白頁降低資源占用，並開始閒置計時"""
+        with self._lock:
+            if driver is not self._driver:
+                self._quit(driver)
+                return
+
+            self._in_use = False
+            try:
+                driver.get('about:blank')
+            except Exception:
+                self._quit(driver)
+                self._driver = None
+                return
+
+            self._idle_timer = threading.Timer(self.idle_timeout, self._reap)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def discard(self, driver):
+        """丟棄異常的 WebDriver，下次重新啟動"""
+        with self._lock:
+            if driver is self._driver:
+                self._driver = None
+                self._in_use = False
+            self._quit(driver)
+
+    def shutdown(self):
+        """關閉常駐 WebDriver"""
+        with self._lock:
+            self._cancel_idle_timer()
+            if self._driver is not None:
+                self._quit(self._driver)
+                self._driver = None
+                self._in_use = False
+
+    def stats(self) -> dict:
+        """啟動 / 重用次數與平均耗時"""
+        return {
+            'alive': self._driver is not None,
+            'in_use': self._in_use,
+            'launch_count': self._launch_count,
+            'avg_launch_seconds': round(self._launch_seconds / self._launch_count, 3) if self._launch_count else None,
+            'reuse_count': self._reuse_count,
+            'avg_reuse_seconds': round(self._reuse_seconds / self._reuse_count, 3) if self._reuse_count else None,
+            'idle_timeout': self.idle_timeout
+        }
+
+    def _reap(self):
+        """閒置逾時：關閉瀏覽器"""
+        with self._lock:
+            self._idle_timer = None
+            if self._driver is not None and not self._in_use:
+                logger.info("常駐 WebDriver 閒置逾時，關閉瀏覽器")
+                self._quit(self._driver)
+                self._driver = None
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    @staticmethod
+    def _is_alive(driver) -> bool:
+        try:
+            _ = driver.current_url
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass